@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+FTE34806 - Modelling of Biobased Production Systems
+MSc Biosystems Engineering, WUR
+
+Benchmark of the per-step overhead of the fixed-step integration functions:
+the np.nditer loops with allocating right-hand sides (fcn_euler_forward,
+fcn_rk4) next to the in-place versions with preallocated work buffers
+(fcn_euler_forward_inplace, fcn_rk4_inplace), and the runs of the models
+with the methods 'euler'/'rk4' next to 'euler_inplace'/'rk4_inplace'.
+
+Run from the repository root:
+    python -m benchmarks.bench_integration
+"""
+import io
+import time
+import contextlib
+
+import numpy as np
+
+from mbps.functions.integration import (fcn_euler_forward, fcn_rk4,
+                                        fcn_euler_forward_inplace,
+                                        fcn_rk4_inplace)
+from mbps.models.lotka_volterra import LotkaVolterra
+from mbps.models.sir import SIR
+
+def time_per_step(fcn, diff, y0, n_steps=20000, repeat=5):
+    """ Best time per integration step [us] over `repeat` runs """
+    tspan = (0.0, float(n_steps))
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fcn(diff, tspan, y0, h=1.0)
+        best = min(best, time.perf_counter() - t0)
+    return best/n_steps*1E6
+
+# Models (small steps, to keep the states bounded over many steps)
+tsim = np.linspace(0, 365, 366)
+lv = LotkaVolterra(tsim, 1.0, {'prey':50, 'pred':50},
+                   {'p1':1/30, 'p2':0.02/30, 'p3':0.01/30, 'p4':1/30})
+sir = SIR(tsim, 1.0, {'susceptible':0.99, 'infected':0.01, 'recovered':0.0},
+          {'beta':0.5, 'gamma':0.02})
+class Decay():
+    # Trivial right-hand side, to measure the integrator overhead alone
+    p = {'k':1.0}
+    def diff(self,_t,_y0):
+        return -self.p['k']*_y0
+    def diff_inplace(self,_t,_y0,_dy):
+        np.multiply(_y0, -self.p['k'], out=_dy)
+
+models = {
+    'Decay':(Decay(), np.array([1.0, 2.0])),
+    'LotkaVolterra':(lv, lv.get_y0(('prey','pred'))),
+    'SIR':(sir, sir.get_y0(('susceptible','infected','recovered'))),
+    }
+
+print('%-15s %-8s %14s %14s %8s' % ('model', 'method', 'nditer [us]',
+                                     'in-place [us]', 'speedup'))
+for name, (model, y0) in models.items():
+    # Scale the rates so that h=1.0 remains stable for many steps
+    for k in model.p:
+        model.p[k] = model.p[k]*1E-2
+    if hasattr(model, 'compile_p'):
+        model.compile_p()
+    for method, fcn, fcn_ip in (('euler', fcn_euler_forward,
+                                 fcn_euler_forward_inplace),
+                                ('rk4', fcn_rk4, fcn_rk4_inplace)):
+        # Both versions must give the same results
+        y_ref = fcn(model.diff, (0.0, 100.0), y0, h=1.0)['y']
+        y_ip = fcn_ip(model.diff_inplace, (0.0, 100.0), y0, h=1.0)['y']
+        assert np.allclose(y_ref, y_ip, rtol=1E-12, atol=0)
+        t_ref = time_per_step(fcn, model.diff, y0)
+        t_ip = time_per_step(fcn_ip, model.diff_inplace, y0)
+        print('%-15s %-8s %14.2f %14.2f %7.1fx' % (name, method, t_ref,
+                                                 t_ip, t_ref/t_ip))
+
+# Runs of the models, with the methods of the registry
+# (the same integration through Module.integrate, with 'diff_inplace')
+def time_per_run(model, x0, repeat=5):
+    """ Best time per run [ms] over `repeat` runs, and its outputs """
+    tspan = (model.t[0], model.t[-1])
+    best = np.inf
+    for _ in range(repeat):
+        model.x0 = dict(x0)
+        t0 = time.perf_counter()
+        # (without the messages printed by LotkaVolterra.output)
+        with contextlib.redirect_stdout(io.StringIO()):
+            y = model.run(tspan)
+        best = min(best, time.perf_counter() - t0)
+    return best*1E3, y
+
+print()
+print('%-15s %-8s %14s %14s %8s' % ('model run', 'method', 'run [ms]',
+                                     'in-place [ms]', 'speedup'))
+tsim = np.linspace(0, 2000, 2001)
+for name in ('LotkaVolterra', 'SIR'):
+    model = models[name][0]
+    x0 = dict(model.x0)
+    for method in ('euler', 'rk4'):
+        runs = [time_per_run(type(model)(tsim, 1.0, x0, model.p, method=m),
+                             x0)
+                for m in (method, method+'_inplace')]
+        (t_ref, y_ref), (t_ip, y_ip) = runs
+        for k in model.x_keys:
+            assert np.allclose(y_ref[k], y_ip[k], rtol=1E-12, atol=0)
+        print('%-15s %-8s %14.2f %14.2f %7.1fx' % (name, method, t_ref,
+                                                 t_ip, t_ref/t_ip))
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+FTE34806 - Modelling of Biobased Production Systems
+MSc Biosystems Engineering, WUR
+
+Benchmark of the result logging of Module.run for chunked simulations:
+one run over the whole simulation time next to one run per day (as for
+coupled models, or receding-horizon control). The results are written to
+the logs by index range (Module.log_slice), at a constant cost per run, so
+the ratio of the daily runs to the single run does not grow with the
+length of the simulation. It is not 1: each run has a fixed set-up cost
+(parameter vector, initial conditions, time vectors of the integration),
+about 3x here for one-day runs of 10 steps (3.0-3.6x measured for 365,
+3650 and 36500 days).
+
+Run from the repository root:
+    python -m benchmarks.bench_run
+"""
+import io
+import time
+import contextlib
+
+import numpy as np
+
+from mbps.models.lotka_volterra import LotkaVolterra
+
+def make_model(n_days):
+    tsim = np.linspace(0, n_days, n_days+1)
+    return LotkaVolterra(tsim, 0.1, {'prey':50, 'pred':50},
+                         {'p1':1/30, 'p2':0.02/30, 'p3':0.01/30,
+                          'p4':1/30}, dt_save=1.0)
+
+def time_runs(n_days, chunk, repeat=3):
+    """ Best time [s] to simulate `n_days` in runs of `chunk` days """
+    best = np.inf
+    for _ in range(repeat):
+        model = make_model(n_days)
+        t0 = time.perf_counter()
+        # (LotkaVolterra prints a message per run)
+        with contextlib.redirect_stdout(io.StringIO()):
+            for ti in range(0, n_days, chunk):
+                model.run((ti, min(ti+chunk, n_days)))
+        best = min(best, time.perf_counter() - t0)
+    return best, model
+
+def time_logging(n_days, repeat=3):
+    """ Time [s] per run of the log indices: search (np.isin) and
+    index range (Module.log_slice), for a one-day run """
+    model = make_model(n_days)
+    t = model.t[n_days//2:n_days//2+2]
+    res = []
+    for fcn in (lambda: (np.isin(model.t,t), np.isin(t,model.t)),
+                lambda: model.log_slice(t)):
+        best = np.inf
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            for _ in range(1000):
+                fcn()
+            best = min(best, (time.perf_counter() - t0)/1000)
+        res.append(best)
+    return res
+
+print('%-8s %14s %14s %8s %14s %14s' % ('days', 'single [s]', 'daily [s]',
+                                        'ratio', 'isin [us]',
+                                        'slice [us]'))
+for n_days in (365, 3650, 36500):
+    t_one, m_one = time_runs(n_days, n_days)
+    t_day, m_day = time_runs(n_days, 1)
+    # Both ways must give the same logs
+    assert np.allclose(m_one.y['prey'], m_day.y['prey'], rtol=1E-10)
+    t_isin, t_slice = time_logging(n_days)
+    print('%-8d %14.4f %14.4f %7.2fx %14.2f %14.2f'
+          % (n_days, t_one, t_day, t_day/t_one, t_isin*1E6, t_slice*1E6))
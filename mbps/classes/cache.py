@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+FTE34806 - Modelling of Biobased Production Systems
+MSc Biosystems Engineering, WUR
+
+Cache of simulation results, for identical runs of a model module
+
+A run is identified by a hash of its inputs (class of the model,
+parameters, initial conditions, disturbances, controlled inputs, time
+span, integration method, options and time-steps). The outputs (and
+flows) of a run are kept in memory, in a least-recently-used (LRU)
+dictionary of bounded size, and optionally on disk, in a directory of
+bounded size (the least recently used entries are removed first).
+"""
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+
+def _hash_update(h, obj):
+    """ Update the hash `h` with the contents of `obj` (dictionaries,
+    sequences, strings, numbers and arrays). Numbers are hashed as
+    float64, so e.g. 0 and 0.0 give the same key.
+    """
+    if obj is None:
+        h.update(b'N')
+    elif isinstance(obj, str):
+        h.update(b'S%d:' % len(obj) + obj.encode())
+    elif isinstance(obj, dict):
+        h.update(b'D%d:' % len(obj))
+        for k in sorted(obj, key=str):
+            _hash_update(h, str(k))
+            _hash_update(h, obj[k])
+    elif isinstance(obj, (list, tuple)):
+        h.update(b'L%d:' % len(obj))
+        for v in obj:
+            _hash_update(h, v)
+    elif isinstance(obj, (int, float, np.ndarray, np.generic)):
+        arr = np.asarray(obj)
+        if arr.dtype.kind in 'biuf':
+            arr = arr.astype(float)
+        elif arr.dtype.kind not in 'cU':
+            raise TypeError('cannot hash arrays of dtype %s' % arr.dtype)
+        h.update(b'A' + arr.dtype.str.encode() + str(arr.shape).encode())
+        h.update(np.ascontiguousarray(arr).tobytes())
+    else:
+        raise TypeError('cannot hash objects of type %s'
+                        % type(obj).__name__)
+
+def _read_only(arr):
+    # (copy of the array, protected against modification)
+    arr = np.array(arr)
+    arr.flags.writeable = False
+    return arr
+
+class ResultCache():
+    """ Cache of the outputs of Module runs (see the argument `cache` of
+    Module)
+
+    The arrays of a cached run are read-only, and are returned by the
+    cache hits without a copy (memory-mapped, for the entries on disk).
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of runs kept in memory.
+    path : str, optional
+        Directory of the cache on disk (created if needed). By default,
+        the runs are only kept in memory.
+    max_bytes : int
+        Maximum size of the cache on disk [bytes].
+
+    Attributes
+    ----------
+    hits, misses : int
+        Number of runs found, and not found, in the cache.
+    disk_hits : int
+        Number of hits found on disk (not in memory).
+    """
+    def __init__(self, maxsize=128, path=None, max_bytes=2**30):
+        self.maxsize, self.path, self.max_bytes = maxsize, path, max_bytes
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+        self._init_memory()
+
+    def _init_memory(self):
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits, self.misses, self.disk_hits = 0, 0, 0
+
+    def __getstate__(self):
+        # (copies for worker processes keep the settings and the disk
+        # store, but not the entries in memory)
+        return {'maxsize':self.maxsize, 'path':self.path,
+                'max_bytes':self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_memory()
+
+    def key(self, module, tspan):
+        """ Key of a run of `module` over `tspan`, with its current
+        inputs (hexadecimal hash)
+
+        Raises
+        ------
+        TypeError
+            If an input cannot be hashed (e.g. a callable option).
+        """
+        h = hashlib.blake2b(digest_size=20)
+        cls = type(module)
+        _hash_update(h, (cls.__module__, cls.__qualname__))
+        _hash_update(h, (module.p, module.x0, module.d, module.u))
+        _hash_update(h, tuple(float(t) for t in tspan))
+        _hash_update(h, (module.method, module.options, module.dt,
+                         module.nsave, bool(module.use_jit()),
+                         bool(module.record and module.f_keys)))
+        return h.hexdigest()
+
+    def get(self, key):
+        """ Outputs and flows of a cached run
+
+        Returns
+        -------
+        entry : 2-tuple of dictionaries, or None
+            Outputs `y` and flows `f` of the run (read-only arrays), or
+            None if the run is not in the cache.
+        """
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry
+        entry = self._load(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+            self._remember(key, entry)
+        return entry
+
+    def put(self, key, y, f=None):
+        """ Add the outputs `y` and flows `f` (dictionaries of arrays) of
+        a run to the cache (as read-only copies)
+        """
+        entry = ({k:_read_only(v) for k,v in y.items()},
+                 {k:_read_only(v) for k,v in (f or {}).items()})
+        with self._lock:
+            self._remember(key, entry)
+        if self.path is not None:
+            self._save(key, entry)
+
+    def _remember(self, key, entry):
+        # Add to the memory, and remove the least recently used entries
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+
+    def _save(self, key, entry):
+        # One directory per run, with one .npy file per array, named by
+        # position and key (so the outputs are loaded in the same order)
+        # (written to a temporary directory, then renamed at once)
+        target = os.path.join(self.path, key)
+        if os.path.isdir(target):
+            return
+        tmp = tempfile.mkdtemp(dir=self.path, prefix='.tmp-')
+        for prefix, arrays in zip(('y.', 'f.'), entry):
+            for i, (k, v) in enumerate(arrays.items()):
+                np.save(os.path.join(tmp, '%s%d.%s.npy' % (prefix, i, k)), v)
+        try:
+            os.rename(tmp, target)
+        except OSError:
+            # (saved meanwhile by another process)
+            shutil.rmtree(tmp, ignore_errors=True)
+        self._evict()
+
+    def _load(self, key):
+        if self.path is None:
+            return None
+        target = os.path.join(self.path, key)
+        try:
+            files = []
+            for name in os.listdir(target):
+                pos, k = name[2:-4].split('.', 1)
+                files.append((('y.', 'f.').index(name[:2]), int(pos), k,
+                              name))
+            entry = ({}, {})
+            for i, _, k, name in sorted(files):
+                entry[i][k] = np.load(os.path.join(target, name),
+                                      mmap_mode='r')
+            # (time of last use, for the eviction)
+            os.utime(target)
+        except (OSError, ValueError):
+            return None
+        return entry
+
+    def _evict(self):
+        # Remove the least recently used runs on disk, down to max_bytes
+        entries = []
+        for name in os.listdir(self.path):
+            target = os.path.join(self.path, name)
+            if name.startswith('.') or not os.path.isdir(target):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(target, f))
+                           for f in os.listdir(target))
+                entries.append((os.path.getmtime(target), size, target))
+            except OSError:
+                continue
+        total = sum(e[1] for e in entries)
+        for _, size, target in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(target, ignore_errors=True)
+            total -= size
+
+    def disk_bytes(self):
+        """ Size of the cache on disk [bytes] """
+        if self.path is None:
+            return 0
+        total = 0
+        for root, _, files in os.walk(self.path):
+            total += sum(os.path.getsize(os.path.join(root, f))
+                         for f in files)
+        return total
+
+    def stats(self):
+        """ Statistics of the cache
+
+        Returns
+        -------
+        stats : dictionary
+            Hits, misses and disk hits, hit ratio, number of runs in
+            memory, and size on disk [bytes].
+        """
+        n = self.hits + self.misses
+        return {'hits':self.hits, 'misses':self.misses,
+                'disk_hits':self.disk_hits,
+                'hit_ratio':self.hits/n if n else 0.,
+                'memory_entries':len(self._memory),
+                'disk_bytes':self.disk_bytes()}
+
+    def clear(self):
+        """ Remove all runs from the cache (in memory and on disk) """
+        with self._lock:
+            self._memory.clear()
+        if self.path is not None:
+            for name in os.listdir(self.path):
+                shutil.rmtree(os.path.join(self.path, name),
+                              ignore_errors=True)
@@ -0,0 +1,445 @@
+# -*- coding: utf-8 -*-
+"""
+FTE34806 - Modelling of Biobased Production Systems
+MSc Biosystems Engineering, WUR
+
+Calibration of the parameters of a model module to observed data, by
+bounded (trust-region reflective) least squares
+
+The Jacobian of the residuals is computed from the forward sensitivity
+equations of the model (Module.sensitivities), or by finite differences,
+with the perturbed runs integrated as one ensemble, or distributed over
+processes (see Module.ns).
+
+Several datasets with their own disturbances and initial conditions (e.g.
+site-years) can be calibrated jointly, with one parameter vector, with
+`JointCalibration`.
+"""
+import os
+import time
+import contextlib
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from scipy.optimize import least_squares
+
+from mbps.classes.module import map_runs
+from mbps.functions.integration import time_index
+
+def read_datasets(t,data,key):
+    """ Datasets of observed outputs, for the comparison with the runs
+    of a module (see Calibration and EnsembleSampler)
+
+    Parameters
+    ----------
+    t : ndarray
+        Time array of the module.
+    data : list of dictionaries
+        Datasets, each with the keys 'y' (output), 't' (times, stored
+        time instants of the module), 'data' (observed values), and
+        optionally `key`.
+    key : str
+        Key of the scale of the errors in the datasets (e.g. 'weight' or
+        'sigma'), scalar or array (1 by default).
+
+    Returns
+    -------
+    datasets : list of tuples
+        Output, indices of the data in `t`, observed values, and values
+        of `key` (of the shape of the observed values), per dataset.
+    y_keys : list of str
+        Outputs of the datasets (each once).
+    """
+    datasets = []
+    for ds in data:
+        obs = np.asarray(ds['data'],dtype=float)
+        scale = np.broadcast_to(np.asarray(ds.get(key,1.),dtype=float),
+                                obs.shape)
+        datasets.append((ds['y'],time_index(t,ds['t']),obs,scale))
+    y_keys = list(dict.fromkeys(ds[0] for ds in datasets))
+    return datasets, y_keys
+
+# Sites of JointCalibration in a worker of its process pool
+# (sent once per fit, by the initializer of the pool)
+_SITES = None
+
+def _init_sites(sites):
+    global _SITES
+    _SITES = sites
+
+def _site_call(i,method,*args):
+    """ Evaluation of the site `i` of JointCalibration, in a worker of
+    its process pool """
+    return getattr(_SITES[i],method)(*args)
+
+class Calibration():
+    """ Least-squares calibration of parameters of a Module
+
+    The residuals are the weighted errors ``sqrt(w)*(y - y_data)`` of the
+    outputs at the times of the data, for all datasets, so the cost is
+    ``0.5*sum(w*(y - y_data)**2)``.
+
+    Parameters
+    ----------
+    module : Module
+        Instance of the model (with the time array of the runs).
+    x0 : dictionary
+        Initial conditions.
+    p : dictionary
+        Parameters (initial values of the calibrated ones).
+    data : list of dictionaries
+        Datasets, each with the keys 'y' (output, a state or derived
+        output), 't' (times, stored time instants of the module), 'data'
+        (observed values), and optionally 'weight' (scalar or array).
+    p_keys : sequence of str
+        Parameters to calibrate (a subset of `p`).
+    bounds : dictionary of 2-tuples, optional
+        Ranges (low, high) of the calibrated parameters (by default,
+        unbounded).
+    d, u : dictionaries, optional
+        Disturbances and controlled inputs of the runs.
+    jac : {'forward', 'fd'}
+        Jacobian from the forward sensitivity equations (default), or by
+        forward finite differences.
+    n_jobs : int
+        Number of processes for the finite differences (-1 for all CPUs),
+        in one process pool for each fit. With 1 (default), the perturbed
+        runs are integrated as one ensemble.
+    executor : concurrent.futures.Executor, optional
+        Pool of threads or processes for the finite differences, instead
+        of the process pool of each fit.
+
+    Attributes
+    ----------
+    p_fit : dictionary
+        Parameters of the last fit (the start of the next one).
+    log : list of dictionaries
+        Per iteration (Jacobian evaluation) of the fits: elapsed time [s],
+        cost, numbers of residual and Jacobian evaluations, and
+        parameters (see 'log_frame').
+
+    Examples
+    --------
+    >>> data = [{'y':'Wg', 't':t_data, 'data':m_data}]
+    >>> cal = Calibration(grass, x0, p, data, ('alpha','beta'), d=d, u=u,
+    ...                   bounds={'alpha':(0,1E-7), 'beta':(0,0.1)})
+    >>> result = cal.fit()
+    >>> result.p
+    """
+    def __init__(self,module,x0,p,data,p_keys,bounds=None,d=None,u=None,
+                 jac='forward',n_jobs=1,executor=None):
+        if jac not in ('forward','fd'):
+            raise ValueError("jac must be 'forward' or 'fd', got %r" % jac)
+        self.module = module.clone(logs=False)
+        self.x0, self.d, self.u = dict(x0), d, u
+        self.init_fit(p,p_keys,bounds)
+        self.jac, self.n_jobs, self.executor = jac, n_jobs, executor
+        # Datasets: output, indices of the data in the module time array,
+        # observed values, and square root of the weights
+        datasets, self.y_keys = read_datasets(self.module.t,data,'weight')
+        self.data = [(yk,idx,obs,np.sqrt(w)) for yk,idx,obs,w in datasets]
+
+    def init_fit(self,p,p_keys,bounds):
+        """ Parameters, bounds, start and log of the fits """
+        self.p, self.p_keys = dict(p), list(p_keys)
+        bounds = bounds or {}
+        self.bounds = (np.array([bounds.get(k,(-np.inf,np.inf))[0]
+                                 for k in self.p_keys],dtype=float),
+                       np.array([bounds.get(k,(-np.inf,np.inf))[1]
+                                 for k in self.p_keys],dtype=float))
+        self.p_fit = {k:self.p[k] for k in self.p_keys}
+        self.log = []
+        # Counters of the current fit, and last evaluated residuals
+        self._nfev, self._njev, self._t0 = 0, 0, None
+        self._last = (None, None)
+        # Process pool of the current fit (see 'pool')
+        self._pool = None
+
+    def params(self,pv):
+        """ Dictionary of all parameters, with the calibrated ones from
+        the vector `pv` (in the order of `p_keys`)
+        """
+        p = dict(self.p)
+        p.update({k:float(v) for k,v in zip(self.p_keys,pv)})
+        return p
+
+    def errors(self,y):
+        """ Weighted errors of the outputs `y` (arrays of shape (n_t,)),
+        for all datasets in one vector """
+        return np.concatenate([sw*(np.asarray(y[yk])[idx]-obs)
+                               for yk,idx,obs,sw in self.data])
+
+    def simulate(self,pv):
+        """ Outputs `y_keys` of a run with the parameters `pv` """
+        self.module.x0, self.module.p = dict(self.x0), self.params(pv)
+        tspan = (self.module.t[0],self.module.t[-1])
+        y = self.module.run(tspan,self.d,self.u,outputs=())
+        return {yk:np.asarray(y[yk]) for yk in self.y_keys}
+
+    def evaluate(self,pv):
+        """ Vector of weighted residuals for the parameters `pv` """
+        return self.errors(self.simulate(pv))
+
+    def residuals(self,pv):
+        """ Vector of weighted residuals for the parameters `pv`
+        (function of least_squares, counted in the log) """
+        self._nfev += 1
+        r = self.evaluate(pv)
+        self._last = (np.array(pv,dtype=float), r)
+        return r
+
+    def jacobian(self,pv):
+        """ Jacobian of the residuals to the parameters `pv`
+        (function of least_squares, logged per iteration) """
+        self._njev += 1
+        pv = np.asarray(pv,dtype=float)
+        J = self.evaluate_jacobian(pv)
+        self.log.append(dict(iteration=len(self.log),
+                             time=time.perf_counter()-self._t0,
+                             cost=0.5*np.sum(self._last[1]**2),
+                             nfev=self._nfev,njev=self._njev,
+                             **dict(zip(self.p_keys,pv.tolist()))))
+        return J
+
+    def evaluate_jacobian(self,pv,r=None):
+        """ Jacobian of the residuals to the parameters `pv`, of shape
+        (n_residuals, n_params)
+
+        Parameters
+        ----------
+        pv : ndarray
+            Calibrated parameters.
+        r : ndarray, optional
+            Residuals at `pv`, for the finite differences (by default,
+            those of the last call of 'residuals', if at `pv`, or of an
+            extra run).
+        """
+        pv = np.asarray(pv,dtype=float)
+        if self.jac == 'forward':
+            _, sens = self.module.sensitivities(self.x0,self.params(pv),
+                                                self.d,self.u,self.y_keys,
+                                                self.p_keys)
+            # (columns of the sensitivities at the times of the data)
+            J = np.concatenate([sw[:,None]*sens[yk][:,idx].T
+                                for yk,idx,obs,sw in self.data])
+        else:
+            # Forward differences, from the residuals at pv
+            # (run with the perturbed ones, if not evaluated before)
+            h = np.sqrt(np.finfo(float).eps)*np.where(pv!=0,np.abs(pv),1.)
+            # (steps towards the interior of the bounds)
+            h = np.where(pv+h > self.bounds[1],-h,h)
+            if (r is None and self._last[0] is not None
+                    and np.array_equal(self._last[0],pv)):
+                r = self._last[1]
+            base = r is None
+            runs = [self.params(pv)] if base else []
+            for j in range(len(self.p_keys)):
+                pj = pv.copy()
+                pj[j] += h[j]
+                runs.append(self.params(pj))
+            tspan = (self.module.t[0],self.module.t[-1])
+            if self.executor is None and self.n_jobs == 1:
+                # One ensemble run of all the perturbed parameter sets
+                p_batch = dict(self.p)
+                for k in self.p_keys:
+                    p_batch[k] = np.array([run[k] for run in runs])
+                self.module.x0, self.module.p = dict(self.x0), p_batch
+                y = self.module.run(tspan,self.d,self.u,outputs=())
+                results = [{yk:np.asarray(y[yk])[j] for yk in self.y_keys}
+                           for j in range(len(runs))]
+            else:
+                results = map_runs(self.module,self.x0,tspan,self.d,self.u,
+                                   self.y_keys,runs,self.n_jobs,
+                                   self.executor or self._pool)
+            if base:
+                r = self.errors(results.pop(0))
+                self._last = (pv, r)
+            J = np.array([(self.errors(y_j)-r)/h[j]
+                          for j,y_j in enumerate(results)]).T
+        return J
+
+    def fit(self,p0=None,**options):
+        """ Calibrate the parameters, with scipy.optimize.least_squares
+        (method 'trf')
+
+        Parameters
+        ----------
+        p0 : dictionary, optional
+            Initial values of the calibrated parameters. By default, the
+            result of the last fit (warm start), or the values of `p`.
+        **options
+            Options of least_squares (e.g. ftol, xtol, max_nfev).
+
+        Returns
+        -------
+        result : OptimizeResult
+            Result of least_squares, with the calibrated parameters as
+            dictionary `p`, and the time of the fit `elapsed` [s].
+        """
+        p0 = self.p_fit if p0 is None else {**self.p_fit, **p0}
+        x0 = np.array([p0[k] for k in self.p_keys],dtype=float)
+        # (scale of each parameter, for the trust region)
+        x_scale = np.where(x0!=0,np.abs(x0),1.)
+        options = {'x_scale':x_scale, **options}
+        self.log = []
+        self._nfev, self._njev, self._t0 = 0, 0, time.perf_counter()
+        with self.pool():
+            result = least_squares(self.residuals,x0,jac=self.jacobian,
+                                   bounds=self.bounds,method='trf',**options)
+        result.p = {k:float(v) for k,v in zip(self.p_keys,result.x)}
+        result.elapsed = time.perf_counter()-self._t0
+        self.p_fit = dict(result.p)
+        return result
+
+    def new_pool(self,n_jobs):
+        """ Process pool of `n_jobs` workers (see 'pool'), or None if
+        the evaluations do not use one
+        """
+        if self.jac != 'fd':
+            return None
+        return ProcessPoolExecutor(n_jobs)
+
+    @contextlib.contextmanager
+    def pool(self):
+        """ Context with one process pool of `n_jobs` for all
+        evaluations (e.g. the iterations of a fit), instead of a new pool
+        per evaluation. Nothing is done with an `executor`, or with
+        `n_jobs` of 1.
+        """
+        n_jobs = os.cpu_count() if self.n_jobs == -1 else self.n_jobs
+        if self.executor is not None or n_jobs <= 1 or self._pool is not None:
+            yield
+            return
+        self._pool = self.new_pool(n_jobs)
+        try:
+            yield
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown()
+            self._pool = None
+
+    def log_frame(self):
+        """ Log of the iterations of the last fit, as a DataFrame """
+        return pd.DataFrame(self.log).set_index('iteration')
+
+class JointCalibration(Calibration):
+    """ Joint least-squares calibration of one set of parameters, for
+    several sites (or years), each with its own disturbances, initial
+    conditions and data
+
+    The residuals of all sites are combined, so the cost is the sum of
+    the costs of the sites. For each candidate parameter set, the sites
+    are evaluated serially, or concurrently over an executor (with the
+    finite differences of each site as one ensemble run). With `n_jobs`,
+    the sites are sent once per fit to the workers of its process pool,
+    and each evaluation only sends the parameters. The module of each
+    site keeps its tables of disturbances between iterations (see
+    Disturbances.precompute).
+
+    Parameters
+    ----------
+    sites : list of dictionaries
+        Sites, each with the keys 'module' (instance of the model), 'x0'
+        and 'data' (see Calibration), and optionally 'd', 'u' and 'name'.
+    p : dictionary
+        Parameters (initial values of the calibrated ones).
+    p_keys : sequence of str
+        Parameters to calibrate (a subset of `p`).
+    bounds : dictionary of 2-tuples, optional
+        Ranges (low, high) of the calibrated parameters.
+    jac : {'forward', 'fd'}
+        Jacobian of the residuals of each site (see Calibration).
+    n_jobs : int
+        Number of processes for the sites (-1 for all CPUs), in one
+        process pool for each fit. With 1 (default), the sites are
+        evaluated serially.
+    executor : concurrent.futures.Executor, optional
+        Pool of threads for the sites, instead of the process pool of
+        each fit (with a process pool, the site is sent with each
+        evaluation).
+
+    Examples
+    --------
+    >>> sites = [{'module':Grass(tsim,dt,x0,p), 'x0':x0, 'd':d[yr], 'u':u,
+    ...           'data':data[yr], 'name':yr} for yr in (2001,2003,2007)]
+    >>> cal = JointCalibration(sites, p, ('alpha','beta'), n_jobs=3)
+    >>> result = cal.fit()
+    >>> cal.site_costs(result.x)
+    """
+    def __init__(self,sites,p,p_keys,bounds=None,jac='forward',n_jobs=1,
+                 executor=None):
+        self.sites = [Calibration(s['module'],s['x0'],p,s['data'],p_keys,
+                                  bounds,s.get('d'),s.get('u'),jac)
+                      for s in sites]
+        self.names = [s.get('name',i) for i,s in enumerate(sites)]
+        self.init_fit(p,p_keys,bounds)
+        self.jac, self.n_jobs, self.executor = jac, n_jobs, executor
+
+    def new_pool(self,n_jobs):
+        """ Process pool for the sites, with a copy of the sites in each
+        worker (see 'pool')
+        """
+        return ProcessPoolExecutor(min(n_jobs,len(self.sites)),
+                                   initializer=_init_sites,
+                                   initargs=(self.sites,))
+
+    def map_sites(self,method,pv,args=None):
+        """ Results of the method `method` of each site at `pv`, serially
+        or concurrently (see `n_jobs` and `executor`)
+
+        Parameters
+        ----------
+        method : str
+            Name of the method of Calibration.
+        pv : ndarray
+            Calibrated parameters.
+        args : list, optional
+            Further argument of the method, for each site.
+        """
+        n_jobs = os.cpu_count() if self.n_jobs == -1 else self.n_jobs
+        if self._pool is None and self.executor is None and n_jobs > 1:
+            # (outside of a fit, with a process pool for this call)
+            with self.pool():
+                return self.map_sites(method,pv,args)
+        extra = [()]*len(self.sites) if args is None else [(a,) for a in args]
+        if self._pool is not None:
+            futures = [self._pool.submit(_site_call,i,method,pv,*a)
+                       for i,a in enumerate(extra)]
+        elif self.executor is not None:
+            futures = [self.executor.submit(getattr(cal,method),pv,*a)
+                       for cal,a in zip(self.sites,extra)]
+        else:
+            return [getattr(cal,method)(pv,*a)
+                    for cal,a in zip(self.sites,extra)]
+        return [future.result() for future in futures]
+
+    def evaluate(self,pv):
+        """ Vector of weighted residuals of all sites """
+        return np.concatenate(self.map_sites('evaluate',pv))
+
+    def evaluate_jacobian(self,pv,r=None):
+        """ Jacobian of the residuals of all sites, of shape
+        (n_residuals, n_params), from the residuals `r` at `pv` (by
+        default, those of the last call of 'residuals', if at `pv`)
+        """
+        pv = np.asarray(pv,dtype=float)
+        if (r is None and self._last[0] is not None
+                and np.array_equal(self._last[0],pv)):
+            r = self._last[1]
+        args = None
+        if r is not None:
+            # (residuals of each site, in the order of the sites)
+            sizes = [sum(ds[2].size for ds in cal.data) for cal in self.sites]
+            args = np.split(r,np.cumsum(sizes)[:-1])
+        return np.concatenate(self.map_sites('evaluate_jacobian',pv,args))
+
+    def site_costs(self,pv):
+        """ Cost of each site, for the parameters `pv`
+
+        Returns
+        -------
+        costs : Series
+            Cost ``0.5*sum(w*(y - y_data)**2)`` by site name.
+        """
+        r = self.map_sites('evaluate',pv)
+        return pd.Series([0.5*np.sum(r_i**2) for r_i in r],index=self.names)
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+FTE34806 - Modelling of Biobased Production Systems
+MSc Biosystems Engineering, WUR
+
+Tables of disturbances (or controlled inputs) for the models
+
+The disturbances are given to the models as a dictionary of 2D arrays of
+shape (n_t, 2), for time and value. A `Disturbances` object validates
+these series once, and interpolates them linearly (as np.interp) at the
+time instants requested by the method 'diff' of a model.
+"""
+import bisect
+import numpy as np
+
+from mbps.functions.integration import time_grid
+
+class Disturbances():
+    """ Linear interpolation of time series of disturbances
+
+    Series with uniform time steps (e.g. daily weather data) are
+    interpolated by direct indexing instead of a search of the time
+    array. The values at all the stage times of a fixed-step integration
+    can be computed up front, with the method 'precompute'.
+
+    Parameters
+    ----------
+    d : dictionary of 2D arrays
+        Disturbances, of shape (n_t, 2) for time and value.
+    keys : sequence of str, optional
+        Keys of `d` to interpolate, in the order of the results
+        (by default, all keys of `d`).
+
+    Attributes
+    ----------
+    d : dictionary
+        The dictionary `d` (to check if the tables are up to date).
+    keys : tuple of str
+        Keys of the interpolated series.
+    uniform : dictionary of bool
+        Whether each series has uniform time steps.
+    """
+    def __init__(self, d, keys=None):
+        if keys is None:
+            keys = tuple(d.keys())
+        self.d, self.keys = d, tuple(keys)
+        self.t, self.v, self.slope = {}, {}, {}
+        self.uniform = {}
+        # (the same values as lists, for the interpolation at one time
+        # instant with Python floats, without the overhead of NumPy scalars)
+        self._lists = {}
+        for k in self.keys:
+            arr = np.asarray(d[k], dtype=float)
+            if arr.ndim != 2 or arr.shape[1] != 2 or arr.shape[0] < 2:
+                raise ValueError('disturbance %r must be of shape (n_t,2), '
+                                 'with n_t >= 2, got %s' % (k, arr.shape))
+            t, v = np.ascontiguousarray(arr[:,0]), np.ascontiguousarray(arr[:,1])
+            dt = np.diff(t)
+            if np.any(dt <= 0):
+                raise ValueError('time of disturbance %r must be strictly '
+                                 'increasing' % k)
+            self.t[k], self.v[k] = t, v
+            # Slopes of each interval (as computed by np.interp)
+            self.slope[k] = (v[1:] - v[:-1])/dt
+            self.uniform[k] = bool(np.allclose(dt, dt.mean(), rtol=1E-9,
+                                               atol=0))
+            self._lists[k] = (t.tolist(), v.tolist(), self.slope[k].tolist(),
+                              (t.size-1)/(t[-1]-t[0]))
+        # Values at the stage times of a fixed-step integration
+        # (time of the first element, spacing, and table), and the
+        # interval and step of the table
+        self._table = None
+        self._table_key = None
+
+    def interp(self, k, t):
+        """ Linear interpolation of the series `k` at the time(s) `t`,
+        with the same results as np.interp
+
+        Parameters
+        ----------
+        k : str
+            Key of the series.
+        t : float or ndarray
+            Time instant(s).
+
+        Returns
+        -------
+        v : float or ndarray
+            Values at `t` (the first or last value outside of the series).
+        """
+        if np.ndim(t) == 0:
+            return self._interp_scalar(k, float(t))
+        tk, vk = self.t[k], self.v[k]
+        if not self.uniform[k]:
+            return np.interp(t, tk, vk)
+        n = tk.size
+        x = np.asarray(t, dtype=float)
+        # Index of the interval, from the (uniform) time step, corrected
+        # for the roundoff of the time array (so tk[j] <= x < tk[j+1])
+        j = np.floor((x - tk[0])*((n-1)/(tk[-1] - tk[0])))
+        j = np.clip(j, 0, n-2).astype(int)
+        j = j + (x >= tk[np.minimum(j+1, n-1)]) - (x < tk[j])
+        j = np.clip(j, 0, n-2)
+        v = self.slope[k][j]*(x - tk[j]) + vk[j]
+        # (outside of the series, and at its last time instant)
+        v = np.where(x <= tk[0], vk[0], np.where(x >= tk[-1], vk[-1], v))
+        return v[()]
+
+    def _interp_scalar(self, k, x):
+        # Linear interpolation at one time instant x, as 'interp'
+        tk, vk, sk, inv_step = self._lists[k]
+        if x <= tk[0]:
+            return vk[0]
+        if x >= tk[-1]:
+            return vk[-1]
+        if self.uniform[k]:
+            # (index from the time step, corrected for the roundoff)
+            j = min(int((x - tk[0])*inv_step), len(tk)-2)
+            if x >= tk[j+1]:
+                j += 1
+            elif x < tk[j]:
+                j -= 1
+        else:
+            j = bisect.bisect_right(tk, x) - 1
+        return sk[j]*(x - tk[j]) + vk[j]
+
+    def precompute(self, t_span, h):
+        """ Compute the values of all series at the stage times of the
+        Euler forward or Runge-Kutta integration with step `h`
+        (t, t+h/2 and t+h for each time instant t of the integration)
+
+        The table is kept for the next runs with the same `t_span` and
+        `h` (e.g. the iterations of a calibration), so it is only computed
+        once.
+
+        Parameters
+        ----------
+        t_span : 2-tuple of floats
+            Interval of integration (t0, tf).
+        h : float
+            Step size of the integration.
+        """
+        key = (float(t_span[0]), float(t_span[1]), float(h))
+        if key == self._table_key:
+            return
+        tint = time_grid(t_span, h)[0]
+        # Stage times, as computed by the integration functions:
+        # t and t+h/2 alternating, and t+h at the end of each step
+        # (which can differ from the next t by the roundoff of linspace)
+        tg = np.empty(2*tint.size-1)
+        tg[0::2], tg[1::2] = tint, tint[:-1] + h/2
+        te = tint[:-1] + h
+        table = (tint[0], h/2, tg, self.values(tg), te, self.values(te))
+        # (assigned at once, the table can be shared by clones of a model)
+        self._table, self._table_key = table, key
+
+    def values(self, t):
+        """ Values of all series at the time instants `t`
+
+        Returns
+        -------
+        v : ndarray, shape (n_keys,) + shape of `t`
+            Values at `t`, in the order of `keys`.
+        """
+        return np.array([self.interp(k, t) for k in self.keys])
+
+    def __call__(self, t):
+        """ Values of all series at the time instant `t`, from the table
+        of 'precompute' if `t` is one of its stage times
+
+        Parameters
+        ----------
+        t : float
+            Time instant.
+
+        Returns
+        -------
+        v : ndarray, shape (n_keys,)
+            Values at `t`, in the order of `keys`.
+        """
+        table = self._table
+        if table is not None:
+            t0, hg, tg, vg, te, ve = table
+            i = int(round((t - t0)/hg))
+            if 0 <= i < tg.size and tg[i] == t:
+                return vg[:,i]
+            if i % 2 == 0 and 0 < i//2 <= te.size and te[i//2-1] == t:
+                return ve[:,i//2-1]
+        return self.values(t)
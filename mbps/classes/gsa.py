@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+"""
+FTE34806 - Modelling of Biobased Production Systems
+MSc Biosystems Engineering, WUR
+
+Global sensitivity analysis of a model module
+
+Unlike Module.ns (local, one parameter at a time around a reference),
+the parameters are sampled over given ranges, all at once:
+
+* `Sobol`: first-order and total Sobol indices, from Saltelli sampling
+  (quasi-random Sobol sequence).
+* `Morris`: elementary effects (mu, mu*, sigma), for screening.
+
+The samples are simulated as ensembles of `batch_size` members (one
+vectorized integration per batch), serially or distributed over an
+executor. The indices are accumulated as running sums, so more samples
+can be added with further calls of 'run'. The confidence intervals are
+computed with the Poisson bootstrap: each sample has a random weight
+(Poisson, mean 1) in each bootstrap replicate, accumulated with the same
+running sums, without storing the outputs of all samples.
+"""
+import numpy as np
+import pandas as pd
+from scipy.stats import qmc
+
+from mbps.classes.module import map_runs
+
+class GlobalSA():
+    """ Base class for the global sensitivity analysis of a Module
+
+    Parameters
+    ----------
+    module : Module
+        Instance of the model (with the time array of the runs).
+    x0 : dictionary
+        Initial conditions.
+    p_ref : dictionary
+        Parameters (the values of the parameters not in `bounds`).
+    bounds : dictionary of 2-tuples
+        Ranges (low, high) of the sampled parameters.
+    d, u : dictionaries, optional
+        Disturbances and controlled inputs of the runs.
+    y_keys : sequence of str, optional
+        Outputs of the analysis (by default, the states).
+    aggregate : callable, optional
+        Function ``aggregate(y)`` of an output of shape (n_samples, n_t),
+        that returns an array of shape (n_samples,) or (n_samples, n_agg),
+        e.g. the final value ``lambda y: y[:,-1]``. By default, the
+        indices are time-resolved.
+    n_boot : int
+        Number of bootstrap replicates for the confidence intervals.
+    seed : int, optional
+        Seed of the random numbers (samples and bootstrap weights).
+
+    Attributes
+    ----------
+    n_runs : int
+        Number of model runs so far.
+    """
+    def __init__(self,module,x0,p_ref,bounds,d=None,u=None,y_keys=None,
+                 aggregate=None,n_boot=100,seed=None):
+        self.module = module.clone(logs=False)
+        self.x0, self.p_ref = dict(x0), dict(p_ref)
+        self.p_keys = list(bounds.keys())
+        self.bounds = np.array([bounds[k] for k in self.p_keys],dtype=float)
+        self.d, self.u = d, u
+        self.y_keys = list(module.x_keys) if y_keys is None else list(y_keys)
+        self.aggregate = aggregate
+        self.n_boot = n_boot
+        self.rng = np.random.default_rng(seed)
+        self.n_runs = 0
+        # Running sums, per output (initialized by the first 'run')
+        self.sums = {}
+
+    def scale(self,s):
+        """ Parameter values from samples of the unit hypercube
+
+        Parameters
+        ----------
+        s : ndarray, shape (n, n_params)
+            Samples in [0, 1], in the order of `bounds`.
+
+        Returns
+        -------
+        p : ndarray, shape (n, n_params)
+            Parameter values.
+        """
+        low, high = self.bounds[:,0], self.bounds[:,1]
+        return low + s*(high-low)
+
+    def evaluate(self,P,batch_size=256,n_jobs=1,executor=None):
+        """ Outputs for a matrix of parameter sets
+
+        Parameters
+        ----------
+        P : ndarray, shape (n, n_params)
+            Parameter values, in the order of `bounds`.
+        batch_size : int
+            Number of members of each ensemble run.
+        n_jobs, executor
+            Processes, or pool of threads or processes, for the batches
+            (see mbps.classes.module.map_runs). By default, the batches
+            are run serially.
+
+        Returns
+        -------
+        y : dictionary
+            Outputs `y_keys`, of shape (n, n_t) (or (n, n_agg) with
+            `aggregate`).
+        """
+        tspan = (self.module.t[0],self.module.t[-1])
+        # (each batch is one ensemble run, with arrays of parameters)
+        batches = []
+        for i in range(0,P.shape[0],batch_size):
+            p_batch = dict(self.p_ref)
+            for j,k in enumerate(self.p_keys):
+                p_batch[k] = P[i:i+batch_size,j]
+            batches.append(p_batch)
+        results = map_runs(self.module,self.x0,tspan,self.d,self.u,
+                           self.y_keys,batches,n_jobs,executor)
+        self.n_runs += P.shape[0]
+        # (outputs of shape (n_members, n_t), also if constant over the
+        # members)
+        n_t = self.module.t.size
+        sizes = [np.size(b[self.p_keys[0]]) for b in batches]
+        y = {}
+        for yk in self.y_keys:
+            y_k = np.concatenate([np.broadcast_to(r[yk],(n,n_t))
+                                  for r,n in zip(results,sizes)])
+            if self.aggregate is not None:
+                y_k = np.asarray(self.aggregate(y_k))
+            y[yk] = y_k.reshape(P.shape[0],-1)
+        return y
+
+    def weights(self,n):
+        """ Weights of `n` new samples: 1 for the estimate (row 0), and
+        Poisson(1) for each bootstrap replicate (rows 1 to n_boot)
+        """
+        w = self.rng.poisson(1.,(self.n_boot+1,n)).astype(float)
+        w[0] = 1.
+        return w
+
+    def index(self,m):
+        """ Index of the results, time (or position of the aggregated
+        output) """
+        if self.aggregate is None:
+            return self.module.t
+        return np.arange(m)
+
+    def table(self,values,names,conf):
+        """ DataFrame of indices, with the estimates (row 0 of `values`)
+        and the percentile confidence intervals of the bootstrap
+        replicates (rows 1 to n_boot)
+
+        Parameters
+        ----------
+        values : dictionary
+            By output, dictionary by name of the index of arrays of shape
+            (n_boot+1, n_params, m).
+        names : sequence of str
+            Names of the indices.
+        conf : float
+            Confidence level of the intervals.
+
+        Returns
+        -------
+        df : DataFrame
+            Indices, with MultiIndex columns (y, p, index), with the
+            estimate `name` and the bounds `name`_lo and `name`_hi.
+        """
+        q = [50*(1-conf),50*(1+conf)]
+        cols, data = [], []
+        for yk in self.y_keys:
+            for j,kp in enumerate(self.p_keys):
+                for name in names:
+                    v = values[yk][name][:,j]
+                    lo, hi = np.nanpercentile(v[1:],q,axis=0)
+                    cols += [(yk,kp,name),(yk,kp,name+'_lo'),
+                             (yk,kp,name+'_hi')]
+                    data += [v[0],lo,hi]
+        midx = pd.MultiIndex.from_tuples(cols,names=['y','p','index'])
+        return pd.DataFrame(np.array(data).T,index=self.index(data[0].size),
+                            columns=midx)
+
+class Sobol(GlobalSA):
+    """ First-order and total Sobol indices, from Saltelli sampling
+
+    Each base sample is a point of a scrambled Sobol sequence of dimension
+    2*n_params, split into the matrices A and B. The model is run for A,
+    B, and the matrices AB_i (A with the column i of B), so
+    n*(n_params+2) runs for n base samples. The estimators are those of
+    Saltelli et al. (2010): S1_i = E[f_B (f_ABi - f_A)]/V, and
+    ST_i = E[(f_A - f_ABi)^2]/(2V) (Jansen).
+
+    See GlobalSA for the parameters.
+
+    Examples
+    --------
+    >>> sa = Sobol(grass, x0, p, {'a':(30,60), 'k':(0.3,0.7)}, d=d, u=u)
+    >>> sa.run(1024, batch_size=512)
+    >>> df = sa.indices()
+    >>> df['Wg','a','ST']
+    """
+    def __init__(self,module,x0,p_ref,bounds,**kwargs):
+        GlobalSA.__init__(self,module,x0,p_ref,bounds,**kwargs)
+        self.sampler = qmc.Sobol(2*len(self.p_keys),scramble=True,
+                                 seed=self.rng)
+
+    def sample(self,n):
+        """ Parameter matrices of the next `n` base samples
+
+        Returns
+        -------
+        P : ndarray, shape (n*(n_params+2), n_params)
+            Parameter values, in blocks of n rows: A, B, AB_1 ... AB_n.
+        """
+        n_p = len(self.p_keys)
+        s = self.sampler.random(n)
+        A, B = s[:,:n_p], s[:,n_p:]
+        blocks = [A,B]
+        for i in range(n_p):
+            AB = A.copy()
+            AB[:,i] = B[:,i]
+            blocks.append(AB)
+        return self.scale(np.concatenate(blocks))
+
+    def run(self,n,batch_size=256,n_jobs=1,executor=None):
+        """ Run `n` more base samples, and add them to the running sums
+        (a power of 2 keeps the balance of the Sobol sequence)
+
+        See GlobalSA.evaluate for `batch_size`, `n_jobs` and `executor`.
+        """
+        n_p = len(self.p_keys)
+        y = self.evaluate(self.sample(n),batch_size,n_jobs,executor)
+        w = self.weights(n)
+        for yk in self.y_keys:
+            f = y[yk].reshape(n_p+2,n,-1)
+            f_A, f_B, f_AB = f[0], f[1], f[2:]
+            m = f_A.shape[1]
+            s = self.sums.setdefault(yk,{
+                'w':np.zeros(self.n_boot+1),
+                'f':np.zeros((self.n_boot+1,m)),
+                'f2':np.zeros((self.n_boot+1,m)),
+                'S1':np.zeros((self.n_boot+1,n_p,m)),
+                'ST':np.zeros((self.n_boot+1,n_p,m)),
+                })
+            s['w'] += w.sum(axis=1)
+            # (variance of the outputs from both A and B)
+            s['f'] += w @ (f_A+f_B)
+            s['f2'] += w @ (f_A**2+f_B**2)
+            for i in range(n_p):
+                s['S1'][:,i] += w @ (f_B*(f_AB[i]-f_A))
+                s['ST'][:,i] += w @ (f_A-f_AB[i])**2
+
+    def indices(self,conf=0.95):
+        """ Sobol indices of the samples so far
+
+        Parameters
+        ----------
+        conf : float
+            Confidence level of the bootstrap intervals.
+
+        Returns
+        -------
+        df : DataFrame
+            Indices 'S1' and 'ST' (and their intervals '_lo', '_hi'),
+            with MultiIndex columns (y, p, index), and the time as index
+            (or the position of the aggregated output).
+        """
+        values = {}
+        with np.errstate(divide='ignore',invalid='ignore'):
+            for yk,s in self.sums.items():
+                n_w = s['w'][:,None]
+                mean = s['f']/(2*n_w)
+                var = (s['f2']/(2*n_w) - mean**2)[:,None,:]
+                values[yk] = {'S1':s['S1']/n_w[:,None]/var,
+                              'ST':s['ST']/(2*n_w[:,None])/var}
+        return self.table(values,('S1','ST'),conf)
+
+class Morris(GlobalSA):
+    """ Elementary effects of Morris, for the screening of parameters
+
+    Each trajectory starts at a random point of a grid of `levels` levels
+    in the unit hypercube, and changes one parameter at a time (in random
+    order) by delta = levels/(2*(levels-1)), so r*(n_params+1) runs for r
+    trajectories. The elementary effects are in output units per range of
+    the parameter. The results are the mean 'mu', the mean of absolute
+    values 'mu_star' (Campolongo et al., 2007), and the standard deviation
+    'sigma' of the elementary effects.
+
+    Parameters
+    ----------
+    levels : int
+        Number of levels of the grid (even).
+
+    See GlobalSA for the other parameters.
+    """
+    def __init__(self,module,x0,p_ref,bounds,levels=4,**kwargs):
+        GlobalSA.__init__(self,module,x0,p_ref,bounds,**kwargs)
+        self.levels = levels
+        self.delta = levels/(2*(levels-1))
+
+    def sample(self,r):
+        """ Parameter matrices of `r` new trajectories
+
+        Returns
+        -------
+        P : ndarray, shape (r*(n_params+1), n_params)
+            Parameter values, n_params+1 consecutive rows per trajectory.
+        order : ndarray, shape (r, n_params)
+            Parameter changed at each step of each trajectory.
+        sign : ndarray, shape (r, n_params)
+            Direction (-1 or +1) of the change of each parameter.
+        """
+        n_p, dl = len(self.p_keys), self.delta
+        # Start (low end) on the grid, with both ends within [0, 1]
+        grid = np.arange(self.levels)/(self.levels-1)
+        low = self.rng.choice(grid[grid <= 1-dl+1E-12],(r,n_p))
+        sign = self.rng.choice([-1.,1.],(r,n_p))
+        order = np.argsort(self.rng.random((r,n_p)),axis=1)
+        s = np.empty((r,n_p+1,n_p))
+        s[:,0] = np.where(sign > 0,low,low+dl)
+        for k in range(n_p):
+            s[:,k+1] = s[:,k]
+            i = order[:,k]
+            s[np.arange(r),k+1,i] += sign[np.arange(r),i]*dl
+        return self.scale(s.reshape(-1,n_p)), order, sign
+
+    def run(self,r,batch_size=256,n_jobs=1,executor=None):
+        """ Run `r` more trajectories, and add them to the running sums
+
+        See GlobalSA.evaluate for `batch_size`, `n_jobs` and `executor`.
+        """
+        n_p = len(self.p_keys)
+        P, order, sign = self.sample(r)
+        y = self.evaluate(P,batch_size,n_jobs,executor)
+        w = self.weights(r)
+        rows = np.arange(r)[:,None]
+        for yk in self.y_keys:
+            f = y[yk].reshape(r,n_p+1,-1)
+            m = f.shape[2]
+            # Elementary effects, per parameter (from the step of `order`)
+            ee = np.empty((r,n_p,m))
+            ee[rows,order] = (f[:,1:]-f[:,:-1])/(sign[rows,order]
+                                                 *self.delta)[...,None]
+            s = self.sums.setdefault(yk,{
+                'w':np.zeros(self.n_boot+1),
+                'ee':np.zeros((self.n_boot+1,n_p,m)),
+                'ee_abs':np.zeros((self.n_boot+1,n_p,m)),
+                'ee2':np.zeros((self.n_boot+1,n_p,m)),
+                })
+            s['w'] += w.sum(axis=1)
+            s['ee'] += np.einsum('br,rpm->bpm',w,ee)
+            s['ee_abs'] += np.einsum('br,rpm->bpm',w,np.abs(ee))
+            s['ee2'] += np.einsum('br,rpm->bpm',w,ee**2)
+
+    def indices(self,conf=0.95):
+        """ Statistics of the elementary effects of the trajectories
+        so far
+
+        Parameters
+        ----------
+        conf : float
+            Confidence level of the bootstrap intervals.
+
+        Returns
+        -------
+        df : DataFrame
+            Statistics 'mu', 'mu_star' and 'sigma' (and their intervals
+            '_lo', '_hi'), with MultiIndex columns (y, p, index), and the
+            time as index (or the position of the aggregated output).
+        """
+        values = {}
+        with np.errstate(divide='ignore',invalid='ignore'):
+            for yk,s in self.sums.items():
+                n_w = s['w'][:,None,None]
+                mu = s['ee']/n_w
+                # (sample standard deviation)
+                var = (s['ee2']-n_w*mu**2)/(n_w-1)
+                values[yk] = {'mu':mu,'mu_star':s['ee_abs']/n_w,
+                              'sigma':np.sqrt(np.maximum(var,0.))}
+        return self.table(values,('mu','mu_star','sigma'),conf)
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+FTE34806 - Modelling of Biobased Production Systems
+MSc Biosystems Engineering, WUR
+
+Bayesian calibration of the parameters of a model module, with the
+affine-invariant ensemble sampler of Goodman & Weare (2010)
+
+The walkers are split in two halves, each updated with the stretch move
+from the positions of the other half. All walkers of a half are
+simulated together, as one ensemble run of the module per half-step.
+"""
+import json
+import time
+import numpy as np
+import pandas as pd
+
+from mbps.classes.calibration import read_datasets
+
+class EnsembleSampler():
+    """ Affine-invariant ensemble MCMC of parameters of a Module
+
+    The log-posterior is the sum of the log-priors of the parameters and
+    of the Gaussian log-likelihood of the observed series (or of a
+    user-defined log-likelihood).
+
+    Parameters
+    ----------
+    module : Module
+        Instance of the model (with the time array of the runs).
+    x0 : dictionary
+        Initial conditions.
+    p : dictionary
+        Parameters (the values of the parameters without prior).
+    data : list of dictionaries
+        Datasets, each with the keys 'y' (output, a state or derived
+        output), 't' (times, stored time instants of the module), 'data'
+        (observed values), and 'sigma' (standard deviation of the errors,
+        scalar or array).
+    priors : dictionary
+        Prior of each sampled parameter: a distribution with the method
+        'logpdf' (e.g. from scipy.stats), or a function of an array of
+        values that returns the log-densities.
+    d, u : dictionaries, optional
+        Disturbances and controlled inputs of the runs.
+    n_walkers : int
+        Number of walkers (even, at least twice the number of parameters).
+    a : float
+        Scale of the stretch move.
+    log_likelihood : callable, optional
+        Function ``log_likelihood(y)`` of the outputs of a batch of
+        walkers (dictionary of arrays of shape (n, n_t)), that returns an
+        array of shape (n,). By default, the Gaussian log-likelihood of
+        `data`.
+    seed : int, optional
+        Seed of the random numbers.
+
+    Attributes
+    ----------
+    chain : ndarray, shape (n_steps, n_walkers, n_params)
+        Positions of the walkers at each step.
+    log_prob : ndarray, shape (n_steps, n_walkers)
+        Log-posterior of the positions.
+    n_evals : int
+        Number of evaluations of the log-posterior (walkers simulated).
+
+    Examples
+    --------
+    >>> from scipy import stats
+    >>> priors = {'alpha':stats.uniform(1E-9,1E-7),
+    ...           'beta':stats.norm(0.025,0.005)}
+    >>> data = [{'y':'Wg', 't':t_data, 'data':m_data, 'sigma':0.01}]
+    >>> sampler = EnsembleSampler(grass, x0, p, data, priors, d=d, u=u)
+    >>> sampler.initialize(p)
+    >>> sampler.run(2000, checkpoint='chains.npz')
+    >>> sampler.samples(burn=500).describe()
+    """
+    def __init__(self,module,x0,p,data,priors,d=None,u=None,n_walkers=32,
+                 a=2.0,log_likelihood=None,seed=None):
+        if n_walkers % 2 or n_walkers < 2*len(priors):
+            raise ValueError('n_walkers must be even, and at least twice '
+                             'the number of parameters, got %d'
+                             % n_walkers)
+        self.module = module.clone(logs=False)
+        self.x0, self.p = dict(x0), dict(p)
+        self.priors = dict(priors)
+        self.p_keys = list(priors.keys())
+        self.d, self.u = d, u
+        self.n_walkers, self.a = n_walkers, a
+        self.log_likelihood = log_likelihood
+        # Datasets: output, indices of the data in the module time array,
+        # observed values, and standard deviations
+        self.data, self.y_keys = read_datasets(self.module.t,data,'sigma')
+        self.rng = np.random.default_rng(seed)
+        # State of the walkers, and chains
+        self.walkers, self.lp = None, None
+        self.chain = np.empty((0,n_walkers,len(self.p_keys)))
+        self.log_prob = np.empty((0,n_walkers))
+        self.n_accepted = np.zeros(n_walkers)
+        self.n_evals, self.elapsed = 0, 0.
+
+    def log_prior(self,P):
+        """ Log-prior of the parameter sets `P`, shape (n, n_params) """
+        lp = np.zeros(P.shape[0])
+        for j,k in enumerate(self.p_keys):
+            prior = self.priors[k]
+            logpdf = getattr(prior,'logpdf',prior)
+            lp += np.asarray(logpdf(P[:,j]),dtype=float)
+        return lp
+
+    def log_posterior(self,P):
+        """ Log-posterior of the parameter sets `P`, shape (n, n_params),
+        from one ensemble run of the parameter sets with finite prior
+        """
+        lp = self.log_prior(P)
+        ok = np.isfinite(lp)
+        if not np.any(ok):
+            return lp
+        # Ensemble run of the parameter sets with finite prior
+        p_batch = dict(self.p)
+        for j,k in enumerate(self.p_keys):
+            p_batch[k] = P[ok,j]
+        self.module.x0, self.module.p = dict(self.x0), p_batch
+        tspan = (self.module.t[0],self.module.t[-1])
+        y = self.module.run(tspan,self.d,self.u,outputs=())
+        n = int(np.sum(ok))
+        y = {yk:np.broadcast_to(y[yk],(n,self.module.t.size))
+             for yk in self.y_keys}
+        self.n_evals += n
+        if self.log_likelihood is not None:
+            ll = np.asarray(self.log_likelihood(y),dtype=float)
+        else:
+            # Gaussian log-likelihood (without the constant term)
+            ll = np.zeros(n)
+            for yk,idx,obs,sigma in self.data:
+                e = (y[yk][:,idx]-obs)/sigma
+                ll -= 0.5*np.sum(e**2,axis=1) + np.sum(np.log(sigma))
+        # (failed runs, with nan outputs, are rejected)
+        lp[ok] += np.where(np.isnan(ll),-np.inf,ll)
+        return lp
+
+    def initialize(self,p0=None,scatter=1E-3):
+        """ Initial positions of the walkers: in a small ball around `p0`
+        (relative `scatter`), or drawn from the priors (with a method
+        'rvs', as the distributions of scipy.stats)
+
+        Parameters
+        ----------
+        p0 : dictionary, optional
+            Center of the initial positions.
+        scatter : float
+            Relative standard deviation of the initial positions.
+        """
+        n_p = len(self.p_keys)
+        if p0 is not None:
+            c = np.array([p0[k] for k in self.p_keys],dtype=float)
+            scale = np.where(c!=0,np.abs(c),1.)
+            P = c + scatter*scale*self.rng.standard_normal((self.n_walkers,
+                                                            n_p))
+        else:
+            P = np.column_stack([self.priors[k].rvs(size=self.n_walkers,
+                                                    random_state=self.rng)
+                                 for k in self.p_keys])
+        self.walkers = P
+        self.lp = self.log_posterior(P)
+        if not np.all(np.isfinite(self.lp)):
+            raise ValueError('initial positions of the walkers must have '
+                             'a finite posterior')
+
+    def step(self):
+        """ One step of all walkers (two half-steps of stretch moves) """
+        n_half, n_p = self.n_walkers//2, len(self.p_keys)
+        for s in (slice(0,n_half),slice(n_half,None)):
+            other = slice(n_half,None) if s.start == 0 else slice(0,n_half)
+            X, lp = self.walkers[s], self.lp[s]
+            # Stretch move: Y = X_j + z*(X - X_j), with z ~ 1/sqrt(z)
+            # on [1/a, a], and X_j a random walker of the other half
+            z = ((self.a-1)*self.rng.random(n_half) + 1)**2/self.a
+            X_j = self.walkers[other][self.rng.integers(0,n_half,n_half)]
+            Y = X_j + z[:,None]*(X-X_j)
+            lp_y = self.log_posterior(Y)
+            log_r = (n_p-1)*np.log(z) + lp_y - lp
+            accept = np.log(self.rng.random(n_half)) < log_r
+            X[accept], lp[accept] = Y[accept], lp_y[accept]
+            self.n_accepted[s] += accept
+
+    def run(self,n_steps,checkpoint=None,every=100):
+        """ Advance the chains by `n_steps` steps
+
+        Parameters
+        ----------
+        n_steps : int
+            Number of steps.
+        checkpoint : str, optional
+            File to save the state of the sampler (see 'save'), every
+            `every` steps and at the end.
+        every : int
+            Steps between checkpoints.
+        """
+        if self.walkers is None:
+            raise ValueError('the walkers are not initialized, '
+                             'see method initialize')
+        n0 = self.chain.shape[0]
+        self.chain = np.concatenate((self.chain,np.empty((n_steps,)+
+                                                self.walkers.shape)))
+        self.log_prob = np.concatenate((self.log_prob,
+                                        np.empty((n_steps,self.n_walkers))))
+        t0 = time.perf_counter()
+        for i in range(n0,n0+n_steps):
+            self.step()
+            self.chain[i], self.log_prob[i] = self.walkers, self.lp
+            if checkpoint is not None and (i+1-n0) % every == 0:
+                self.elapsed += time.perf_counter()-t0
+                t0 = time.perf_counter()
+                self.save(checkpoint,n_steps=i+1)
+        self.elapsed += time.perf_counter()-t0
+        if checkpoint is not None:
+            self.save(checkpoint)
+
+    def acceptance_fraction(self):
+        """ Fraction of accepted moves of each walker """
+        return self.n_accepted/max(self.chain.shape[0],1)
+
+    def throughput(self):
+        """ Evaluations of the log-posterior per second, in 'run' """
+        return self.n_evals/self.elapsed if self.elapsed else 0.
+
+    def samples(self,burn=0,thin=1):
+        """ Samples of all walkers after `burn` steps, every `thin` steps
+
+        Returns
+        -------
+        df : DataFrame
+            Samples, with the parameters as columns, and the log-posterior
+            'log_prob'.
+        """
+        P = self.chain[burn::thin].reshape(-1,len(self.p_keys))
+        df = pd.DataFrame(P,columns=self.p_keys)
+        df['log_prob'] = self.log_prob[burn::thin].ravel()
+        return df
+
+    def save(self,file,n_steps=None):
+        """ Save the chains and the state of the sampler (walkers, random
+        generator and counters) to a .npz file, to continue with
+        'restore' and 'run'
+
+        Parameters
+        ----------
+        file : str
+            Name of the file.
+        n_steps : int, optional
+            Number of steps of the chains to save (by default, all).
+        """
+        n = self.chain.shape[0] if n_steps is None else n_steps
+        np.savez(file,chain=self.chain[:n],log_prob=self.log_prob[:n],
+                 walkers=self.walkers,lp=self.lp,
+                 n_accepted=self.n_accepted,
+                 counters=np.array([self.n_evals,self.elapsed]),
+                 p_keys=np.array(self.p_keys),
+                 rng=np.array(json.dumps(self.rng.bit_generator.state)))
+
+    def restore(self,file):
+        """ Continue from the state saved by 'save' (for a sampler with
+        the same parameters, priors and data)
+        """
+        with np.load(file) as f:
+            if f['p_keys'].tolist() != self.p_keys:
+                raise ValueError('parameters of the checkpoint %s differ '
+                                 'from the sampler %s'
+                                 % (f['p_keys'].tolist(), self.p_keys))
+            self.chain, self.log_prob = f['chain'], f['log_prob']
+            self.walkers, self.lp = f['walkers'], f['lp']
+            self.n_accepted = f['n_accepted']
+            self.n_evals, self.elapsed = int(f['counters'][0]), \
+                float(f['counters'][1])
+            self.rng.bit_generator.state = json.loads(str(f['rng']))
@@ -8,27 +8,238 @@ MSc Biosystems Engineering, WUR
 Basic class for a model module
 """
     
+import os
 import copy
+import warnings
 import numpy as np
-import pandas as pd
+from collections.abc import KeysView, ItemsView, ValuesView
+from concurrent.futures import ProcessPoolExecutor
+
+from mbps.functions.integration import (fcn_stream, fcn_integrate,
+                                        INTEGRATORS, INPLACE_METHODS,
+                                        STREAM_METHODS)
+from mbps.functions.jit import HAS_NUMBA, fcn_jit
+from mbps.functions.adjoint import fcn_adjoint
+from mbps.classes.sinks import consume
+from mbps.classes.ns_result import NSResult
+
+class Outputs(dict):
+    """ Dictionary of model outputs (or logs) of a Module instance, with
+    the derived outputs of the module computed on access
+    
+    A key of `Module.derived` that is not stored in the dictionary is
+    computed from the stored outputs (e.g. the states) and the parameters
+    `p` of the run when it is read, and not kept in memory. The derived
+    outputs are keys of the dictionary as the stored ones (for `in`,
+    'get', 'keys', 'items', iteration, etc.). The logs, with results of
+    runs with different parameters, have no parameters `p`: their derived
+    outputs are stored by 'Module.store'.
+    
+    Parameters
+    ----------
+    module : Module
+        Instance of the model.
+    *args
+        Outputs, as for dict.
+    p : dictionary, optional
+        Parameters of the run (a copy of them, so the derived outputs do
+        not change with the parameters of later runs).
+    """
+    def __init__(self,module,*args,p=None):
+        dict.__init__(self,*args)
+        self.module = module
+        self.p = p
+
+    def __missing__(self,key):
+        if key in self.module.derived and self.p is not None:
+            return self.module.derived[key](self.module,self)
+        raise KeyError(key)
+
+    def derived_keys(self):
+        """ Keys of the derived outputs computed on access """
+        if self.p is None:
+            return []
+        return [k for k in self.module.derived
+                if not dict.__contains__(self,k)]
+
+    def __contains__(self,key):
+        return dict.__contains__(self,key) or key in self.derived_keys()
+
+    def __iter__(self):
+        yield from dict.__iter__(self)
+        yield from self.derived_keys()
+
+    def __len__(self):
+        return dict.__len__(self) + len(self.derived_keys())
+
+    def get(self,key,default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        return KeysView(self)
+
+    def items(self):
+        return ItemsView(self)
+
+    def values(self):
+        return ValuesView(self)
+
+def _ns_runs(module,x0,tspan,d,u,y_keys,runs):
+    """ Runs of Module.ns with perturbed parameters
+    
+    Called once per chunk of runs (in the worker of an executor, or in
+    the main process), so the module and the inputs are passed (and
+    pickled, for a process pool) once per chunk instead of once per run.
+    
+    Returns
+    -------
+    y : list of dictionaries
+        Outputs `y_keys` of each run, in the order of `runs`.
+    """
+    results = []
+    for p in runs:
+        module.x0 = dict(x0)
+        module.p = p
+        # (without logs, only the outputs of the run are used)
+        y = module.run(tspan,d,u,outputs=())
+        results.append({yk:np.asarray(y[yk]) for yk in y_keys})
+    return results
+
+def map_runs(module,x0,tspan,d,u,y_keys,runs,n_jobs=1,executor=None):
+    """ Runs of a module with several parameter sets, serially or in
+    chunks distributed over an executor (one chunk per worker)
+    
+    Parameters
+    ----------
+    module : Module
+        Instance for the runs (without logs, see Module.ns).
+    x0 : dictionary
+        Initial conditions of each run.
+    tspan : 2-element array-like
+        Initial and final time of the runs.
+    d, u : dictionary
+        Disturbances and controlled inputs.
+    y_keys : sequence of str
+        Outputs of the runs.
+    runs : list of dictionaries
+        Parameters of each run.
+    n_jobs : int
+        Number of processes (-1 for all CPUs), and of chunks of runs.
+        With 1 (default) and without `executor`, the runs are executed
+        serially.
+    executor : concurrent.futures.Executor, optional
+        Pool of threads or processes, kept by the caller for many calls
+        (e.g. the iterations of a calibration), instead of a new process
+        pool of `n_jobs` for each call. The runs are split in `n_jobs`
+        chunks (by default, one per CPU).
+    
+    Returns
+    -------
+    y : list of dictionaries
+        Outputs `y_keys` of each run, in the order of `runs`.
+    """
+    if n_jobs == -1:
+        n_jobs = os.cpu_count() or 1
+    if executor is None and n_jobs <= 1:
+        return _ns_runs(module,x0,tspan,d,u,y_keys,runs)
+    n_chunks = min(len(runs),n_jobs if n_jobs > 1 else os.cpu_count() or 1)
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(n_jobs)
+    try:
+        futures = [executor.submit(_ns_runs,module.clone(logs=False),x0,
+                                   tspan,d,u,y_keys,runs[i::n_chunks])
+                   for i in range(n_chunks)]
+        results = [None]*len(runs)
+        for i,future in enumerate(futures):
+            results[i::n_chunks] = future.result()
+    finally:
+        if own_executor:
+            executor.shutdown()
+    return results
 
 class Module():
-    def __init__(self,tsim,dt,x0,p):
+    # Keys of the state variables, in the order used by the method 'diff'
+    # (defined by each model)
+    x_keys = ()
+    # Keys of the parameters, in the order of the parameter vector `pv`
+    # read by the method 'diff' (defined by each model)
+    p_keys = ()
+    # Keys of the flows (or other diagnostics) logged by the method 'diff'
+    # with 'log_flows', in the order of its values (defined by each model)
+    f_keys = ()
+    # Derived outputs, as functions ``fcn(module, y)`` of the outputs `y`
+    # (e.g. the states) and of the parameters of the run `y.p`, computed on
+    # access (see Outputs)
+    derived = {}
+    # Default integration method, a name in INTEGRATORS
+    # (can be changed per instance with the argument `method`)
+    method = 'euler'
+    # Compiled right-hand side ``rhs_jit(t, y, dy, args)`` for the argument
+    # `jit`, with the arguments of the method 'jit_args' (defined by each
+    # model, see mbps.functions.jit)
+    rhs_jit = None
+
+    def __init__(self,tsim,dt,x0,p,jit=False,dt_save=None,method=None,
+                 options=None,record=True,cache=None):
         # Simulation time array
         self.tsim = tsim
-        # Module time-step
+        # Module time-step (integration)
         self.dt = dt
-        # Module time array
-        len_t = int((tsim[-1]-tsim[0])/dt) + 1
+        # Time-step of the stored results, a multiple of the integration
+        # time-step (by default, the same)
+        if dt_save is None:
+            dt_save = dt
+        self.nsave = int(round(dt_save/dt))
+        if self.nsave < 1 or not np.isclose(self.nsave*dt, dt_save):
+            raise ValueError('dt_save must be a multiple of dt, got '
+                             'dt_save=%g and dt=%g' % (dt_save, dt))
+        self.dt_save = self.nsave*dt
+        # Module time array (of the stored results)
+        len_t = int((tsim[-1]-tsim[0])/self.dt_save) + 1
         self.t = np.linspace(tsim[0],tsim[-1],len_t)
-        # Initial conditions
+        # (read-only, so that clones can share it)
+        self.t.flags.writeable = False
+        # Initial conditions, and their time (end of the last run)
         self.x0 = copy.deepcopy(x0)
-        # Parameters
+        self.t_x0 = self.t[0]
+        # Parameters, and position of each key in the parameter vector
+        # (compiled from `p` by the methods 'run' and 'stream')
         self.p = copy.deepcopy(p)
+        self.p_index = {k:i for i,k in enumerate(self.p_keys)}
+        self.compile_p()
+        # Disturbances and controlled inputs (assigned by method 'run')
+        self.d, self.u = None, None
         # Logs of simulation results
-        self.y = {}
+        # (shared with a clone until one of them runs, see method 'clone')
+        self.y = Outputs(self)
+        self._logs_shared = False
+        # Logs of flows, recorded at the stored states of a run
+        # (can be switched off with record=False, for the states only)
+        self.record = record
+        self.f = {}
+        # Index of the logs for the next flows (set by the integration)
+        self.f_idx = None
+        # Compiled integration of the model (only if Numba is installed,
+        # otherwise the NumPy integration functions are used)
+        if jit and not HAS_NUMBA:
+            warnings.warn('Numba is not installed, jit=True has no effect')
+        self.jit = jit and HAS_NUMBA
+        # Integration method, and its options (e.g. rtol, atol)
+        if method is not None:
+            if method not in INTEGRATORS:
+                raise ValueError('unknown integration method %r, '
+                                 'available: %s'
+                                 % (method, ', '.join(INTEGRATORS)))
+            self.method = method
+        self.options = dict(options or {})
+        # Event functions for the integration (assigned by method 'run')
+        self.events = None
+        # Cache of the results of identical runs (e.g. a ResultCache from
+        # mbps.classes.cache, shared by the clones of the instance)
+        self.cache = cache
     
-    def run(self,tspan,d=None,u=None):
+    def run(self,tspan,d=None,u=None,events=None,outputs=None):
         """ Run the attribute 'model' of Module instance
         
         Parameters
@@ -39,82 +250,993 @@ class Module():
             disturbances
         u : dictionary
             controlled inputs
+        events : callable, or list of callables, optional
+            event functions ``event(t, y)`` of the states, in the order of
+            `x_keys` (see mbps.functions.integration.fcn_events).
+            A terminal event ends the run, and its state becomes the new
+            initial condition. An event with attribute 'update' applies
+            a discrete change of state (e.g. a harvest cut).
+        outputs : sequence of str, optional
+            Keys of the outputs to store in the logs `y`, including
+            derived outputs. By default, all outputs (the derived ones
+            computed with the parameters of the run).
+        
+        Returns
+        -------
+        y : Outputs
+            Model outputs of the run, with the derived outputs computed
+            on access.
         """
-        # Assign disturbances and control input
-        self.d, self.u = d, u
+        # Assign disturbances, control input and events
+        self.d, self.u, self.events = d, u, events
+        # Own copy of the logs shared with a clone, before writing them
+        if self._logs_shared:
+            self.copy_logs()
+        # Parameter vector for the integration
+        self.compile_p()
+        # Logs of flows (initialized, or re-initialized for a new shape
+        # of the ensemble)
+        if self.record and self.f_keys:
+            shape = self.ensemble_shape() + (self.t.size,)
+            for k in self.f_keys:
+                if k not in self.f or self.f[k].shape != shape:
+                    self.f[k] = np.full(shape,np.nan)
         # Call model
-        y = self.output(tspan)
+        # (or reuse the outputs of an identical run, from the cache)
+        key = None
+        if self.cache is not None and events is None:
+            try:
+                key = self.cache.key(self,tspan)
+            except TypeError:
+                key = None
+        entry = None if key is None else self.cache.get(key)
+        # (with a copy of the parameters, for the derived outputs)
+        p = dict(self.p)
+        if entry is None:
+            # (the cache keeps the outputs of the model, without the
+            # derived ones)
+            y = self.output(tspan)
+            if key is not None:
+                self.cache.put(key,y,self.run_flows(y['t']))
+            y = Outputs(self,y,p=p)
+        else:
+            y = Outputs(self,entry[0],p=p)
+            self.run_flows(y['t'],entry[1])
+        return self.store(y,outputs)
+
+    def run_flows(self,t,f=None):
+        """ Flows recorded by a run with the time vector `t` (at all its
+        stored states but the last), or assign them from `f`
+        
+        Parameters
+        ----------
+        t : ndarray
+            Time vector of the results of the run.
+        f : dictionary, optional
+            Flows of the run, to write in the logs (e.g. from a cache).
+        
+        Returns
+        -------
+        f : dictionary
+            Flows of the run (empty if they are not recorded).
+        """
+        # (indices of the logs from the start of the run, as recorded
+        # by the method 'integrate')
+        idxs = self.log_slice(np.atleast_1d(t[0]))
+        if (not (self.record and self.f_keys) or idxs is None
+                or self.use_jit()):
+            return {}
+        i0 = idxs[0].start
+        i = slice(i0,min(i0+t.size-1,self.t.size))
+        if f is None:
+            return {k:self.f[k][...,i] for k in self.f_keys}
+        for k,v in f.items():
+            self.f[k][...,i] = v
+        return f
+
+    def store(self,y,outputs=None):
+        """ Store the outputs of a run in the logs, and update the
+        initial conditions with the final state (called by method 'run')
+        
+        Parameters
+        ----------
+        y : Outputs
+            Outputs of the run, with the time 't'.
+        outputs : sequence of str, optional
+            Keys of the outputs to store (see method 'run').
+        
+        Returns
+        -------
+        y : Outputs
+            The same outputs.
+        """
         # Update model output logs
-        # (if first simulation, initialize logs)
+        # (if first simulation, initialize logs with the selected outputs)
+        # (for an ensemble, the logs keep the member axis before time)
+        # (derived outputs stored with their values for the run)
         if len(self.y) == 0:
-            self.y_keys = [yk for yk in y.keys() if yk[0]!='t']
-            for k in self.y_keys:
-                self.y[k] = np.full((len(self.t),),np.nan)       
-        for k in self.y_keys:
-            idxs = np.isin(self.t,y['t'])
-            self.y[k][idxs] = y[k]
+            self.y_keys = [yk for yk in y.keys()
+                           if yk[0]!='t' and yk!='y_events']
+            self.y_keys += [yk for yk in self.derived
+                            if yk not in self.y_keys]
+        keys = self.y_keys if outputs is None else list(outputs)
+        values = {k:y[k] for k in keys}
+        # (logs initialized, or re-initialized for a new shape of the
+        # ensemble, as the flows in 'run')
+        for k in keys:
+            shape = np.shape(values[k])[:-1] + (len(self.t),)
+            if k not in self.y or self.y[k].shape != shape:
+                self.y[k] = np.full(shape,np.nan)
+        if outputs is not None:
+            self.y_keys = list(self.y.keys())
+        # (index range of the run in the logs, or, for results off the
+        # module time array, e.g. of a run from the time of a terminal
+        # event, the values interpolated at the module time array)
+        idxs = self.log_slice(y['t'])
+        if idxs is None:
+            i, j, w = self.log_interp(y['t'])
+            j1 = np.minimum(j+1,y['t'].size-1)
+        for k in keys:
+            # (outputs constant in time, e.g. scalar inputs, broadcast to
+            # the time vector of the run)
+            v = values[k]
+            if np.ndim(v) == 0:
+                v = np.broadcast_to(v,y['t'].shape)
+            if idxs is None:
+                self.y[k][...,i] = v[...,j]*(1-w) + v[...,j1]*w
+            else:
+                self.y[k][...,idxs[0]] = v[...,idxs[1]]
         # Update initial conditions
+        # (copy of the last values, a scalar for a single trajectory)
         for k in self.x0.keys():
-            self.x0[k] = y[k][-1]
+            self.x0[k] = np.copy(y[k][...,-1])[()]
+        self.t_x0 = y['t'][-1]
         return y
 
-    def ns(self,x0,p_ref,d=None,u=None,y_keys=None):
+    def log_slice(self,t):
+        """ Index range of a time vector in the module time array
+        
+        The index of the first element is computed from the time-step of
+        the logs, so a run writes its results without searching the
+        module time array (constant cost for any length of `t`).
+        
+        Parameters
+        ----------
+        t : ndarray
+            Time vector of the results of a run.
+        
+        Returns
+        -------
+        idx_log, idx_t : slice
+            Elements of the logs, and of the results, for the time
+            instants of `t` on the module time array. None if they are not
+            a contiguous range of the module time array.
+        """
+        n = t.size
+        if n == 0:
+            return None
+        # (tolerance for the roundoff of np.linspace)
+        tol = 1E-6*self.dt_save
+        i0 = int(round((t[0]-self.t[0])/self.dt_save))
+        # (a terminal event can end the results off the module time array)
+        i_last = min(i0+n-1, self.t.size-1)
+        if n > 1 and abs(t[-1]-self.t[i_last]) > tol:
+            n -= 1
+        i1 = i0 + n
+        if (i0 < 0 or i1 > self.t.size or abs(t[0]-self.t[i0]) > tol
+                or abs(t[n-1]-self.t[i1-1]) > tol):
+            return None
+        return slice(i0,i1), slice(0,n)
+
+    def log_interp(self,t):
+        """ Linear interpolation of results off the module time array
+        (with the time vector `t`), at the time instants of the module
+        time array within `t`
+        
+        Parameters
+        ----------
+        t : ndarray
+            Time vector of the results of a run (increasing).
+        
+        Returns
+        -------
+        idx_log : slice
+            Elements of the logs within `t` (empty if there are none).
+        j : ndarray of int
+            Index of the result before each of these time instants.
+        w : ndarray
+            Weight of the result after each of these time instants
+            (0 for the time instants in `t`).
+        """
+        # (tolerance for the roundoff of np.linspace)
+        tol = 1E-6*self.dt_save
+        i0 = max(int(np.ceil((t[0]-self.t[0]-tol)/self.dt_save)),0)
+        i1 = min(int(np.floor((t[-1]-self.t[0]+tol)/self.dt_save))+1,
+                 self.t.size)
+        t_log = self.t[i0:max(i1,i0)]
+        j = np.clip(np.searchsorted(t,t_log,side='right')-1,0,
+                    max(t.size-2,0))
+        dt = t[np.minimum(j+1,t.size-1)] - t[j]
+        with np.errstate(divide='ignore',invalid='ignore'):
+            w = np.where(dt>0,(t_log-t[j])/dt,0.)
+        return slice(i0,i0+t_log.size), j, np.clip(w,0.,1.)
+
+    def stream(self,tspan,sinks,d=None,u=None,method=None,chunk=1000):
+        """ Run the model in chunks of time, passing the states to sinks
+        
+        Unlike 'run', the results are not stored in the logs `y`, so the
+        memory use is bounded by the chunk size instead of the length of
+        `tspan`. The initial conditions are updated with the final state.
+        
+        Parameters
+        ----------
+        tspan : 2-element array-like
+            initial and final time for the model run
+        sinks : sequence
+            Result sinks (see mbps.classes.sinks) that receive the chunks
+            ``(t, y)``, with the states in the order of `x_keys`.
+        d : dictionary
+            disturbances
+        u : dictionary
+            controlled inputs
+        method : {'euler', 'rk4'}, optional
+            Integration method. By default, that of the instance, or 'rk4'
+            for an adaptive Runge-Kutta method of the instance (e.g.
+            'RK45' or 'dopri45', see STREAM_METHODS), with the step `dt`.
+        chunk : int
+            Number of stored time instants per chunk (the results are
+            stored every `dt_save`, as in the logs).
+        
+        Returns
+        -------
+        sinks : sequence
+            The same sinks, after all chunks have been passed.
+        """
+        # Assign disturbances and control input
+        self.d, self.u = d, u
+        # (fixed-step scheme for the method of the instance)
+        if method is None:
+            if self.method not in STREAM_METHODS:
+                raise ValueError("the method of the instance %r has no "
+                                 "fixed-step scheme for 'stream', use the "
+                                 "argument method='euler' or 'rk4'"
+                                 % self.method)
+            method = STREAM_METHODS[self.method]
+        self.compile_p()
+        y0 = self.get_y0(self.x_keys)
+        chunks = fcn_stream(self.diff,tspan,y0,h=self.dt,method=method,
+                            chunk=chunk,nsave=self.nsave)
+        t, y = consume(chunks,sinks)
+        # Update initial conditions
+        for i,k in enumerate(self.x_keys):
+            self.x0[k] = np.copy(y[i][...,-1])[()]
+        self.t_x0 = t[-1]
+        return sinks
+
+    def snapshot(self):
+        """ State of the Module instance, to restore it later
+        
+        Only the initial conditions (the state at the end of the last run),
+        their time, the parameters and the inputs are captured, not the
+        logs. Arrays of the parameters and inputs are not copied: they are
+        replaced, not modified, by the Module methods.
+        
+        Returns
+        -------
+        state : dictionary
+            'x0', 't_x0', 'p', 'd' and 'u', for the method 'restore'.
+        """
+        return {'x0':{k:np.copy(v)[()] for k,v in self.x0.items()},
+                't_x0':self.t_x0, 'p':dict(self.p),
+                'd':self.d, 'u':self.u}
+
+    def restore(self,state):
+        """ Restore a state captured with the method 'snapshot'
+        
+        Parameters
+        ----------
+        state : dictionary
+            State returned by 'snapshot' (it can be restored many times).
+        """
+        self.x0 = {k:np.copy(v)[()] for k,v in state['x0'].items()}
+        self.t_x0 = state['t_x0']
+        self.p = dict(state['p'])
+        self.d, self.u = state['d'], state['u']
+
+    def clone(self,logs=True):
+        """ Copy of the Module instance, e.g. to branch a scenario from
+        the current state
+        
+        The clone has its own initial conditions and parameters
+        (dictionaries), and shares the time arrays, inputs and logs with
+        the original. The logs are copied by the first of both instances
+        that runs (copy-on-write), so cloning is cheap at any point of a
+        simulation.
+        
+        Parameters
+        ----------
+        logs : bool
+            Share the logs with the clone (default). With False, the clone
+            starts with empty logs and does not record flows, e.g. for the
+            runs of an analysis, which only use the outputs of each run.
+        
+        Returns
+        -------
+        module : Module
+            Instance of the same class, with the same state.
+        """
+        new = copy.copy(self)
+        new.x0 = {k:np.copy(v)[()] for k,v in self.x0.items()}
+        new.p = dict(self.p)
+        new.options = dict(self.options)
+        if not logs:
+            new.y, new.f = Outputs(new), {}
+            new.record = False
+            new._logs_shared = False
+            return new
+        # (logs bound to the clone, for its derived outputs)
+        new.y = Outputs(new,self.y)
+        self._logs_shared = new._logs_shared = True
+        return new
+
+    def copy_logs(self):
+        """ Own copy of the logs (and flows) shared with a clone
+        (see 'clone')
+        """
+        self.y = Outputs(self,{k:np.copy(v) for k,v in self.y.items()})
+        self.f = {k:np.copy(v) for k,v in self.f.items()}
+        if hasattr(self,'y_keys'):
+            self.y_keys = list(self.y_keys)
+        self._logs_shared = False
+
+    def ensemble_shape(self):
+        """ Shape of the ensemble of members in the Module instance
+        
+        Initial conditions and parameters can be given as arrays of shape
+        (n_members,) instead of scalars, to simulate an ensemble of
+        trajectories in one vectorized integration.
+        
+        Returns
+        -------
+        shape : tuple
+            Broadcast shape of all values in `x0` and `p`
+            (empty tuple for a single trajectory).
+        """
+        shapes = {np.shape(v) for v in self.x0.values()}
+        shapes.update(np.shape(v) for v in self.p.values())
+        # (single trajectory, the usual case, without broadcasting)
+        if shapes == {()}:
+            return ()
+        return np.broadcast_shapes(*shapes)
+
+    def use_jit(self):
+        """ Whether the compiled integration applies to the next run
+        (requested with `jit`, for a single trajectory without events,
+        with the method 'euler' or 'rk4')
+        """
+        return (self.jit and self.rhs_jit is not None
+                and self.method in ('euler','rk4')
+                and self.ensemble_shape()==() and not self.events)
+
+    def jit_args(self):
+        """ Arguments `args` of the compiled right-hand side 'rhs_jit'
+        (by default, the parameter vector `pv`)
+        """
+        return self.pv
+
+    def solve(self,tspan):
+        """ Numerical integration of the states from the initial conditions,
+        as outputs of a run (called by the method 'output' of the models)
+        
+        The states are integrated with the compiled right-hand side
+        'rhs_jit' if the compiled integration applies (see 'use_jit'), or
+        otherwise with the method 'diff' and the method of the instance
+        (see 'integrate', with the method 'diff_inplace' of the model, if
+        any, for the in-place methods).
+        
+        Parameters
+        ----------
+        tspan : 2-element array-like
+            initial and final time for the integration
+        
+        Returns
+        -------
+        y : dictionary
+            Time 't', and the states by key of `x_keys` (arrays of shape
+            (n_t,), or (n_members, n_t) for an ensemble), and the times
+            and states of the events 't_events' and 'y_events' (see
+            mbps.functions.integration.fcn_events), if the run has events.
+        """
+        # (initial conditions of shape (n_states,), or
+        # (n_states,n_members) for an ensemble)
+        y0 = self.get_y0(self.x_keys)
+        if self.use_jit():
+            y_int = fcn_jit(self.rhs_jit,tspan,y0,h=self.dt,
+                            args=self.jit_args(),method=self.method,
+                            nsave=self.nsave)
+        else:
+            y_int = self.integrate(self.diff,tspan,y0,
+                                   getattr(self,'diff_inplace',None))
+        # Time and states, by key
+        y = {'t':y_int['t']}
+        for i,k in enumerate(self.x_keys):
+            y[k] = y_int['y'][i,...]
+        # Times and states of events, if any
+        if self.events is not None:
+            y['t_events'] = y_int['t_events']
+            y['y_events'] = y_int['y_events']
+        return y
+
+    def integrate(self,diff,tspan,y0,diff_inplace=None):
+        """ Numerical integration with the method of the instance
+        
+        Parameters
+        ----------
+        diff : callable
+            Function ``diff(t, y)`` with the differential equations.
+        tspan : 2-element array-like
+            initial and final time for the integration
+        y0 : ndarray, shape (n_states,) or (n_states, n_members)
+            Initial conditions (see 'get_y0').
+        diff_inplace : callable, optional
+            Function ``diff_inplace(t, y, dy)`` with the same differential
+            equations, written into `dy`, for the in-place methods
+            ('euler_inplace' and 'rk4_inplace', e.g. the method
+            'diff_inplace' of a model). By default, the values returned by
+            `diff` are copied into `dy`.
+        
+        Returns
+        -------
+        Dictionary with 't' and 'y' (and 't_events', 'y_events' if the
+        run has events), see mbps.functions.integration.fcn_integrate.
+        """
+        # Recording of flows at the stored states, by index of the logs
+        # (only for runs on the module time array)
+        rec = None
+        if self.record and self.f_keys:
+            idxs = self.log_slice(np.atleast_1d(tspan[0]))
+            if idxs is not None:
+                i0 = idxs[0].start
+                def _record(i):
+                    self.f_idx = i0 + i
+                rec = _record
+        # (right-hand side writing into a buffer, for the in-place methods)
+        if self.method in INPLACE_METHODS:
+            if diff_inplace is None:
+                def diff_inplace(_t,_y0,_dy):
+                    _dy[...] = diff(_t,_y0)
+            diff = diff_inplace
+        y = fcn_integrate(diff,tspan,y0,method=self.method,h=self.dt,
+                          events=self.events,nsave=self.nsave,record=rec,
+                          **self.options)
+        self.f_idx = None
+        return y
+
+    def log_flows(self,values):
+        """ Log the flows of the current evaluation of 'diff', if it is at
+        a stored state of the run (otherwise, nothing is done)
+        
+        Parameters
+        ----------
+        values : sequence
+            Flows, in the order of `f_keys` (scalars, or arrays of shape
+            (n_members,) for an ensemble).
+        """
+        i = self.f_idx
+        if i is None or i >= self.t.size:
+            return
+        for k,v in zip(self.f_keys,values):
+            self.f[k][...,i] = v
+        self.f_idx = None
+
+    def get_y0(self,keys):
+        """ Array of initial conditions for the numerical integration
+        
+        Parameters
+        ----------
+        keys : sequence of str
+            Keys of `x0`, in the order used by the method 'diff'.
+        
+        Returns
+        -------
+        y0 : ndarray, shape (n_states,) or (n_states, n_members)
+            Initial conditions, broadcast to the ensemble shape.
+        """
+        shape = self.ensemble_shape()
+        if shape == ():
+            return np.array([self.x0[k] for k in keys],dtype=float)
+        return np.array([np.broadcast_to(self.x0[k],shape) for k in keys],
+                        dtype=float)
+
+    def get_p(self,keys=None):
+        """ Array of parameters, e.g. a batch of parameter sets
+        
+        Parameters
+        ----------
+        keys : sequence of str, optional
+            Keys of `p` (by default, `p_keys`).
+        
+        Returns
+        -------
+        p : ndarray, shape (n_params,) or (n_params, n_members)
+            Parameters, broadcast to the ensemble shape.
+        """
+        if keys is None:
+            keys = self.p_keys
+        shape = self.ensemble_shape()
+        if shape == ():
+            return np.array([self.p[k] for k in keys],dtype=float)
+        return np.array([np.broadcast_to(self.p[k],shape) for k in keys],
+                        dtype=float)
+
+    def set_p(self,pv,keys=None):
+        """ Assign the parameters from an array (inverse of 'get_p')
+        
+        Parameters
+        ----------
+        pv : array_like, shape (n_params,) or (n_params, n_members)
+            Parameters, in the order of `keys`. A 2D array is a batch of
+            parameter sets, simulated as an ensemble.
+        keys : sequence of str, optional
+            Keys of `p` (by default, `p_keys`).
+        """
+        if keys is None:
+            keys = self.p_keys
+        pv = np.asarray(pv, dtype=float)
+        for i,k in enumerate(keys):
+            self.p[k] = pv[i][()]
+
+    def compile_p(self):
+        """ Compile the parameters into the vector `pv`, read by position
+        in the method 'diff' instead of by key in `p`
+        
+        The vector is a tuple in the order of `p_keys`: floats for a single
+        trajectory, or arrays of shape (n_members,) for an ensemble.
+        """
+        pv = self.get_p()
+        self.pv = tuple(pv.tolist()) if pv.ndim == 1 else tuple(pv)
+
+    def jacobians(self,_t,_y0):
+        """ Jacobians of the method 'diff' to the states and to the
+        parameters, at the time `_t` and the state `_y0`
+        
+        By default, they are computed by central differences of 'diff',
+        evaluated once for all perturbations as an ensemble. A model can
+        override this method with the analytic Jacobians.
+        
+        Parameters
+        ----------
+        _t : float
+            Time instant.
+        _y0 : ndarray, shape (n_states,)
+            State (single trajectory).
+        
+        Returns
+        -------
+        J_x : ndarray, shape (n_states, n_states)
+            Derivatives of d_dt to the states, in the order of `x_keys`.
+        J_p : ndarray, shape (n_states, n_params)
+            Derivatives of d_dt to the parameters, in the order of `p_keys`.
+        """
+        pv = self.pv
+        x = np.asarray(_y0,dtype=float)
+        n_x = x.size
+        v = np.concatenate((x,np.asarray(pv,dtype=float)))
+        # Steps relative to the values (optimal for central differences)
+        h = np.finfo(float).eps**(1/3)*np.where(v!=0,np.abs(v),1.)
+        # Members 2*i and 2*i+1 for -/+ of value i (states, then parameters)
+        idx = np.arange(v.size)
+        vm = np.repeat(v[:,None],2*v.size,axis=1)
+        vm[idx,2*idx] -= h
+        vm[idx,2*idx+1] += h
+        self.pv = tuple(vm[n_x:])
+        try:
+            dy = np.asarray(self.diff(_t,vm[:n_x])).reshape(n_x,-1)
+        finally:
+            self.pv = pv
+        J = (dy[:,1::2]-dy[:,0::2])/(2*h)
+        return J[:,:n_x], J[:,n_x:]
+
+    def gradient(self,x0,p,objective,d=None,u=None,p_keys=None):
+        """ Gradient of a scalar objective of the states to the
+        parameters, by the adjoint method
+        
+        The module is run forward (storing the states in the logs, as
+        checkpoints), and the adjoint is integrated backward with the
+        Jacobians of the method 'jacobians'. The cost is about that of two
+        simulations, for any number of parameters. The gradient is exact
+        for the discrete integration, with the fixed-step method of the
+        instance ('euler' or 'rk4').
+        
+        Parameters
+        ----------
+        x0 : dictionary
+            Initial conditions.
+        p : dictionary
+            Parameters.
+        objective : callable
+            Function ``objective(y)`` of the outputs of the run, that
+            returns the value of the objective and a dictionary with its
+            derivatives to the stored states, arrays of shape (n_t,) by key
+            of `x_keys` (e.g. mbps.functions.adjoint.fcn_sse).
+        d, u : dictionaries, optional
+            Disturbances and controlled inputs of the run.
+        p_keys : sequence of str, optional
+            Parameters of the gradient (by default, `p_keys`).
+        
+        Returns
+        -------
+        J : float
+            Value of the objective.
+        dJ_dp : dictionary
+            Gradient of the objective to the parameters `p_keys`.
+        dJ_dx0 : dictionary
+            Gradient of the objective to the initial conditions.
+        """
+        if self.method not in ('euler','rk4'):
+            raise ValueError("the adjoint gradient requires the method "
+                             "'euler' or 'rk4', got %r" % self.method)
+        if p_keys is None:
+            p_keys = self.p_keys
+        # Forward run, with the states stored in the logs
+        self.x0, self.p = dict(x0), dict(p)
+        tspan = (self.t[0],self.t[-1])
+        y = self.run(tspan,d,u)
+        if self.ensemble_shape() != ():
+            raise ValueError('the adjoint gradient requires a single '
+                             'trajectory, not an ensemble')
+        J, dJ_dy = objective(y)
+        for k in dJ_dy:
+            if k not in self.x_keys:
+                raise ValueError('the objective must depend on the states, '
+                                 'got the derivatives to %r' % k)
+        y_states = np.array([y[k] for k in self.x_keys],dtype=float)
+        dg_dy = np.zeros_like(y_states)
+        for i,k in enumerate(self.x_keys):
+            if k in dJ_dy:
+                dg_dy[i] = dJ_dy[k]
+        # Backward sweep, on a clone without logs and flows
+        instance = self.clone(logs=False)
+        instance.x0, instance.p = dict(x0), dict(p)
+        instance.compile_p()
+        dJ_dpv, dJ_dy0 = fcn_adjoint(instance.diff,instance.jacobians,tspan,
+                                     y_states,dg_dy,h=self.dt,
+                                     method=self.method,nsave=self.nsave)
+        dJ_dp = {k:float(dJ_dpv[self.p_keys.index(k)]) for k in p_keys}
+        dJ_dx0 = {k:float(dJ_dy0[i]) for i,k in enumerate(self.x_keys)}
+        return J, dJ_dp, dJ_dx0
+
+    def ns_keys(self,y_keys=None):
+        """ Outputs of the sensitivities: `y_keys`, or by default all
+        logged and derived outputs
+        """
+        if y_keys:
+            return list(y_keys)
+        y_keys = [yk for yk in self.y_keys]
+        y_keys += [yk for yk in self.derived if yk not in y_keys]
+        return y_keys
+
+    def ns_run(self,x0,p_ref,d=None,u=None):
+        """ Reference run of the sensitivities, stored in the logs
+        
+        The parameters `p_ref` (all, or some of them) replace those of
+        the instance for the run only: the attribute `p` is unchanged.
+        
+        Parameters
+        ----------
+        x0, p_ref, d, u
+            See method 'ns'.
+        
+        Returns
+        -------
+        y_ref : Outputs
+            Model outputs of the reference run.
+        p : dictionary
+            All parameters of the reference run.
+        """
         # Reset intial conditions for reference module
-        self.x0 = copy.deepcopy(x0)
-        # Initialize instances for -/+
-        instance_mns = copy.deepcopy(self)
-        instance_pls = copy.deepcopy(self)
+        self.x0 = dict(x0)
+        p, p_inst = {**self.p, **p_ref}, self.p
+        self.p = dict(p)
+        try:
+            tspan = (self.t[0],self.t[-1])
+            y_ref = self.run(tspan,d,u)
+        finally:
+            self.p = p_inst
+            self.compile_p()
+        return y_ref, p
+
+    def ns(self,x0,p_ref,d=None,u=None,y_keys=None,n_jobs=1,executor=None,
+           batch=False,forward=False,dtype=np.float64,frame=True):
+        """ Normalized sensitivities of the outputs to each parameter,
+        with -5% and +5% perturbations of the parameter
+        
+        Parameters
+        ----------
+        x0 : dictionary
+            Initial conditions.
+        p_ref : dictionary
+            Reference parameters (all of them are perturbed). Parameters
+            not in `p_ref` keep the values of the instance, whose attribute
+            `p` is unchanged.
+        d, u : dictionary
+            Disturbances and controlled inputs.
+        y_keys : sequence of str, optional
+            Outputs (by default, all logged and derived outputs).
+        n_jobs : int
+            Number of processes for the perturbed runs (-1 for all CPUs).
+            With 1 (default), the runs are executed serially.
+        executor : concurrent.futures.Executor, optional
+            Pool of threads or processes for the perturbed runs, instead
+            of a new process pool of `n_jobs`.
+        batch : bool
+            Integrate the reference and all perturbed runs at once, as an
+            ensemble of 2*n_params+1 members (see method 'ns_batch').
+        forward : bool
+            Compute the sensitivities from the forward sensitivity
+            equations instead of perturbed runs (see method 'ns_forward').
+        dtype : data-type
+            Type of the stored results (e.g. np.float32).
+        frame : bool
+            Return a DataFrame (default), or the NSResult with the
+            results as one array (see mbps.classes.ns_result).
+        
+        Returns
+        -------
+        ns_df : DataFrame, or NSResult
+            Normalized sensitivities, with MultiIndex columns
+            (y, p, -/+), and the reference outputs (y, 'ref', 'ref').
+            The results are identical for serial and parallel runs.
+        """
+        if forward:
+            return self.ns_forward(x0,p_ref,d,u,y_keys,dtype,frame)
+        if batch:
+            return self.ns_batch(x0,p_ref,d,u,y_keys,dtype,frame)
+        # Instance for the perturbed runs (without logs and flows)
+        instance = self.clone(logs=False)
         # Run module for reference parameters
+        # (p_ref completed with the parameters of the instance)
         tspan = (self.t[0],self.t[-1])
-        y_ref = self.run(tspan,d,u)
+        y_ref, p = self.ns_run(x0,p_ref,d,u)
         # Initialize pandas dataframe for normalized sensitivities (with nan)
         # - create MultiIndex
-        if not y_keys:
-            y_keys = [yk for yk in self.y_keys]
+        # (by default, all logged and derived outputs)
+        y_keys = self.ns_keys(y_keys)
+        # (derived outputs of the reference computed once)
+        y_ref = {yk:y_ref[yk] for yk in y_keys}
         p_keys = [pk for pk in p_ref.keys()]
-        pm = ['-','+']
-        iterables = [y_keys,p_keys,pm]
-        midx = pd.MultiIndex.from_product(iterables, names=['y', 'p', '-/+'])
-        # - initialize nan DataFrame
-        nan_arr = np.full((self.t.size, 2*len(y_keys)*len(p_keys)),0.)
-        ns_df = pd.DataFrame(nan_arr, index=self.t, columns=midx)
-        # Iterate over model parameters
-        for kp in p_ref.keys():
-            # Reset initial conditions and parameters for mns and pls modules
-            instance_mns.x0 = copy.deepcopy(x0)
-            instance_pls.x0 = copy.deepcopy(x0)
-            p_mns = copy.deepcopy(p_ref)
-            p_pls = copy.deepcopy(p_ref)
-            instance_mns.p = p_mns
-            instance_pls.p = p_pls
+        # (results in one array, of shape (n_t, n_y, n_p, 2))
+        res = NSResult(self.t,y_keys,p_keys,dtype)
+        # Parameters of the perturbed runs, -/+ for each parameter kp
+        # (copies of the dictionary, the values are replaced, not
+        # modified, by the method 'run')
+        runs = []
+        for kp in p_keys:
+            p_mns = dict(p)
+            p_pls = dict(p)
             # Modify parameter kp
-            instance_mns.p[kp] = 0.95*p_ref[kp]
-            instance_pls.p[kp] = 1.05*p_ref[kp]
+            p_mns[kp] = 0.95*p[kp]
+            p_pls[kp] = 1.05*p[kp]
         # TODO: Modify the calculation for temperature-related parameters
             #if kp[0] == 'T':
-            #    instance_mns.p[kp] = ???
-            #    instance_pls.p[kp] = ???
-            # Run model
-            y_mns = instance_mns.run(tspan,d,u)
-            y_pls = instance_pls.run(tspan,d,u)
-            # Compute normalized sensitivities per model output
-            for ky in y_keys:
+            #    p_mns[kp] = ???
+            #    p_pls[kp] = ???
+            runs += [p_mns, p_pls]
+        # Run model
+        results = map_runs(instance,x0,tspan,d,u,y_keys,runs,n_jobs,executor)
+        # Compute normalized sensitivities per model output
+        for j,kp in enumerate(p_keys):
+            p_mns, p_pls = runs[2*j], runs[2*j+1]
+            y_mns, y_pls = results[2*j], results[2*j+1]
+            for i,ky in enumerate(y_keys):
                 # Compute sensitivity
-                s_mns = (y_mns[ky]-y_ref[ky])/(p_mns[kp]-p_ref[kp])
-                s_pls = (y_pls[ky]-y_ref[ky])/(p_pls[kp]-p_ref[kp])
+                s_mns = (y_mns[ky]-y_ref[ky])/(p_mns[kp]-p[kp])
+                s_pls = (y_pls[ky]-y_ref[ky])/(p_pls[kp]-p[kp])
                 # Compute normalized sensitivity
-                ns_mns = s_mns*p_ref[kp]/y_ref[ky]
-                ns_pls = s_pls*p_ref[kp]/y_ref[ky]
+                ns_mns = s_mns*p[kp]/y_ref[ky]
+                ns_pls = s_pls*p[kp]/y_ref[ky]
                 # Compute normalized sensitivity
                 # (normalized with respect to average of y through time)
-                # ns_mns = s_mns*p_ref[kp]/np.average(y_ref[ky])
-                # ns_pls = s_pls*p_ref[kp]/np.average(y_ref[ky])
-                # Store in corresponding column in DataFrame
-                # (tuple to access MultiIndex column name)
-                ns_df.loc[:,(ky,kp,'-')] = ns_mns
-                ns_df.loc[:,(ky,kp,'+')] = ns_pls
-        # Add columns for reference model outputs
+                # ns_mns = s_mns*p[kp]/np.average(y_ref[ky])
+                # ns_pls = s_pls*p[kp]/np.average(y_ref[ky])
+                # Store in the block of results (-/+ of output i and
+                # parameter j)
+                res.block[:,i,j,0] = ns_mns
+                res.block[:,i,j,1] = ns_pls
+        # Reference model outputs
+        for i,yk in enumerate(y_keys):
+            res.ref[:,i] = y_ref[yk]
+        # Results
+        return res.frame() if frame else res
+
+    def ns_batch(self,x0,p_ref,d=None,u=None,y_keys=None,dtype=np.float64,
+                 frame=True):
+        """ Normalized sensitivities as in method 'ns', from one
+        integration of the reference and all perturbed parameter sets
+        
+        The parameters are given as arrays of 2*n_params+1 members
+        (reference, then -/+ for each parameter), integrated as one
+        ensemble, and the sensitivities are computed with array operations.
+        The reference member is stored in the logs, as in 'ns' (except the
+        flows). The results equal those of 'ns' up to roundoff (for the
+        adaptive methods, up to the tolerances, since all members share
+        the same steps).
+        
+        Parameters
+        ----------
+        x0, p_ref, d, u, y_keys, dtype, frame
+            See method 'ns'.
+        
+        Returns
+        -------
+        ns_df : DataFrame, or NSResult
+            Normalized sensitivities (see method 'ns').
+        """
+        # Reset intial conditions for reference module
+        # (p_ref completed with the parameters of the instance)
+        self.x0 = dict(x0)
+        p = {**self.p, **p_ref}
+        p_keys = [pk for pk in p_ref.keys()]
+        n_p = len(p_keys)
+        # Perturbation matrix: member 0 for the reference, and members
+        # 2*j+1 and 2*j+2 for -/+ of parameter j
+        p_batch = dict(p)
+        for j,kp in enumerate(p_keys):
+            p_batch[kp] = np.full(2*n_p+1,p[kp],dtype=float)
+            p_batch[kp][2*j+1] = 0.95*p[kp]
+            p_batch[kp][2*j+2] = 1.05*p[kp]
+        # Run the ensemble (without flows, and without logs)
+        instance = self.clone(logs=False)
+        instance.x0, instance.p = dict(x0), p_batch
+        tspan = (self.t[0],self.t[-1])
+        y = instance.run(tspan,d,u,outputs=())
+        # Reference member, stored in the logs of the module
+        self.d, self.u = d, u
+        y_ref = Outputs(self,{k:(v if k[0]=='t' or k=='y_events'
+                                 else v[...,0,:])
+                              for k,v in y.items()},p=p)
+        self.store(y_ref)
+        # (by default, all logged and derived outputs)
+        y_keys = self.ns_keys(y_keys)
+        # Normalized sensitivities, for all parameters at once
+        # (rows of shape (n_p,1) for the parameters)
+        p_r = np.array([p[kp] for kp in p_keys],dtype=float)[:,None]
+        p_mns = np.array([p_batch[kp][2*j+1] for j,kp in enumerate(p_keys)])
+        p_pls = np.array([p_batch[kp][2*j+2] for j,kp in enumerate(p_keys)])
+        res = NSResult(self.t,y_keys,p_keys,dtype)
+        for i,ky in enumerate(y_keys):
+            y_k = np.asarray(y[ky])
+            y_r = y_k[0]
+            s_mns = (y_k[1::2]-y_r)/(p_mns[:,None]-p_r)
+            s_pls = (y_k[2::2]-y_r)/(p_pls[:,None]-p_r)
+            ns_mns = s_mns*p_r/y_r
+            ns_pls = s_pls*p_r/y_r
+            res.block[:,i,:,0] = ns_mns.T
+            res.block[:,i,:,1] = ns_pls.T
+            # Reference model outputs
+            res.ref[:,i] = y_r
+        # Results
+        return res.frame() if frame else res
+
+    def sensitivities(self,x0,p,d=None,u=None,y_keys=None,p_keys=None):
+        """ Sensitivities of the outputs to the parameters, from the
+        forward sensitivity equations (see method 'ns_forward')
+        
+        Parameters
+        ----------
+        x0 : dictionary
+            Initial conditions.
+        p : dictionary
+            Parameters (all, or some of them; the others keep the values
+            of the instance, whose attribute `p` is unchanged).
+        d, u : dictionary
+            Disturbances and controlled inputs.
+        y_keys : sequence of str, optional
+            Outputs, states or derived outputs (by default, all logged and
+            derived outputs).
+        p_keys : sequence of str, optional
+            Parameters of the sensitivities (by default, all keys of `p`).
+        
+        Returns
+        -------
+        y_ref : Outputs
+            Outputs of the run with the parameters `p`.
+        sens : dictionary
+            Sensitivities dy/dp of each output of `y_keys`, arrays of shape
+            (n_params, n_t), in the order of `p_keys`.
+        """
+        if p_keys is None:
+            p_keys = [pk for pk in p.keys()]
+        x_keys = list(self.x_keys)
+        # Run module for reference parameters
+        # (the states and outputs of the reference, in the logs, with
+        # `p` completed with the parameters of the instance)
+        tspan = (self.t[0],self.t[-1])
+        y_ref, p = self.ns_run(x0,p,d,u)
+        if self.ensemble_shape() != ():
+            raise ValueError('forward sensitivities require a single '
+                             'trajectory, not an ensemble')
+        y_keys = self.ns_keys(y_keys)
+        for yk in y_keys:
+            if yk not in x_keys and yk not in self.derived:
+                raise ValueError('forward sensitivities are available for '
+                                 'the states and derived outputs, not %r'
+                                 % yk)
+        # Columns of J_p for the parameters of p_keys
+        j_p = [self.p_keys.index(kp) for kp in p_keys]
+        # Augmented system, for states z[:n_x] and sensitivities z[n_x:]
+        # (matrix S of shape (n_x, n_p), by rows)
+        instance = self.clone(logs=False)
+        instance.x0, instance.p = dict(x0), dict(p)
+        instance.d, instance.u = self.d, self.u
+        instance.compile_p()
+        n_x, n_p = len(x_keys), len(p_keys)
+        def diff_sens(_t,_z):
+            x = _z[:n_x]
+            S = _z[n_x:].reshape(n_x,n_p)
+            dx_dt = instance.diff(_t,x)
+            J_x, J_p = instance.jacobians(_t,x)
+            dS_dt = J_x @ S + J_p[:,j_p]
+            return np.concatenate((np.ravel(dx_dt),dS_dt.ravel()))
+        z0 = np.concatenate((instance.get_y0(x_keys),np.zeros(n_x*n_p)))
+        z = instance.integrate(diff_sens,tspan,z0)['y']
+        # Sensitivities of the states, shape (n_x, n_p, n_t)
+        S = z[n_x:].reshape(n_x,n_p,-1)
+        sens = {xk:S[i] for i,xk in enumerate(x_keys)}
+        # Sensitivities of the derived outputs, by central differences
+        # along (S dp, dp) for each parameter
         for yk in y_keys:
-            ns_df[yk,'ref','ref'] = y_ref[yk]
+            if yk in sens:
+                continue
+            s_y = []
+            for j,kp in enumerate(p_keys):
+                h = np.finfo(float).eps**(1/3)*(abs(p[kp]) or 1.)
+                y_pm = []
+                for sgn in (-1,1):
+                    instance.p = dict(p)
+                    instance.p[kp] = p[kp] + sgn*h
+                    y_pm.append(Outputs(instance,{
+                        xk:y_ref[xk] + sgn*h*sens[xk][j] for xk in x_keys
+                        },p=instance.p)[yk])
+                s_y.append((y_pm[1]-y_pm[0])/(2*h))
+            sens[yk] = np.array(s_y)
+        return y_ref, {yk:sens[yk] for yk in y_keys}
+
+    def ns_forward(self,x0,p_ref,d=None,u=None,y_keys=None,
+                   dtype=np.float64,frame=True):
+        """ Normalized sensitivities from the forward sensitivity equations
+        
+        The sensitivities S = dx/dp of the states to the parameters are
+        integrated together with the states, as one augmented system::
+        
+            dx/dt = f(t, x, p)
+            dS/dt = J_x S + J_p,    S(t0) = 0
+        
+        with the Jacobians of the method 'jacobians'. The sensitivities of
+        the derived outputs follow from those of the states (by central
+        differences of the derived output along x + S dp).
+        Unlike 'ns', the results do not depend on a perturbation size.
+        
+        Parameters
+        ----------
+        x0, p_ref, d, u, y_keys, dtype, frame
+            See method 'ns' (`y_keys` can be states or derived outputs).
+        
+        Returns
+        -------
+        ns_df : DataFrame, or NSResult
+            Normalized sensitivities, in the format of method 'ns'
+            (with the same values in the columns '-' and '+').
+        """
+        y_ref, sens = self.sensitivities(x0,p_ref,d,u,y_keys)
+        y_keys, p_keys = list(sens.keys()), list(p_ref.keys())
+        # Normalized sensitivities (same format as method 'ns')
+        res = NSResult(self.t,y_keys,p_keys,dtype)
+        p_r = np.array([p_ref[kp] for kp in p_keys],dtype=float)[:,None]
+        for i,yk in enumerate(y_keys):
+            ns_y = sens[yk]*p_r/np.asarray(y_ref[yk])
+            res.block[:,i,:,0] = res.block[:,i,:,1] = ns_y.T
+            # Reference model outputs
+            res.ref[:,i] = y_ref[yk]
         # Results
-        return ns_df
+        return res.frame() if frame else res
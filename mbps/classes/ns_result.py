@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+FTE34806 - Modelling of Biobased Production Systems
+MSc Biosystems Engineering, WUR
+
+Results of the normalized sensitivities of Module.ns, as one contiguous
+array instead of a DataFrame built column by column
+"""
+import numpy as np
+import pandas as pd
+
+class NSResult():
+    """ Normalized sensitivities, and reference outputs, of Module.ns
+
+    The values are stored in one 2D array `data`, of shape
+    (n_t, n_y*n_p*2 + n_y): the sensitivities of each output y to each
+    parameter p, for the -/+ perturbations, followed by the reference
+    outputs. The attributes `block` and `ref` are views of `data` with
+    shapes (n_t, n_y, n_p, 2) and (n_t, n_y), and the method 'frame'
+    gives a DataFrame on the same memory (the format returned by
+    Module.ns).
+
+    Parameters
+    ----------
+    t : ndarray
+        Time vector.
+    y_keys, p_keys : sequence of str
+        Keys of the outputs and of the parameters.
+    dtype : data-type
+        Type of the values (e.g. np.float32, for half the memory).
+    data : ndarray, optional
+        Values (by default, zeros).
+    """
+    def __init__(self, t, y_keys, p_keys, dtype=np.float64, data=None):
+        self.t = np.asarray(t)
+        self.y_keys, self.p_keys = list(y_keys), list(p_keys)
+        n_y, n_p = len(self.y_keys), len(self.p_keys)
+        if data is None:
+            data = np.zeros((self.t.size, n_y*n_p*2 + n_y), dtype=dtype)
+        self.data = data
+        # Views of the sensitivities and of the reference outputs
+        self.block = data[:,:n_y*n_p*2].reshape(self.t.size, n_y, n_p, 2)
+        self.ref = data[:,n_y*n_p*2:]
+
+    def columns(self):
+        """ MultiIndex of the columns of `data`: (y, p, -/+) for the
+        sensitivities, and (y, 'ref', 'ref') for the reference outputs
+        """
+        tuples = [(yk,pk,pm) for yk in self.y_keys for pk in self.p_keys
+                  for pm in ('-','+')]
+        tuples += [(yk,'ref','ref') for yk in self.y_keys]
+        return pd.MultiIndex.from_tuples(tuples, names=['y', 'p', '-/+'])
+
+    def frame(self):
+        """ DataFrame of the results, without a copy of `data`
+
+        Returns
+        -------
+        ns_df : DataFrame
+            Normalized sensitivities, with MultiIndex columns
+            (y, p, -/+), and the reference outputs (y, 'ref', 'ref').
+        """
+        return pd.DataFrame(self.data, index=self.t, columns=self.columns(),
+                            copy=False)
+
+    def save_npz(self, file):
+        """ Save the results to a NumPy .npz file (see 'load_npz') """
+        np.savez(file, t=self.t, data=self.data,
+                 y_keys=np.array(self.y_keys), p_keys=np.array(self.p_keys))
+
+    @classmethod
+    def load_npz(cls, file):
+        """ Results from a .npz file of 'save_npz' """
+        with np.load(file) as f:
+            return cls(f['t'], f['y_keys'].tolist(), f['p_keys'].tolist(),
+                       data=f['data'])
+
+    def to_parquet(self, path, **kwargs):
+        """ Save the results to a Parquet file, with DataFrame.to_parquet
+        (requires pyarrow or fastparquet)
+        """
+        self.frame().to_parquet(path, **kwargs)
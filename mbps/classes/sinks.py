@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+FTE34806 - Modelling of Biobased Production Systems
+MSc Biosystems Engineering, WUR
+
+Result sinks for streaming simulations
+
+A sink receives the chunks ``(t, y)`` yielded by
+`mbps.functions.integration.fcn_stream` (or by the Module method 'stream')
+through its method 'update', and is finalized with its method 'close'.
+The time is the last axis of `y`, as for the integration functions.
+"""
+import numpy as np
+
+def consume(stream, sinks):
+    """ Pass all chunks of a stream to a sequence of sinks
+
+    Parameters
+    ----------
+    stream : iterable
+        Chunks ``(t, y)``, e.g. from `fcn_stream`.
+    sinks : sequence
+        Objects with the methods 'update' and 'close'.
+
+    Returns
+    -------
+    t, y : ndarray
+        Last chunk of the stream (e.g. to retrieve the final state).
+    """
+    t, y = None, None
+    for t, y in stream:
+        for sink in sinks:
+            sink.update(t, y)
+    for sink in sinks:
+        sink.close()
+    return t, y
+
+class Decimator():
+    """ Sink that keeps every `step`-th time instant of the stream
+
+    Parameters
+    ----------
+    step : int
+        Decimation factor (1 keeps every time instant).
+
+    Attributes
+    ----------
+    t : ndarray, shape (n_kept,)
+        Kept time instants (available after 'close').
+    y : ndarray, shape (n_outputs, n_kept) or (n_outputs, n_members, n_kept)
+        Kept values (available after 'close').
+    """
+    def __init__(self, step):
+        self.step = int(step)
+        # Number of time instants received so far
+        self.n = 0
+        self._t, self._y = [], []
+
+    def update(self, t, y):
+        # First index of the chunk on the decimated grid
+        first = (-self.n) % self.step
+        self._t.append(t[first::self.step])
+        self._y.append(y[...,first::self.step])
+        self.n += t.size
+
+    def close(self):
+        self.t = np.concatenate(self._t)
+        self.y = np.concatenate(self._y, axis=-1)
+        self._t, self._y = [], []
+
+class RunningStats():
+    """ Sink with running statistics through time of each output
+
+    The statistics are updated per chunk (Chan et al., 1979), so only the
+    accumulators are kept in memory.
+
+    Attributes
+    ----------
+    n : int
+        Number of time instants received.
+    mean, var, min, max : ndarray, shape (n_outputs,) or (n_outputs, n_members)
+        Mean, (population) variance, minimum and maximum through time.
+    """
+    def __init__(self):
+        self.n = 0
+        self.mean, self.m2 = None, None
+        self.min, self.max = None, None
+
+    def update(self, t, y):
+        n_b = y.shape[-1]
+        mean_b = y.mean(axis=-1)
+        m2_b = ((y - mean_b[...,np.newaxis])**2).sum(axis=-1)
+        if self.n == 0:
+            self.mean, self.m2 = mean_b, m2_b
+            self.min, self.max = y.min(axis=-1), y.max(axis=-1)
+        else:
+            n = self.n + n_b
+            delta = mean_b - self.mean
+            self.mean = self.mean + delta*n_b/n
+            self.m2 = self.m2 + m2_b + delta**2*self.n*n_b/n
+            self.min = np.minimum(self.min, y.min(axis=-1))
+            self.max = np.maximum(self.max, y.max(axis=-1))
+        self.n += n_b
+
+    @property
+    def var(self):
+        return self.m2/self.n
+
+    def close(self):
+        pass
+
+class FileWriter():
+    """ Sink that appends the stream to a CSV file
+
+    Parameters
+    ----------
+    path : str
+        Path of the CSV file (overwritten).
+    keys : sequence of str, optional
+        Names of the outputs, for the header. For an ensemble, the columns
+        are named 'key[j]' for member j.
+    fmt : str
+        Format of the values, as in numpy.savetxt.
+    """
+    def __init__(self, path, keys=None, fmt='%.10g'):
+        self.path, self.keys, self.fmt = path, keys, fmt
+        self.file = None
+
+    def update(self, t, y):
+        # Rows of time instants, with the outputs (and members) as columns
+        rows = y.reshape(-1, y.shape[-1]).T
+        if self.file is None:
+            self.file = open(self.path, 'w')
+            keys = self.keys
+            if keys is None:
+                keys = ['y%d' % i for i in range(y.shape[0])]
+            if y.ndim > 2:
+                keys = ['%s[%d]' % (k, j) for k in keys
+                        for j in range(rows.shape[1]//len(keys))]
+            self.file.write(','.join(['t'] + list(keys)) + '\n')
+        np.savetxt(self.file, np.column_stack((t, rows)), fmt=self.fmt,
+                   delimiter=',')
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
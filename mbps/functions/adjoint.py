@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+FTE34806 - Modelling of Biobased Production Systems
+MSc Biosystems Engineering, WUR
+
+Adjoint method for the gradient of a scalar objective of the states
+(e.g. the sum of squared errors to measured data) to the parameters.
+
+The gradient is that of the discrete integration (Euler forward or
+Runge-Kutta), with the stored states of a run as checkpoints. The states
+between checkpoints are recomputed during the backward sweep, so the
+gradient to all parameters costs about two simulations, independently of
+the number of parameters.
+"""
+import numpy as np
+
+from mbps.functions.integration import (time_grid, time_index, step_euler,
+                                        step_rk4)
+
+def step_jacobians(diff, jac, t, y, h, method='euler'):
+    """ Jacobians of one integration step to the state and parameters
+
+    Parameters
+    ----------
+    diff : callable
+        Function ``diff(t, y)`` with the differential equations.
+    jac : callable
+        Function ``jac(t, y)`` that returns the Jacobians of `diff` to the
+        state, shape (n_states, n_states), and to the parameters, shape
+        (n_states, n_params).
+    t : float
+        Time at the start of the step.
+    y : ndarray, shape (n_states,)
+        State at the start of the step.
+    h : float
+        Step size.
+    method : {'euler', 'rk4'}
+        Euler forward, or 4th-order Runge-Kutta.
+
+    Returns
+    -------
+    M_x : ndarray, shape (n_states, n_states)
+        Derivatives of the state after the step to `y`.
+    M_p : ndarray, shape (n_states, n_params)
+        Derivatives of the state after the step to the parameters.
+    """
+    I = np.eye(y.size)
+    A1, B1 = jac(t, y)
+    if method == 'euler':
+        return I + A1*h, B1*h
+    if method != 'rk4':
+        raise ValueError("method must be 'euler' or 'rk4', got %r" % method)
+    # Stages as in step_rk4, with the derivatives of each slope
+    k1 = diff(t, y)
+    k2 = diff(t+h/2, y+k1*h/2)
+    k3 = diff(t+h/2, y+k2*h/2)
+    A2, B2 = jac(t+h/2, y+k1*h/2)
+    A3, B3 = jac(t+h/2, y+k2*h/2)
+    A4, B4 = jac(t+h, y+k3*h)
+    D2x, D2p = A2 @ (I + A1*h/2), A2 @ (B1*h/2) + B2
+    D3x, D3p = A3 @ (I + D2x*h/2), A3 @ (D2p*h/2) + B3
+    D4x, D4p = A4 @ (I + D3x*h), A4 @ (D3p*h) + B4
+    M_x = I + (A1 + 2*D2x + 2*D3x + D4x)*h/6
+    M_p = (B1 + 2*D2p + 2*D3p + D4p)*h/6
+    return M_x, M_p
+
+def fcn_adjoint(diff, jac, t_span, y, dg_dy, h=1.0, method='euler', nsave=1):
+    """ Gradient of an objective of the stored states, by the adjoint
+    of the fixed-step integration
+
+    For an objective ``J = g(y[:,0], ..., y[:,n_points-1])`` of the
+    stored states of a run, the adjoint (dJ/dy of each state) is
+    propagated backward, from the last stored state to the initial
+    condition, with the Jacobians of each integration step.
+
+    Parameters
+    ----------
+    diff : callable
+        Function ``diff(t, y)`` with the differential equations.
+    jac : callable
+        Function ``jac(t, y)`` with the Jacobians of `diff` (see
+        `step_jacobians`).
+    t_span : 2-tuple of floats
+        Interval of integration (t0, tf) of the run.
+    y : ndarray, shape (n_states, n_points)
+        Stored states of the run (every `nsave` steps), as checkpoints.
+    dg_dy : ndarray, shape (n_states, n_points)
+        Derivatives of the objective to the stored states.
+    h : float
+        Step size of the integration.
+    method : {'euler', 'rk4'}
+        Euler forward, or 4th-order Runge-Kutta.
+    nsave : int
+        Number of integration steps between stored states.
+
+    Returns
+    -------
+    dJ_dp : ndarray, shape (n_params,)
+        Gradient of the objective to the parameters.
+    dJ_dy0 : ndarray, shape (n_states,)
+        Gradient of the objective to the initial conditions.
+    """
+    step = {'euler':step_euler, 'rk4':step_rk4}[method]
+    tint = time_grid(t_span, h, nsave)[0]
+    y, dg_dy = np.asarray(y, dtype=float), np.asarray(dg_dy, dtype=float)
+    # Adjoint at the last stored state
+    lam = dg_dy[:,-1].copy()
+    dJ_dp = 0.
+    for k in range(y.shape[1]-1, 0, -1):
+        # States of the steps between checkpoints k-1 and k (recomputed)
+        i0 = (k-1)*nsave
+        ys = [y[:,k-1]]
+        for i in range(i0, i0+nsave-1):
+            ys.append(step(diff, tint[i], ys[-1], h))
+        # Adjoint backward through the steps
+        for i in range(nsave-1, -1, -1):
+            M_x, M_p = step_jacobians(diff, jac, tint[i0+i], ys[i], h,
+                                      method)
+            dJ_dp = dJ_dp + lam @ M_p
+            lam = lam @ M_x
+        lam += dg_dy[:,k-1]
+    return np.asarray(dJ_dp), lam
+
+def fcn_sse(key, t_data, y_data, weights=None):
+    """ Objective function for the (weighted) sum of squared errors
+    between a state and measured data, for Module.gradient
+
+    Parameters
+    ----------
+    key : str
+        Key of the state (e.g. 'Wg').
+    t_data : array_like
+        Time instants of the data (stored time instants of the module).
+    y_data : array_like
+        Measured values at `t_data`.
+    weights : array_like, optional
+        Weights of the squared errors (by default, 1).
+
+    Returns
+    -------
+    objective : callable
+        Function ``objective(y)`` of the outputs of a run, that returns
+        the sum of squared errors, and its derivatives to the stored
+        states (dictionary with `key`).
+    """
+    t_data = np.asarray(t_data, dtype=float)
+    y_data = np.asarray(y_data, dtype=float)
+    w = np.ones_like(y_data) if weights is None else np.asarray(weights)
+    def objective(y):
+        idx = time_index(y['t'], t_data)
+        e = np.asarray(y[key])[idx] - y_data
+        dg = np.zeros(np.size(y['t']))
+        np.add.at(dg, idx, 2*w*e)
+        return np.sum(w*e**2), {key:dg}
+    return objective
@@ -6,9 +6,59 @@ MSc Biosystems Engineering, WUR
 @authors:   Daniel Reyes Lastiri, Stefan Maranus,
             Rachel van Ooteghem, Tim Hoogstad
 """
+import inspect
+import functools
 import numpy as np
+from scipy.integrate import solve_ivp
+from scipy.optimize import brentq
 
-def fcn_euler_forward(diff, t_span, y0, h=1.0):
+def time_grid(t_span, h, nsave=1):
+    """ Time vectors for integration with step `h`, and for the results
+    stored every `nsave` steps
+    
+    Returns
+    -------
+    tint : ndarray
+        Integration time instants, ``int((tf-t0)/h) + 1`` from t0 to tf.
+    tsave : ndarray
+        Time instants of the stored results (every `nsave`-th element of
+        `tint`, from np.linspace as for the time array of Module).
+    """
+    # Number of elements for integration time and stored results
+    nt = int((t_span[1]-t_span[0])/h) + 1
+    tint = np.linspace(t_span[0], t_span[1], nt)
+    if nsave == 1:
+        return tint, tint
+    nout = (nt-1)//nsave + 1
+    tsave = np.linspace(t_span[0], tint[(nout-1)*nsave], nout)
+    return tint, tsave
+
+def time_index(t, t_data):
+    """ Indices of the time instants `t_data` in the time vector `t`
+    (e.g. measurement times in the stored times of a run)
+    
+    Returns
+    -------
+    idx : ndarray of int
+        Index of the nearest element of `t` for each time of `t_data`.
+    
+    Raises
+    ------
+    ValueError
+        If a time of `t_data` is not in `t` (up to roundoff).
+    """
+    t, t_data = np.asarray(t), np.asarray(t_data, dtype=float)
+    idx = np.clip(np.searchsorted(t, t_data), 0, t.size-1)
+    # (nearest element, left or right, within roundoff)
+    left = np.clip(idx-1, 0, t.size-1)
+    idx = np.where(np.abs(t[left]-t_data) < np.abs(t[idx]-t_data), left, idx)
+    if not np.allclose(t[idx], t_data, rtol=1E-9, atol=1E-9):
+        raise ValueError('time of the data must be stored time instants '
+                         'of the module')
+    return idx
+
+def fcn_euler_forward(diff, t_span, y0, h=1.0, events=None, nsave=1,
+                      record=None):
     """ Function for Euler Forward numerical integration.
     Based on the syntax of scipy.integrate.solve_ivp
     
@@ -29,40 +79,64 @@ def fcn_euler_forward(diff, t_span, y0, h=1.0):
     diff : callable
         Function to calculate the value of d_dt
         (the right-hand side of the system).
+        For an ensemble, it receives the whole state matrix of shape
+        (n_states, n_members) and must return an array of the same shape.
     t_span : 2-tuple of floats
         Interval of integration (t0, tf). The solver starts with t=t0 and
         integrates until it reaches t=tf.
+    y0 : ndarray, shape (n_states,) or (n_states, n_members)
+        Initial state. A 2D array integrates an ensemble of `n_members`
+        trajectories together, in one vectorized step per time instant.
     h : float
         Step size for the integration.
+    events : callable, or list of callables, optional
+        Event functions ``event(t, y)`` (single trajectory only), located
+        within the steps (see `fcn_events`).
+    nsave : int
+        Store the results every `nsave` steps (e.g. daily results from
+        an integration with h=0.05 with nsave=20).
+    record : callable, optional
+        Function ``record(i)``, called before the evaluation of `diff` at
+        the i-th stored state (to record diagnostics of the model, such
+        as flows, only for accepted states).
     
     Returns
     -------
     Dictionary with the following:\n
     t : ndarray, shape (n_points,)
-        Time vector for desired evaluation (based on `t_span` and `h`).
-    y : ndarray, shape (n_outputs, n_points)
+        Time vector for desired evaluation (based on `t_span`, `h`
+        and `nsave`).
+    y : ndarray, shape (n_outputs, n_points) or (n_outputs, n_members, n_points)
         Values of the solution at `t`.
+    t_events, y_events : list of ndarrays
+        Times and states of each event (only if `events` is given).
     """
-    # Number of elements for integration time and model outputs
-    nt = int((t_span[1]-t_span[0])/h) + 1
+    if events is not None:
+        return fcn_events(diff, t_span, y0, h, events, step_euler, nsave,
+                          record)
     # Vectors for integration time and model outputs
-    tint = np.linspace(t_span[0], t_span[1], nt)
-    yint = np.zeros((y0.size, tint.size))
+    # (only every nsave-th time instant is stored)
+    tint, tsave = time_grid(t_span, h, nsave)
+    # (time is the last axis, so an ensemble keeps its member axis)
+    yint = np.zeros(y0.shape + (tsave.size,))
     # Assign initial condition to first element of output vector
-    yint[:,0] = y0
+    yint[...,0] = y0
     # Iterator
     # (stop at second-to-last element, and store index in Fortran order)
     it = np.nditer(tint[:-1], flags=['f_index'])
     for ti in it:
         # Index for current time instant
         idx = it.index
+        if record is not None and idx % nsave == 0:
+            record(idx//nsave)
         # Model outputs at next time instant (Euler forward)
-        yint[:,idx+1] = y0 + diff(ti,y0)*h
-        # Update initial condition for next iteration
-        y0 = yint[:,idx+1]
-    return {'t':tint, 'y':yint}
+        # (also the initial condition for next iteration)
+        y0 = y0 + diff(ti,y0)*h
+        if (idx+1) % nsave == 0:
+            yint[...,(idx+1)//nsave] = y0
+    return {'t':tsave, 'y':yint}
 
-def fcn_rk4(diff, t_span, y0, h=1.0):
+def fcn_rk4(diff, t_span, y0, h=1.0, events=None, nsave=1, record=None):
     """ Function for Runge-Kutta numerical integration.
     Based on the syntax of scipy.integrate.solve_ivp
     
@@ -83,33 +157,56 @@ def fcn_rk4(diff, t_span, y0, h=1.0):
     diff : callable
         Function to calculate the value of d_dt
         (the right-hand side of the system).
+        For an ensemble, it receives the whole state matrix of shape
+        (n_states, n_members) and must return an array of the same shape.
     t_span : 2-tuple of floats
         Interval of integration (t0, tf). The solver starts with t=t0 and
         integrates until it reaches t=tf.
+    y0 : ndarray, shape (n_states,) or (n_states, n_members)
+        Initial state. A 2D array integrates an ensemble of `n_members`
+        trajectories together, in one vectorized step per time instant.
     h : float
         Step size for the integration.
+    events : callable, or list of callables, optional
+        Event functions ``event(t, y)`` (single trajectory only), located
+        within the steps (see `fcn_events`).
+    nsave : int
+        Store the results every `nsave` steps (e.g. daily results from
+        an integration with h=0.05 with nsave=20).
+    record : callable, optional
+        Function ``record(i)``, called before the evaluation of `diff` at
+        the i-th stored state (to record diagnostics of the model, such
+        as flows, only for accepted states).
     
     Returns
     -------
     Dictionary with the following:\n
     t : ndarray, shape (n_points,)
-        Time vector for desired evaluation (based on `t_span` and `h`).
-    y : ndarray, shape (n_outputs, n_points)
+        Time vector for desired evaluation (based on `t_span`, `h`
+        and `nsave`).
+    y : ndarray, shape (n_outputs, n_points) or (n_outputs, n_members, n_points)
         Values of the solution at `t`.
+    t_events, y_events : list of ndarrays
+        Times and states of each event (only if `events` is given).
     """
-    # Number of elements for integration time and model outputs
-    nt = int((t_span[1]-t_span[0])/h) + 1
+    if events is not None:
+        return fcn_events(diff, t_span, y0, h, events, step_rk4, nsave,
+                          record)
     # Vectors for integration time and model outputs
-    tint = np.linspace(t_span[0], t_span[1], nt)
-    yint = np.zeros((y0.size, tint.size))
+    # (only every nsave-th time instant is stored)
+    tint, tsave = time_grid(t_span, h, nsave)
+    # (time is the last axis, so an ensemble keeps its member axis)
+    yint = np.zeros(y0.shape + (tsave.size,))
     # Assign initial condition to first element of output vector
-    yint[:,0] = y0
+    yint[...,0] = y0
     # Iterator
     # (stop at second-to-last element, and store index in Fortran order)
     it = np.nditer(tint[:-1], flags=['f_index'])
     for ti in it:
         # Index for current time instant
         idx = it.index
+        if record is not None and idx % nsave == 0:
+            record(idx//nsave)
         # Slopes
         # TODO: Write down and uncomment the equations for the slopes
         k1 = diff(ti,y0)
@@ -117,10 +214,823 @@ def fcn_rk4(diff, t_span, y0, h=1.0):
         k3 = diff(ti+h/2,y0+k2*h/2)
         k4 = diff(ti+h,y0+k3*h)
         # Model outputs at next time instant
+        # (also the initial condition for next iteration)
         # TODO: Write down and uncomment the equation
         # for the numerical solution
-        yint[:,idx+1] = y0 + (k1 + 2*k2 + 2*k3 + k4)*h/6
+        y0 = y0 + (k1 + 2*k2 + 2*k3 + k4)*h/6
+        if (idx+1) % nsave == 0:
+            yint[...,(idx+1)//nsave] = y0
+    return {'t':tsave, 'y':yint}
+        
+# Coefficients of the Dormand-Prince 5(4) embedded pair
+# (Dormand & Prince, 1980), and of its continuous extension for
+# dense output (Shampine, 1986), as used in scipy.integrate.RK45
+DP_C = np.array([0, 1/5, 3/10, 4/5, 8/9, 1])
+DP_A = np.array([
+    [0, 0, 0, 0, 0],
+    [1/5, 0, 0, 0, 0],
+    [3/40, 9/40, 0, 0, 0],
+    [44/45, -56/15, 32/9, 0, 0],
+    [19372/6561, -25360/2187, 64448/6561, -212/729, 0],
+    [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656]])
+DP_B = np.array([35/384, 0, 500/1113, 125/192, -2187/6784, 11/84])
+DP_E = np.array([-71/57600, 0, 71/16695, -71/1920, 17253/339200, -22/525,
+                 1/40])
+DP_P = np.array([
+    [1, -8048581381/2820520608, 8663915743/2820520608,
+     -12715105075/11282082432],
+    [0, 0, 0, 0],
+    [0, 131558114200/32700410799, -68118460800/10900136933,
+     87487479700/32700410799],
+    [0, -1754552775/470086768, 14199869525/1410260304,
+     -10690763975/1880347072],
+    [0, 127303824393/49829197408, -318862633887/49829197408,
+     701980252875/199316789632],
+    [0, -282668133/205662961, 2019193451/616988883, -1453857185/822651844],
+    [0, 40617522/29380423, -110615467/29380423, 69997945/29380423]])
+
+def fcn_dopri45(diff, t_span, y0, h=1.0, rtol=1e-3, atol=1e-6,
+                max_step=np.inf, nsave=1):
+    """ Function for adaptive Runge-Kutta numerical integration,
+    with the embedded Dormand-Prince 5(4) pair and error control.
+    Based on the syntax of scipy.integrate.solve_ivp
+    
+    The integration step is adapted to keep the local error estimate
+    below ``atol + rtol*abs(y)``, so that few steps are taken where the
+    solution changes slowly. The results are interpolated back onto the
+    same time vector as for `fcn_euler_forward` and `fcn_rk4`, with the
+    4th-order dense output of the pair.
+    
+    Parameters
+    ----------
+    diff : callable
+        Function to calculate the value of d_dt
+        (the right-hand side of the system).
+        For an ensemble, it receives the whole state matrix of shape
+        (n_states, n_members) and must return an array of the same shape.
+    t_span : 2-tuple of floats
+        Interval of integration (t0, tf). The solver starts with t=t0 and
+        integrates until it reaches t=tf.
+    y0 : ndarray, shape (n_states,) or (n_states, n_members)
+        Initial state. An ensemble shares the adaptive step size, which is
+        controlled with the error of all its members.
+    h : float
+        Step size of the time vector for the results. It is also used as
+        the first trial step for the integration.
+    rtol, atol : float
+        Relative and absolute tolerances for the local error estimate.
+    max_step : float
+        Maximum allowed integration step size.
+    nsave : int
+        Interpolate the results every `nsave` multiples of `h`.
+    
+    Returns
+    -------
+    Dictionary with the following:\n
+    t : ndarray, shape (n_points,)
+        Time vector for desired evaluation (based on `t_span`, `h`
+        and `nsave`).
+    y : ndarray, shape (n_outputs, n_points) or (n_outputs, n_members, n_points)
+        Values of the solution at `t`.
+    nfev : int
+        Number of evaluations of the right-hand side.
+    """
+    # Vector for the time instants of the results, and model outputs
+    tint = time_grid(t_span, h, nsave)[1]
+    yint = np.zeros(y0.shape + (tint.size,))
+    # Assign initial condition to first element of output vector
+    yint[...,0] = y0
+    # Slopes of the 7 stages (the last one is reused as the first slope
+    # of the next step)
+    t, tf, y = tint[0], tint[-1], np.asarray(y0, dtype=float)
+    K = np.zeros((7,) + y.shape)
+    K[0] = diff(t,y)
+    nfev = 1
+    # Index of the next output time instant, and trial step size
+    idx = 1
+    hs = min(h, max_step)
+    while idx < tint.size:
+        # Step size limited to the end of the integration interval
+        last = hs >= tf - t
+        if last:
+            hs = tf - t
+        if hs < 10*np.finfo(float).eps*max(abs(t),1.0):
+            raise RuntimeError('Step size became too small at t = %g' % t)
+        # Slopes
+        for s in range(1,6):
+            dy = np.tensordot(DP_A[s,:s], K[:s], axes=1)*hs
+            K[s] = diff(t+DP_C[s]*hs, y+dy)
+        y_new = y + np.tensordot(DP_B, K[:6], axes=1)*hs
+        K[6] = diff(t+hs, y_new)
+        nfev += 6
+        # Local error estimate, scaled with the tolerances (RMS norm)
+        err = np.tensordot(DP_E, K, axes=1)*hs
+        scale = atol + rtol*np.maximum(np.abs(y), np.abs(y_new))
+        err_norm = np.sqrt(np.mean((err/scale)**2))
+        # Factor for the next step size
+        # (a non-finite error, e.g. from a NaN of diff, rejects the step
+        # with the smallest factor)
+        if err_norm == 0:
+            factor = 10.0
+        elif not np.isfinite(err_norm):
+            factor = 0.2
+        else:
+            factor = min(10.0, max(0.2, 0.9*err_norm**(-1/5)))
+        if not np.isfinite(err_norm) or err_norm > 1:
+            # Rejected step, try again with a smaller step size
+            hs = hs*min(1.0, factor)
+            continue
+        # Accepted step
+        # Dense output at the time instants within the step
+        t_new = tf if last else t + hs
+        idx_end = tint.size if last else np.searchsorted(tint, t_new, 'right')
+        if idx_end > idx:
+            theta = (tint[idx:idx_end] - t)/hs
+            Q = np.tensordot(DP_P.T, K, axes=1)
+            theta_pow = np.cumprod(np.tile(theta, (4,1)), axis=0)
+            yint[...,idx:idx_end] = (y[...,np.newaxis]
+                + np.tensordot(Q, theta_pow, axes=(0,0))*hs)
+            idx = idx_end
+        # Update initial condition and first slope for next iteration
+        t, y = t_new, y_new
+        K[0] = K[6]
+        hs = min(hs*factor, max_step)
+    return {'t':tint, 'y':yint, 'nfev':nfev}
+
+def fcn_jac_num(diff, t, y, f0=None):
+    """ Function for the numerical Jacobian of the right-hand side
+    ``diff(t, y)``, by forward finite differences.
+    
+    Parameters
+    ----------
+    diff : callable
+        Function to calculate the value of d_dt.
+    t : float
+        Time instant.
+    y : ndarray, shape (n_states,) or (n_states, n_members)
+        State at which the Jacobian is evaluated.
+    f0 : ndarray, optional
+        Value of ``diff(t, y)``, if already available.
+    
+    Returns
+    -------
+    jac : ndarray, shape (n_states, n_states) or (n_states, n_states, n_members)
+        Jacobian matrix ``jac[i,j] = d f_i / d y_j``.
+    nfev : int
+        Number of evaluations of the right-hand side.
+    """
+    nfev = 0
+    if f0 is None:
+        f0 = diff(t,y)
+        nfev += 1
+    jac = np.zeros((y.shape[0],) + y.shape)
+    for j in range(y.shape[0]):
+        # Perturbation relative to the state value
+        # (with a floor for states close to zero)
+        delta = np.sqrt(np.finfo(float).eps)*np.maximum(np.abs(y[j]), 1E-6)
+        y_pert = y.copy()
+        y_pert[j] = y[j] + delta
+        jac[:,j] = (diff(t,y_pert) - f0)/delta
+        nfev += 1
+    return jac, nfev
+
+def fcn_bdf2(diff, t_span, y0, h=1.0, jac=None, rtol=1e-6, atol=1e-9,
+             max_iter=4, nsave=1):
+    """ Function for implicit numerical integration of stiff systems,
+    with the 2nd-order backward differentiation formula (BDF2).
+    Based on the syntax of scipy.integrate.solve_ivp
+    
+    Each step solves::
+
+        y[n+1] - 4/3*y[n] + 1/3*y[n-1] = 2/3*h*f(t[n+1], y[n+1])
+
+    with a simplified Newton iteration (backward Euler for the first step).
+    The Jacobian and the inverse of the iteration matrix are kept between
+    steps, and only re-evaluated when the Newton iteration converges
+    slowly or diverges. If it still fails with a fresh Jacobian, the step
+    is split into backward Euler sub-steps. The method is stable for large
+    steps `h` where the explicit functions require a small `h`.
+    
+    Parameters
+    ----------
+    diff : callable
+        Function to calculate the value of d_dt
+        (the right-hand side of the system).
+    t_span : 2-tuple of floats
+        Interval of integration (t0, tf). The solver starts with t=t0 and
+        integrates until it reaches t=tf.
+    y0 : ndarray, shape (n_states,) or (n_states, n_members)
+        Initial state. For an ensemble, each member has its own Jacobian.
+    h : float
+        Step size for the integration.
+    jac : callable, optional
+        Function ``jac(t, y)`` for the Jacobian ``d f_i / d y_j``,
+        of shape (n_states, n_states) or (n_states, n_states, n_members).
+        If not given, it is calculated by finite differences.
+    rtol, atol : float
+        Relative and absolute tolerances for the Newton iteration.
+    max_iter : int
+        Maximum number of Newton iterations with a cached Jacobian,
+        before it is re-evaluated.
+    nsave : int
+        Store the results every `nsave` steps.
+    
+    Returns
+    -------
+    Dictionary with the following:\n
+    t : ndarray, shape (n_points,)
+        Time vector for desired evaluation (based on `t_span`, `h`
+        and `nsave`).
+    y : ndarray, shape (n_outputs, n_points) or (n_outputs, n_members, n_points)
+        Values of the solution at `t`.
+    nfev : int
+        Number of evaluations of the right-hand side.
+    njev : int
+        Number of evaluations of the Jacobian.
+    """
+    # Vectors for integration time and model outputs
+    # (only every nsave-th time instant is stored)
+    tint, tsave = time_grid(t_span, h, nsave)
+    yint = np.zeros(y0.shape + (tsave.size,))
+    # Assign initial condition to first element of output vector
+    yint[...,0] = y0
+    # Cached Jacobian, and inverse of the iteration matrix I - c*h*J
+    # (with member axes first, for batched inversion)
+    eye = np.eye(y0.shape[0])
+    cache = {'J':None, 'M_inv':None, 'ch':None}
+    count = {'nfev':0, 'njev':0}
+
+    def newton(t_new, psi, ch, y_start, scale):
+        # Solve y - psi - ch*f(t_new,y) = 0, or return None if it fails
+        fresh = False
+        while True:
+            if cache['J'] is None:
+                if jac is None:
+                    J, n = fcn_jac_num(diff, t_new, y_start)
+                    count['nfev'] += n
+                else:
+                    J = np.asarray(jac(t_new, y_start), dtype=float)
+                count['njev'] += 1
+                cache['J'], cache['ch'], fresh = J, None, True
+            if cache['ch'] != ch:
+                J = cache['J']
+                M = eye.reshape(eye.shape + (1,)*(J.ndim-2)) - ch*J
+                cache['M_inv'] = np.linalg.inv(np.moveaxis(M,(0,1),(-2,-1)))
+                cache['ch'] = ch
+            y_new = y_start
+            dy_norm_old = None
+            for it in range(3*max_iter if fresh else max_iter):
+                G = y_new - psi - ch*diff(t_new, y_new)
+                count['nfev'] += 1
+                dy = np.einsum('...ij,...j->...i', cache['M_inv'],
+                               np.moveaxis(G, 0, -1))
+                y_new = y_new - np.moveaxis(dy, -1, 0)
+                dy_norm = np.sqrt(np.mean((dy/np.moveaxis(scale,0,-1))**2))
+                if dy_norm < 1:
+                    return y_new
+                # Stop iterating if the convergence rate degrades
+                if dy_norm_old is not None and dy_norm > 0.5*dy_norm_old:
+                    break
+                dy_norm_old = dy_norm
+            if fresh:
+                return None
+            # Re-evaluate the Jacobian and repeat the iteration
+            cache['J'] = None
+
+    y_prev = None
+    y0 = yint[...,0].copy()
+    for idx in range(tint.size-1):
+        t_new = tint[idx+1]
+        scale = atol + rtol*np.abs(y0)
+        # BDF2 step (backward Euler for the first step),
+        # with the extrapolated state as starting value
+        if y_prev is None:
+            y_new = newton(t_new, y0, h, y0, scale)
+        else:
+            y_new = newton(t_new, 4/3*y0 - 1/3*y_prev, 2/3*h,
+                           2*y0 - y_prev, scale)
+        # If the iteration fails, split the step into backward Euler
+        # sub-steps (and restart the BDF2 formula afterwards)
+        n_sub = 1
+        while y_new is None:
+            n_sub *= 2
+            if n_sub > 1024:
+                raise RuntimeError('Newton iteration did not converge '
+                                   'at t = %g, reduce h' % t_new)
+            y_new = y0
+            for i in range(n_sub):
+                y_new = newton(tint[idx]+(i+1)*h/n_sub, y_new, h/n_sub,
+                               y_new, scale)
+                if y_new is None:
+                    break
+        # Model outputs at next time instant
+        if (idx+1) % nsave == 0:
+            yint[...,(idx+1)//nsave] = y_new
+        # Update initial conditions for next iteration
+        y_prev = y0 if n_sub == 1 else None
+        y0 = y_new
+    return {'t':tsave, 'y':yint, 'nfev':count['nfev'], 'njev':count['njev']}
+
+def fcn_euler_forward_inplace(diff, t_span, y0, h=1.0, nsave=1,
+                              record=None):
+    """ Function for Euler Forward numerical integration,
+    with a right-hand side that writes into a work buffer.
+    
+    Same as `fcn_euler_forward` (without events), but `diff` has the
+    signature ``diff(t, y, dy)`` and writes the value of d_dt into the
+    array `dy`. The work buffers are allocated once per run and the
+    results are written in place, which removes most of the per-step
+    allocations for small systems. It is the method 'euler_inplace' of
+    the registry (see Module.integrate, for the models with a method
+    'diff_inplace').
+    
+    Parameters
+    ----------
+    diff : callable
+        Function ``diff(t, y, dy)`` to calculate the value of d_dt
+        into `dy` (the right-hand side of the system).
+    t_span : 2-tuple of floats
+        Interval of integration (t0, tf). The solver starts with t=t0 and
+        integrates until it reaches t=tf.
+    y0 : ndarray, shape (n_states,) or (n_states, n_members)
+        Initial state.
+    h : float
+        Step size for the integration.
+    nsave : int
+        Store the results every `nsave` steps.
+    record : callable, optional
+        Function ``record(i)``, called before the evaluation of `diff` at
+        the i-th stored state (see `fcn_euler_forward`).
+    
+    Returns
+    -------
+    Dictionary with the following:\n
+    t : ndarray, shape (n_points,)
+        Time vector for desired evaluation (based on `t_span`, `h`
+        and `nsave`).
+    y : ndarray, shape (n_outputs, n_points) or (n_outputs, n_members, n_points)
+        Values of the solution at `t`.
+    """
+    # Vectors for integration time and model outputs
+    # (time on the first axis, so that each state is a contiguous buffer)
+    tint, tsave = time_grid(t_span, h, nsave)
+    yint = np.zeros((tsave.size,) + y0.shape)
+    # Assign initial condition to first element of output vector
+    yint[0] = y0
+    # Work buffers for the slope and for the states between stored ones
+    k1, yw = np.empty_like(yint[0]), np.empty_like(yint[0])
+    y = yint[0]
+    for idx, ti in enumerate(tint[:-1].tolist()):
+        if record is not None and idx % nsave == 0:
+            record(idx//nsave)
+        # Model outputs at next time instant (Euler forward)
+        # (written into the stored results every nsave steps)
+        diff(ti, y, k1)
+        k1 *= h
+        i, r = divmod(idx+1, nsave)
+        y_new = yint[i] if r == 0 else yw
+        np.add(y, k1, out=y_new)
+        y = y_new
+    return {'t':tsave, 'y':np.moveaxis(yint, 0, -1)}
+
+def fcn_rk4_inplace(diff, t_span, y0, h=1.0, nsave=1, record=None):
+    """ Function for Runge-Kutta numerical integration,
+    with a right-hand side that writes into a work buffer.
+    
+    Same as `fcn_rk4` (without events), but `diff` has the signature
+    ``diff(t, y, dy)`` and writes the value of d_dt into the array `dy`.
+    The slopes and the stage states are allocated once per run and
+    updated in place. It is the method 'rk4_inplace' of the registry.
+    
+    Parameters
+    ----------
+    diff : callable
+        Function ``diff(t, y, dy)`` to calculate the value of d_dt
+        into `dy` (the right-hand side of the system).
+    t_span : 2-tuple of floats
+        Interval of integration (t0, tf). The solver starts with t=t0 and
+        integrates until it reaches t=tf.
+    y0 : ndarray, shape (n_states,) or (n_states, n_members)
+        Initial state.
+    h : float
+        Step size for the integration.
+    nsave : int
+        Store the results every `nsave` steps.
+    record : callable, optional
+        Function ``record(i)``, called before the evaluation of `diff` at
+        the i-th stored state (see `fcn_euler_forward`).
+    
+    Returns
+    -------
+    Dictionary with the following:\n
+    t : ndarray, shape (n_points,)
+        Time vector for desired evaluation (based on `t_span`, `h`
+        and `nsave`).
+    y : ndarray, shape (n_outputs, n_points) or (n_outputs, n_members, n_points)
+        Values of the solution at `t`.
+    """
+    # Vectors for integration time and model outputs
+    # (time on the first axis, so that each state is a contiguous buffer)
+    tint, tsave = time_grid(t_span, h, nsave)
+    yint = np.zeros((tsave.size,) + y0.shape)
+    # Assign initial condition to first element of output vector
+    yint[0] = y0
+    # Work buffers for the slopes, the stage states and the states
+    # between stored ones
+    k1, k2, k3, k4, ys, yw = (np.empty_like(yint[0]) for _ in range(6))
+    h2, h6 = h/2, h/6
+    y = yint[0]
+    for idx, ti in enumerate(tint[:-1].tolist()):
+        if record is not None and idx % nsave == 0:
+            record(idx//nsave)
+        # Slopes
+        diff(ti, y, k1)
+        np.multiply(k1, h2, out=ys); ys += y
+        diff(ti+h2, ys, k2)
+        np.multiply(k2, h2, out=ys); ys += y
+        diff(ti+h2, ys, k3)
+        np.multiply(k3, h, out=ys); ys += y
+        diff(ti+h, ys, k4)
+        # Model outputs at next time instant
+        # (written into the stored results every nsave steps)
+        k2 += k3; k2 *= 2; k2 += k1; k2 += k4
+        k2 *= h6
+        i, r = divmod(idx+1, nsave)
+        y_new = yint[i] if r == 0 else yw
+        np.add(y, k2, out=y_new)
+        y = y_new
+    return {'t':tsave, 'y':np.moveaxis(yint, 0, -1)}
+
+def step_euler(diff, t, y, h):
+    """ One Euler forward step of size `h` from state `y` at time `t` """
+    return y + diff(t,y)*h
+
+def step_rk4(diff, t, y, h):
+    """ One Runge-Kutta (4th order) step of size `h` from state `y`
+    at time `t`
+    """
+    k1 = diff(t,y)
+    k2 = diff(t+h/2,y+k1*h/2)
+    k3 = diff(t+h/2,y+k2*h/2)
+    k4 = diff(t+h,y+k3*h)
+    return y + (k1 + 2*k2 + 2*k3 + k4)*h/6
+
+# Fixed-step method of `fcn_stream` for the methods of the registry with
+# an explicit Runge-Kutta scheme (the adaptive ones with the step `h`)
+STREAM_METHODS = {
+    'euler':'euler',
+    'rk4':'rk4',
+    'euler_inplace':'euler',
+    'rk4_inplace':'rk4',
+    'dopri45':'rk4',
+    'RK45':'rk4',
+    'RK23':'rk4',
+    'DOP853':'rk4',
+    }
+
+def fcn_stream(diff, t_span, y0, h=1.0, method='euler', chunk=1000,
+               nsave=1):
+    """ Generator for numerical integration in chunks of time.
+    
+    Same integration as `fcn_euler_forward` or `fcn_rk4` (with the steps
+    `step_euler` or `step_rk4`), but the results are yielded in chunks of
+    `chunk` stored time instants instead of being stored for the whole
+    interval. The memory use is bounded by the chunk size, independently
+    of the length of `t_span`.
+    
+    Parameters
+    ----------
+    diff : callable
+        Function to calculate the value of d_dt
+        (the right-hand side of the system).
+    t_span : 2-tuple of floats
+        Interval of integration (t0, tf). The solver starts with t=t0 and
+        integrates until it reaches t=tf.
+    y0 : ndarray, shape (n_states,) or (n_states, n_members)
+        Initial state.
+    h : float
+        Step size for the integration.
+    method : {'euler', 'rk4'}
+        Euler forward, or 4th-order Runge-Kutta.
+    chunk : int
+        Number of stored time instants per chunk.
+    nsave : int
+        Store the results every `nsave` steps.
+    
+    Yields
+    ------
+    t : ndarray, shape (n_chunk,)
+        Time instants of the chunk (the first chunk starts with t0), as
+        the time vector of `fcn_euler_forward` with `nsave`.
+    y : ndarray, shape (n_outputs, n_chunk) or (n_outputs, n_members, n_chunk)
+        Values of the solution at `t`.
+    """
+    steps = {'euler':step_euler, 'rk4':step_rk4}
+    if method not in steps:
+        raise ValueError("method must be 'euler' or 'rk4', got %r" % method)
+    step = steps[method]
+    # Number of integration time instants and their spacing, and number
+    # of stored time instants and their spacing
+    # (the same as np.linspace in `time_grid`, computed per chunk)
+    nt = int((t_span[1]-t_span[0])/h) + 1
+    dt_grid = (t_span[1]-t_span[0])/(nt-1) if nt > 1 else 0.0
+    nout = (nt-1)//nsave + 1
+    if (nout-1)*nsave == nt-1:
+        t_last = t_span[1]
+    else:
+        t_last = (nout-1)*nsave*dt_grid + t_span[0]
+    dt_save = (t_last-t_span[0])/(nout-1) if nout > 1 else 0.0
+    y = np.asarray(y0, dtype=float)
+    # Index of the integration time instant of `y`
+    idx = 0
+    for i0 in range(0, nout, chunk):
+        i1 = min(i0+chunk, nout)
+        tc = np.arange(i0, i1)*dt_save + t_span[0]
+        if i1 == nout:
+            tc[-1] = t_last
+        yc = np.empty(y.shape + (i1-i0,))
+        for i in range(i0, i1):
+            # Model outputs at next stored time instant
+            while idx < i*nsave:
+                y = step(diff, t_span[0] + idx*dt_grid, y, h)
+                idx += 1
+            yc[...,i-i0] = y
+        yield tc, yc
+
+def _event_crossing(g0, g1, direction):
+    """ Whether an event function crosses zero from g0 to g1 """
+    if g0 == 0 or np.sign(g0) == np.sign(g1):
+        return False
+    return direction == 0 or np.sign(g1 - g0) == np.sign(direction)
+
+def fcn_events(diff, t_span, y0, h, events, step=step_euler, nsave=1,
+               record=None):
+    """ Function for fixed-step numerical integration with events.
+    
+    The event functions are evaluated after each step. If one of them
+    changes sign, its zero is located within the step by root-finding
+    (Brent's method) on a partial step of the same method, so the event
+    time is not limited to the time vector. The event functions take the
+    same attributes as for scipy.integrate.solve_ivp, plus the optional
+    attribute 'update' for a discrete change of state:
+    
+    * terminal : bool (default False)
+        Stop the integration at the event. The state at the event is
+        the last element of the results.
+    * direction : float (default 0)
+        Only detect zero-crossings upwards (>0) or downwards (<0).
+    * update : callable ``update(t, y)``, optional
+        New state after a non-terminal event (e.g. a harvest cut).
+        The step is completed from the event time with the new state.
+    
+    Only the first event within a step is handled.
+    
+    Parameters
+    ----------
+    diff : callable
+        Function to calculate the value of d_dt
+        (the right-hand side of the system).
+    t_span : 2-tuple of floats
+        Interval of integration (t0, tf). The solver starts with t=t0 and
+        integrates until it reaches t=tf.
+    y0 : ndarray, shape (n_states,)
+        Initial state (single trajectory).
+    h : float
+        Step size for the integration.
+    events : callable, or list of callables
+        Event functions ``event(t, y)``, with a zero at the event.
+    step : callable
+        Function for one integration step, ``step(diff, t, y, h)``
+        (`step_euler` or `step_rk4`).
+    nsave : int
+        Store the results every `nsave` steps.
+    record : callable, optional
+        Function ``record(i)``, called before the step from the i-th
+        stored state (see `fcn_euler_forward`).
+    
+    Returns
+    -------
+    Dictionary with the following:\n
+    t : ndarray, shape (n_points,)
+        Time vector for desired evaluation (based on `t_span`, `h` and
+        `nsave`), up to the terminal event, if any.
+    y : ndarray, shape (n_outputs, n_points)
+        Values of the solution at `t`.
+    t_events : list of ndarrays
+        Times of each event.
+    y_events : list of ndarrays, shape (n_events, n_outputs)
+        States at each event (before the update, if any).
+    """
+    if np.ndim(y0) != 1:
+        raise ValueError('events are only supported for a single trajectory')
+    if callable(events):
+        events = [events]
+    # Vectors for integration time and model outputs
+    # (only every nsave-th time instant is stored)
+    tint, tsave = time_grid(t_span, h, nsave)
+    yint = np.zeros((y0.size, tsave.size))
+    # Assign initial condition to first element of output vector
+    yint[:,0] = y0
+    t_events = [[] for ev in events]
+    y_events = [[] for ev in events]
+    # Values of the event functions at the start of the step
+    y = yint[:,0].copy()
+    g = [ev(tint[0], y) for ev in events]
+    for idx in range(tint.size-1):
+        ti = tint[idx]
+        if record is not None and idx % nsave == 0:
+            record(idx//nsave)
+        # Model outputs at next time instant
+        y_new = step(diff, ti, y, h)
+        g_new = [ev(tint[idx+1], y_new) for ev in events]
+        # First event within the step
+        j_ev, tau_ev = None, h
+        for j, ev in enumerate(events):
+            if not _event_crossing(g[j], g_new[j],
+                                   getattr(ev, 'direction', 0)):
+                continue
+            if g_new[j] == 0:
+                tau = h
+            else:
+                tau = brentq(lambda tau: ev(ti+tau, step(diff, ti, y, tau)),
+                             0.0, h)
+            if j_ev is None or tau < tau_ev:
+                j_ev, tau_ev = j, tau
+        if j_ev is not None:
+            ev = events[j_ev]
+            t_ev = ti + tau_ev
+            y_ev = y_new if tau_ev == h else step(diff, ti, y, tau_ev)
+            t_events[j_ev].append(t_ev)
+            y_events[j_ev].append(y_ev)
+            if getattr(ev, 'terminal', False):
+                # Stored results up to the event, and the event itself
+                n = idx//nsave + 1
+                tsave = np.append(tsave[:n], t_ev)
+                yint = np.column_stack((yint[:,:n], y_ev))
+                break
+            if getattr(ev, 'update', None) is not None:
+                # Discrete change of state, and rest of the step
+                y_new = np.asarray(ev.update(t_ev, y_ev), dtype=float)
+                if tau_ev < h:
+                    y_new = step(diff, t_ev, y_new, h - tau_ev)
+                g_new = [e(tint[idx+1], y_new) for e in events]
+        if (idx+1) % nsave == 0:
+            yint[:,(idx+1)//nsave] = y_new
         # Update initial condition for next iteration
-        y0 = yint[:,idx+1]
-    return {'t':tint, 'y':yint}
-        
\ No newline at end of file
+        y, g = y_new, g_new
+    return {'t':tsave, 'y':yint,
+            't_events':[np.array(te) for te in t_events],
+            'y_events':[np.array(ye).reshape(-1, y0.size) for ye in y_events]}
+
+def fcn_solve_ivp(diff, t_span, y0, h=1.0, events=None, nsave=1,
+                  method='RK45', **options):
+    """ Function for numerical integration with scipy.integrate.solve_ivp,
+    with the same arguments and results as the functions above.
+    
+    The solver chooses its own (adaptive) steps. The results are evaluated
+    at the time vector of `h` and `nsave`. An ensemble is integrated as
+    one flattened system.
+    
+    Parameters
+    ----------
+    diff : callable
+        Function ``diff(t, y)`` for the right-hand side of the system.
+    t_span : 2-tuple of floats
+        Interval of integration (t0, tf).
+    y0 : ndarray, shape (n_states,) or (n_states, n_members)
+        Initial state.
+    h : float
+        Step size of the time vector for the results.
+    events : callable, or list of callables, optional
+        Event functions, as for solve_ivp (single trajectory only).
+    nsave : int
+        Evaluate the results every `nsave` multiples of `h`.
+    method : str
+        Integration method of solve_ivp ('RK45', 'LSODA', 'BDF', etc.).
+    **options
+        Other options for solve_ivp (e.g. `rtol`, `atol`).
+    
+    Returns
+    -------
+    Dictionary with the following:\n
+    t : ndarray, shape (n_points,)
+        Time vector for desired evaluation (based on `t_span`, `h`
+        and `nsave`), up to the terminal event, if any, and its time.
+    y : ndarray, shape (n_outputs, n_points) or (n_outputs, n_members, n_points)
+        Values of the solution at `t`.
+    nfev : int
+        Number of evaluations of the right-hand side.
+    t_events, y_events : list of ndarrays
+        Times and states of each event (only if `events` is given).
+    """
+    y0 = np.asarray(y0, dtype=float)
+    if events is not None and y0.ndim > 1:
+        raise ValueError('events are only supported for a single trajectory')
+    shape = y0.shape
+    # (solve_ivp requires a 1D state vector)
+    fun = diff
+    if y0.ndim > 1:
+        fun = lambda t, y: np.reshape(diff(t, y.reshape(shape)), -1)
+    t_eval = time_grid(t_span, h, nsave)[1]
+    sol = solve_ivp(fun, t_span, y0.ravel(), method=method, t_eval=t_eval,
+                    events=events, **options)
+    t, yt = sol.t, sol.y
+    if sol.status == 1:
+        # Terminal event: results up to the event, and the event itself
+        # (as fcn_events), the last of the events found
+        j = max((j for j in range(len(sol.t_events))
+                 if sol.t_events[j].size), key=lambda j: sol.t_events[j][-1])
+        t_ev, y_ev = sol.t_events[j][-1], sol.y_events[j][-1]
+        if t.size == 0 or t_ev > t[-1]:
+            t = np.append(t, t_ev)
+            yt = np.column_stack((yt, y_ev))
+    y = {'t':t, 'y':yt.reshape(shape + (-1,)), 'nfev':sol.nfev}
+    if events is not None:
+        y['t_events'], y['y_events'] = sol.t_events, sol.y_events
+    return y
+
+# Registry of integration methods, by name (see `fcn_integrate`)
+INTEGRATORS = {
+    'euler':fcn_euler_forward,
+    'rk4':fcn_rk4,
+    'dopri45':fcn_dopri45,
+    'bdf2':fcn_bdf2,
+    'euler_inplace':fcn_euler_forward_inplace,
+    'rk4_inplace':fcn_rk4_inplace,
+    }
+# Methods with a right-hand side ``diff(t, y, dy)`` that writes into `dy`
+INPLACE_METHODS = ('euler_inplace', 'rk4_inplace')
+for _method in ('RK45', 'RK23', 'DOP853', 'Radau', 'BDF', 'LSODA'):
+    INTEGRATORS[_method] = functools.partial(fcn_solve_ivp, method=_method)
+
+def register_integrator(name, fcn):
+    """ Add an integration method to the registry `INTEGRATORS`
+    
+    Parameters
+    ----------
+    name : str
+        Name of the method (e.g. for the argument `method` of Module).
+    fcn : callable
+        Function ``fcn(diff, t_span, y0, h=h, nsave=nsave, **options)``
+        returning a dictionary with 't' and 'y', as `fcn_euler_forward`.
+        It supports events if it has the argument `events`.
+    """
+    INTEGRATORS[name] = fcn
+
+@functools.lru_cache(maxsize=None)
+def _parameters(fcn):
+    # Names of the arguments of an integration function
+    # (inspected once per function, not at every run)
+    return frozenset(inspect.signature(fcn).parameters)
+
+def fcn_integrate(diff, t_span, y0, method='euler', h=1.0, events=None,
+                  nsave=1, record=None, **options):
+    """ Function for numerical integration with a method of the registry
+    
+    Parameters
+    ----------
+    diff : callable
+        Function ``diff(t, y)`` for the right-hand side of the system
+        (``diff(t, y, dy)``, writing into `dy`, for the methods of
+        `INPLACE_METHODS`).
+    t_span : 2-tuple of floats
+        Interval of integration (t0, tf).
+    y0 : ndarray, shape (n_states,) or (n_states, n_members)
+        Initial state.
+    method : str
+        Name of the method in `INTEGRATORS`.
+    h : float
+        Step size for the integration.
+    events : callable, or list of callables, optional
+        Event functions (only for the methods that support them).
+    nsave : int
+        Store the results every `nsave` steps.
+    record : callable, optional
+        Function ``record(i)``, called before the evaluation of `diff` at
+        the i-th stored state (except the last one). For the methods
+        without this argument, `diff` is evaluated once more at each
+        stored state after the integration.
+    **options
+        Other options of the method (e.g. `rtol`, `atol`).
+    
+    Returns
+    -------
+    Dictionary with 't' and 'y', and other results of the method.
+    """
+    if method not in INTEGRATORS:
+        raise ValueError('unknown integration method %r, available: %s'
+                         % (method, ', '.join(INTEGRATORS)))
+    fcn = INTEGRATORS[method]
+    params = _parameters(fcn)
+    if events is not None:
+        if 'events' not in params:
+            raise ValueError('method %r does not support events' % method)
+        options['events'] = events
+    if record is not None and 'record' in params:
+        options['record'] = record
+    y = fcn(diff, t_span, y0, h=h, nsave=nsave, **options)
+    if record is not None and 'record' not in params:
+        for i in range(y['t'].size-1):
+            record(i)
+            diff(y['t'][i], y['y'][...,i])
+    return y
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+FTE34806 - Modelling of Biobased Production Systems
+MSc Biosystems Engineering, WUR
+
+Optional compiled backend for the numerical integration of the models.
+
+If Numba is installed, the scalar right-hand side of a model is compiled
+together with the Euler forward or Runge-Kutta stepping loop into one
+native routine. Without Numba, the functions are kept as plain Python and
+the modules use the NumPy integration functions instead
+(see the argument `jit` of Module).
+"""
+import numpy as np
+
+from mbps.functions.integration import time_grid
+
+try:
+    import numba
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+def njit(fcn):
+    """ Compile a function with numba.njit, if Numba is available.
+    Otherwise, return the function unchanged.
+    """
+    if HAS_NUMBA:
+        return numba.njit(fcn)
+    return fcn
+
+def _make_kernel(rhs, method):
+    """ Build the stepping loop for `rhs`, compiled as one routine """
+    # (the results are stored every nsave steps, in nout rows)
+    if method == 'euler':
+        def kernel(tint, y0, h, args, nsave, nout):
+            n = y0.size
+            yint = np.zeros((nout, n))
+            yint[0,:] = y0
+            y, k1 = y0.copy(), np.empty(n)
+            for idx in range(tint.size-1):
+                rhs(tint[idx], y, k1, args)
+                for i in range(n):
+                    y[i] = y[i] + k1[i]*h
+                if (idx+1) % nsave == 0:
+                    yint[(idx+1)//nsave,:] = y
+            return yint
+    elif method == 'rk4':
+        def kernel(tint, y0, h, args, nsave, nout):
+            n = y0.size
+            yint = np.zeros((nout, n))
+            yint[0,:] = y0
+            y = y0.copy()
+            k1, k2 = np.empty(n), np.empty(n)
+            k3, k4 = np.empty(n), np.empty(n)
+            ys = np.empty(n)
+            for idx in range(tint.size-1):
+                ti = tint[idx]
+                rhs(ti, y, k1, args)
+                for i in range(n):
+                    ys[i] = y[i] + k1[i]*h/2
+                rhs(ti+h/2, ys, k2, args)
+                for i in range(n):
+                    ys[i] = y[i] + k2[i]*h/2
+                rhs(ti+h/2, ys, k3, args)
+                for i in range(n):
+                    ys[i] = y[i] + k3[i]*h
+                rhs(ti+h, ys, k4, args)
+                for i in range(n):
+                    y[i] = y[i] + (k1[i] + 2*k2[i] + 2*k3[i] + k4[i])*h/6
+                if (idx+1) % nsave == 0:
+                    yint[(idx+1)//nsave,:] = y
+            return yint
+    else:
+        raise ValueError("method must be 'euler' or 'rk4', got %r" % method)
+    return njit(kernel)
+
+# Compiled kernels, per right-hand side and method
+_kernels = {}
+
+def fcn_jit(rhs, t_span, y0, h=1.0, args=(), method='euler', nsave=1):
+    """ Function for numerical integration with a compiled kernel.
+    Based on the syntax of scipy.integrate.solve_ivp
+
+    The stepping loop of `method` and the right-hand side `rhs` are
+    compiled together (on the first call for each pair), so that the
+    whole integration runs without the Python interpreter.
+
+    Parameters
+    ----------
+    rhs : callable
+        Function ``rhs(t, y, dy, args)``, decorated with `njit`,
+        that writes the value of d_dt into the array `dy`.
+    t_span : 2-tuple of floats
+        Interval of integration (t0, tf). The solver starts with t=t0 and
+        integrates until it reaches t=tf.
+    y0 : ndarray, shape (n_states,)
+        Initial state (single trajectory).
+    h : float
+        Step size for the integration.
+    args : tuple
+        Extra arguments for `rhs` (parameters, disturbance arrays, etc.).
+    method : {'euler', 'rk4'}
+        Euler forward, or 4th-order Runge-Kutta.
+    nsave : int
+        Store the results every `nsave` steps.
+
+    Returns
+    -------
+    Dictionary with the following:\n
+    t : ndarray, shape (n_points,)
+        Time vector for desired evaluation (based on `t_span`, `h`
+        and `nsave`).
+    y : ndarray, shape (n_outputs, n_points)
+        Values of the solution at `t`.
+    """
+    key = (rhs, method)
+    if key not in _kernels:
+        _kernels[key] = _make_kernel(rhs, method)
+    # Vectors for integration time and stored results
+    tint, tsave = time_grid(t_span, h, nsave)
+    yint = _kernels[key](tint, np.asarray(y0, dtype=float), float(h), args,
+                         int(nsave), tsave.size)
+    return {'t':tsave, 'y':yint.T}
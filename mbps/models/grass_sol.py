@@ -10,7 +10,46 @@ Class for grass growth model from Grasim
 import numpy as np
 
 from mbps.classes.module import Module
-from mbps.functions.integration import fcn_euler_forward
+from mbps.classes.disturbances import Disturbances
+from mbps.functions.jit import njit
+
+# Scalar system of differential equations, for the compiled integration
+# (same equations as Grass.diff, without the storage of flows)
+@njit
+def rhs_jit(_t, _x0, _dx, args):
+    (a, alpha, beta, k, m, M, mu_m, P0, phi, Tmax, Tmin, Topt, Y, z,
+     t_I0, I0, t_T, T, t_WAI, WAI, f_Gr, f_Hr) = args
+    Ws, Wg = _x0[0], _x0[1]
+    theta = 12/44
+    # Disturbances at instant _t
+    _I0 = np.interp(_t, t_I0, I0)
+    _T = np.interp(_t, t_T, T)
+    _WAI = np.interp(_t, t_WAI, WAI)
+    # Supporting equations
+    W = Ws + Wg
+    DTmax = max(Tmax - _T, 0.0)
+    DTmin = max(_T - Tmin, 0.0)
+    DTa = Tmax-Topt
+    DTb = Topt-Tmin
+    TI = (DTmax/DTa * (DTmin/DTb)**(DTb/DTa))**z
+    LAI = a*Wg
+    if TI==0 and _I0==0:
+        P = 0.0
+    else:
+        Pm = P0*TI
+        C1 = alpha*k*_I0/(1-m)
+        C2 = (C1+Pm)/(C1*np.exp(-k*LAI)+Pm)
+        P = Pm/k*np.log(C2)
+    # Flows
+    f_P = _WAI*phi*theta*P
+    f_SR = (1-Y)/Y * mu_m*Ws*Wg/W
+    f_MR = M*Wg
+    f_G = mu_m*Ws*Wg/W
+    f_S = beta*Wg
+    f_R = 0.0
+    # Differential equations
+    _dx[0] = f_P - f_SR - f_G - f_MR + f_R
+    _dx[1] = f_G - f_S - f_R - f_Hr - f_Gr
 
 class Grass(Module):
     ''' 
@@ -119,14 +158,40 @@ class Grass(Module):
       senescence, and applied to grass, 
       Plant, Cell & Environment 6.9, 721-729.
     '''
-    def __init__(self, tsim, dt, x0, p):
-        Module.__init__(self, tsim, dt, x0, p)
-        # Initialize dictionary of flows
-        self.f = {}
-        self.f_keys = ('f_P', 'f_SR', 'f_G', 'f_MR',
-                       'f_R', 'f_S', 'f_Hr', 'f_Gr')
-        for k in self.f_keys:
-            self.f[k] = np.full((self.t.size,), np.nan)
+    # State variables, in the order used by the method 'diff'
+    x_keys = ('Ws', 'Wg')
+    # Parameters, in the order of the parameter vector read by 'diff'
+    # (and of the arguments of rhs_jit)
+    p_keys = ('a', 'alpha', 'beta', 'k', 'm', 'M', 'mu_m', 'P0', 'phi',
+              'Tmax', 'Tmin', 'Topt', 'Y', 'z')
+    # Compiled right-hand side, for the argument `jit`
+    # (with the arguments of the method 'jit_args')
+    rhs_jit = staticmethod(rhs_jit)
+    # Flows, logged in the dictionary `f` by the method 'diff'
+    # (for an ensemble, flows keep the member axis before time)
+    f_keys = ('f_P', 'f_SR', 'f_G', 'f_MR', 'f_R', 'f_S', 'f_Hr', 'f_Gr')
+    # Derived outputs, computed from the states (and the parameters of the
+    # run, `y.p`) on access
+    # (trailing axis for 'a', to broadcast ensemble members over time)
+    derived = {
+        # [-] Leaf area index
+        'LAI':lambda self, y: np.expand_dims(y.p['a'], -1)*y['Wg'],
+        }
+
+    def __init__(self, tsim, dt, x0, p, **kwargs):
+        Module.__init__(self, tsim, dt, x0, p, **kwargs)
+        # Tables of the disturbances (built for each new `d`, see the
+        # method 'disturbances')
+        self.dist = None
+    
+    def disturbances(self):
+        """ Tables of the current disturbances `d`, validated once per
+        dictionary `d` (rebuilt when `d` is replaced, e.g. by 'run',
+        'stream' or a cache hit)
+        """
+        if self.dist is None or self.dist.d is not self.d:
+            self.dist = Disturbances(self.d, keys=('I0', 'T', 'WAI'))
+        return self.dist
     
     def diff(self, _t, _x0):
         # -- Initial conditions
@@ -136,27 +201,29 @@ class Grass(Module):
         theta = 12/44            # [-] CO2 to C (physical constant)
         
         # -- Model parameteres
-        a = self.p['a']          # [m2 kgC-1] structural specific leaf area
-        alpha = self.p['alpha']  # [kgCO2 J-1] leaf photosynthetic efficiency
-        beta = self.p['beta']    # [d-1] senescence rate
-        k = self.p['k']          # [-] extinction coefficient of canopy
-        m = self.p['m']          # [-] leaf transmission coefficient
-        M = self.p['M']          # [d-1] maintenance respiration coefficient
-        mu_m = self.p['mu_m']    # [d-1] max. structural specific growth rate
-        P0 = self.p['P0']        # [kgCO2 m-2 d-1] max photosynthesis parameter
-        # P1 = self.p['P1']      # [kgCO2 m-2 d-1 °C-1] max photosynthesis parameter
-        phi = self.p['phi']      # [-] photoshynth. fraction for growth
-        Tmax = self.p['Tmax']    # [°C] maximum temperature for growth
-        Tmin = self.p['Tmin']    # [°C] minimum temperature for growth
-        Topt = self.p['Topt']    # [°C] optimum temperature for growth
-        Y = self.p['Y']          # [-] structure fraction from storage
-        z = self.p['z']          # [-] bell function power
+        # (parameter vector, in the order of p_keys)
+        (a,         # [m2 kgC-1] structural specific leaf area
+         alpha,     # [kgCO2 J-1] leaf photosynthetic efficiency
+         beta,      # [d-1] senescence rate
+         k,         # [-] extinction coefficient of canopy
+         m,         # [-] leaf transmission coefficient
+         M,         # [d-1] maintenance respiration coefficient
+         mu_m,      # [d-1] max. structural specific growth rate
+         P0,        # [kgCO2 m-2 d-1] max photosynthesis parameter
+         phi,       # [-] photoshynth. fraction for growth
+         Tmax,      # [°C] maximum temperature for growth
+         Tmin,      # [°C] minimum temperature for growth
+         Topt,      # [°C] optimum temperature for growth
+         Y,         # [-] structure fraction from storage
+         z,         # [-] bell function power
+         ) = self.pv
         
         # -- Disturbances at instant _t
-        I0, T, WAI = self.d['I0'], self.d['T'], self.d['WAI']
-        _I0 = np.interp(_t,I0[:,0],I0[:,1])     # [J m-2 d-2] PAR
-        _T = np.interp(_t,T[:,0],T[:,1])        # [°C] Environment temperature
-        _WAI = np.interp(_t,WAI[:,0],WAI[:,1])  # [-] Water availability index
+        # (linear interpolation, see Disturbances)
+        (_I0,       # [J m-2 d-2] PAR
+         _T,        # [°C] Environment temperature
+         _WAI,      # [-] Water availability index
+         ) = self.disturbances()(_t)
         
         # -- Controlled inputs
         f_Gr = self.u['f_Gr']    # [kgC m-2 d-1] Graze
@@ -166,20 +233,21 @@ class Grass(Module):
         # - Mass
         W = Ws + Wg             # [kgC m-2] total mass
         # - Temperature index [-]
-        DTmax = max(Tmax - _T, 0)
-        DTmin = max(_T - Tmin, 0)
+        DTmax = np.maximum(Tmax - _T, 0)
+        DTmin = np.maximum(_T - Tmin, 0)
         DTa = Tmax-Topt
         DTb = Topt-Tmin
         TI = (DTmax/DTa * (DTmin/DTb)**(DTb/DTa))**z
         # - Photosynthesis
         LAI = a*Wg                      # [m2 m-2] Leaf area index
-        if TI==0 and _I0==0:
-            P = 0.0
-        else:
-            Pm = P0*TI                      # [kgCO2 m-2 d-1] Max photosynthesis
-            C1 = alpha*k*_I0/(1-m)          # [kgCO2 m-2 d-1]
+        Pm = P0*TI                      # [kgCO2 m-2 d-1] Max photosynthesis
+        C1 = alpha*k*_I0/(1-m)          # [kgCO2 m-2 d-1]
+        # (no photosynthesis if TI==0 and _I0==0, where C2 would be 0/0;
+        # element-wise, to support ensembles of members)
+        with np.errstate(divide='ignore', invalid='ignore'):
             C2 = (C1+Pm)/(C1*np.exp(-k*LAI)+Pm) # [-]
-            P = Pm/k*np.log(C2)             # [kgCO2 m-2 d-1] Photosynthesis rate
+            P = np.where((TI==0) & (_I0==0), 0.0,
+                         Pm/k*np.log(C2))   # [kgCO2 m-2 d-1] Photosynthesis rate
         # - Flows
         # Photosynthesis [kgC m-2 d-1]
         f_P = _WAI*phi*theta*P
@@ -199,37 +267,34 @@ class Grass(Module):
         dWg_dt = f_G - f_S - f_R - f_Hr - f_Gr
         
         # -- Store flows [kgC m-2 d-1]
-        idx = np.isin(np.round(self.t,8), np.round(_t,8))
-        self.f['f_P'][idx] = f_P
-        self.f['f_SR'][idx] = f_SR
-        self.f['f_G'][idx] = f_G
-        self.f['f_MR'][idx] = f_MR
-        self.f['f_R'][idx] = f_R
-        self.f['f_S'][idx] = f_S
-        self.f['f_Hr'][idx] = f_Hr
-        self.f['f_Gr'][idx] = f_Gr
+        # (only at the stored states of a run, in the order of f_keys)
+        self.log_flows((f_P, f_SR, f_G, f_MR, f_R, f_S, f_Hr, f_Gr))
         
         return np.array([dWs_dt,dWg_dt])
     
+    def jit_args(self):
+        # Arguments of rhs_jit: parameters, tables of the disturbances
+        # (time and values) and controlled inputs
+        # (flows are not stored by the compiled integration)
+        args = self.pv
+        for k in ('I0', 'T', 'WAI'):
+            args += (np.ascontiguousarray(self.d[k][:,0], dtype=float),
+                     np.ascontiguousarray(self.d[k][:,1], dtype=float))
+        args += (float(self.u['f_Gr']), float(self.u['f_Hr']))
+        return args
+    
     def output(self, tspan):
-        # Retrieve object properties
-        dt = self.dt        # integration time step size
-        diff = self.diff    # function with system of differential equations
-        Ws0 = self.x0['Ws'] # initial condition
-        Wg0 = self.x0['Wg'] # initial condiiton
-        a = self.p['a']
+        # Tables of the disturbances, with the values at all stage times
+        # of a fixed-step integration
+        if self.method in ('euler', 'rk4') and not self.use_jit():
+            self.disturbances().precompute(tspan, self.dt)
         # Numerical integration
-        y0 = np.array([Ws0,Wg0])
-        y_int = fcn_euler_forward(diff,tspan,y0,h=dt)
+        # (method of the instance, Euler forward by default, or compiled
+        # with `jit`, see Module.solve)
         # Model results
         # assuming 0.4 kgC/kgDM (Mohtar et al. 1997, p. 1492)
-        t = y_int['t']
-        Ws = y_int['y'][0,:]
-        Wg = y_int['y'][1,:]
-        LAI = a*Wg
-        return {
-            't':t,          # [d] Integration time
-            'Ws':Ws,        # [kgC m-2] Structure weight 
-            'Wg':Wg,        # [kgC m-2] Storage weight 
-            'LAI':LAI,      # [-] Leaf area index
-        }
+        # (outputs 't' [d], 'Ws' and 'Wg' [kgC m-2], and the times and
+        # states of events, if any)
+        # (the leaf area index 'LAI' is a derived output, see `derived`)
+        y = self.solve(tspan)
+        return y
@@ -8,11 +8,18 @@ MSc Biosystems Engineering, WUR
 
 Class for logistic growth model
 """
-import numpy as np
 import time
 
 from mbps.classes.module import Module
-from mbps.functions.integration import fcn_euler_forward, fcn_rk4
+from mbps.functions.jit import njit
+
+# Scalar differential equation, for the compiled integration
+# (args: r, K)
+@njit
+def rhs_jit(_t,_y0,_dy,args):
+    r, K = args
+    m = _y0[0]
+    _dy[0] = r*m*(1-m/K)
 
 class LogisticGrowth(Module):
     """ Module for logistic growth (differential equation)
@@ -36,38 +43,44 @@ class LogisticGrowth(Module):
     m : array_like
         Time series for mass growth
     """
+    # State variables, in the order used by the method 'diff'
+    x_keys = ('m',)
+    # Parameters, in the order of the parameter vector read by 'diff'
+    p_keys = ('r','K')
+    # Compiled right-hand side, for the argument `jit`
+    rhs_jit = staticmethod(rhs_jit)
+
     # Initialize object. Inherit methods from object Module
-    def __init__(self,tsim,dt,x0,p):
-        Module.__init__(self,tsim,dt,x0,p)
+    def __init__(self,tsim,dt,x0,p,**kwargs):
+        Module.__init__(self,tsim,dt,x0,p,**kwargs)
     
     # Define differential equation of the model
     def diff(self,_t,_y0):
         # State variable
         m = _y0
         # Parameters
-        r, K = self.p['r'], self.p['K']
+        r, K = self.pv
         # Differential equation
         dm_dt = r*m*(1-m/K)
         return dm_dt
         
+    # Same differential equation, written into the buffer _dy
+    # (for the in-place methods 'euler_inplace' and 'rk4_inplace')
+    def diff_inplace(self,_t,_y0,_dy):
+        # State variable
+        m = _y0[0]
+        # Parameters
+        r, K = self.pv
+        # Differential equation
+        _dy[0] = r*m*(1-m/K)
+
     # Define model outputs from numerical integration of differential equations
     # This function is called by the Module method 'run'.
     def output(self,tspan):
-        # Retrieve object properties
-        dt = self.dt        # integration time step size
-        diff = self.diff    # function with sistem of differential equations
-        m0 = self.x0['m']   # initial conditions
-        # Initial conditions
         # Numerical integration
-        # (for numerical integration, y0 must be numpy array,
-        # even for a single state variable)
-        y0 = np.array([m0,])
-        y_ef = fcn_euler_forward(diff,tspan,y0,h=dt)    # Euler-forward
-        y_rk = fcn_rk4(diff,tspan,y0,h=dt)              # Runge-Kutta
-        # Retrieve results from numerical integration output
-        t_ef = y_ef['t']        # time
-        m_ef = y_ef['y'][0,:]   # first output (row 0)
-        t_rk = y_rk['t']        # time
-        m_rk = y_rk['y'][0,:]   # first output (row 0)
-        return {'t':t_ef, 'm':m_ef,
-                't_rk':t_rk, 'm_rk':m_rk}
+        # (method of the instance: Euler forward by default,
+        # e.g. method='rk4' for Runge-Kutta, or compiled with `jit`,
+        # see Module.solve)
+        # (outputs 't' and 'm', and the times and states of events, if any)
+        y = self.solve(tspan)
+        return y
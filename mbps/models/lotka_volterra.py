@@ -11,7 +11,16 @@ import numpy as np
 
 
 from mbps.classes.module import Module
-from mbps.functions.integration import fcn_euler_forward
+from mbps.functions.jit import njit
+
+# Scalar system of differential equations, for the compiled integration
+# (args: p1, p2, p3, p4)
+@njit
+def rhs_jit(_t,_y0,_dy,args):
+    p1, p2, p3, p4 = args
+    x1, x2 = _y0[0], _y0[1]
+    _dy[0] = p1*x1 - p2*x1*x2   # [prey d-1]
+    _dy[1] = p3*x1*x2 - p4*x2   # [pred d-1]
 
 # Model definition
 class LotkaVolterra(Module):
@@ -43,35 +52,48 @@ class LotkaVolterra(Module):
         Model outputs as 1D arrays ('prey', 'pred'),
         and the evaluation time 't'.
     """
+    # State variables, in the order used by the method 'diff'
+    x_keys = ('prey','pred')
+    # Parameters, in the order of the parameter vector read by 'diff'
+    p_keys = ('p1','p2','p3','p4')
+    # Compiled right-hand side, for the argument `jit`
+    rhs_jit = staticmethod(rhs_jit)
+
     # Initialize object. Inherit methods from object Module
-    def __init__(self,tsim,dt,x0,p):
-        Module.__init__(self,tsim,dt,x0,p)
+    def __init__(self,tsim,dt,x0,p,**kwargs):
+        Module.__init__(self,tsim,dt,x0,p,**kwargs)
 
     # Define system of differential equations of the model
     def diff(self,_t,_y0):
         # State variables
         x1, x2 = _y0[0], _y0[1]
         # Parameters
-        p1, p2 = self.p['p1'], self.p['p2']
-        p3, p4 = self.p['p3'], self.p['p4']
+        p1, p2, p3, p4 = self.pv
         # Differential equations
         dx1_dt = p1*x1 - p2*x1*x2   # [prey d-1]
         dx2_dt = p3*x1*x2 - p4*x2   # [pred d-1]
         return np.array([dx1_dt,dx2_dt])
 
+    # Same system of differential equations, written into the buffer _dy
+    # (for the in-place methods 'euler_inplace' and 'rk4_inplace')
+    def diff_inplace(self,_t,_y0,_dy):
+        # State variables
+        x1, x2 = _y0[0], _y0[1]
+        # Parameters
+        p1, p2, p3, p4 = self.pv
+        # Differential equations
+        _dy[0] = p1*x1 - p2*x1*x2   # [prey d-1]
+        _dy[1] = p3*x1*x2 - p4*x2   # [pred d-1]
+
     # Define model outputs from numerical integration of differential equations.
     # This function is called by the Module method 'run'.
     def output(self,tspan):
-        # Retrieve object properties
-        dt = self.dt        # integration time step size
-        diff = self.diff    # function with system of differential equations
-        prey0 = self.x0['prey'] # initial condition
-        pred0 = self.x0['pred'] # initial condiiton
-
         # Numerical integration
-        # (for numerical integration, y0 must be numpy array)
-        y0 = np.array([prey0,pred0])
-        y_int2 = fcn_euler_forward(diff,tspan,y0,h=dt)
+        # (method of the instance, Euler forward by default, or compiled
+        # with `jit`, see Module.solve)
+        # (outputs 't', 'prey' and 'pred', and the times and states of
+        # events, if any)
+        y = self.solve(tspan)
         print("succesfull integration")
         # TODO: add a second integration output from solve_ivp
         # Note: you must import the function solve_ivp from scipy,
@@ -79,11 +101,6 @@ class LotkaVolterra(Module):
         # See the help of solve_ivp, and pay special attention to
         # the argument t_eval.
 
-        # Retrieve results from numerical integration output
-        # TODO: retrieve the results from y_int2
-        t = y_int2['t']              # time
-        prey = y_int2['y'][0,:]      # first output (row 0, all columns)
-        pred = y_int2['y'][1,:]      # second output (row 1, all columns)
-
-        # TODO: add the model outputs from y_int2 (solve_ivp)
-        return {'t':t, 'prey':prey, 'pred':pred}
\ No newline at end of file
+        # TODO: add the model outputs from the second integration
+        # (solve_ivp)
+        return y
\ No newline at end of file
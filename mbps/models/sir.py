@@ -10,8 +10,17 @@ Class for disease SIR model
 import numpy as np
 
 from mbps.classes.module import Module
-from mbps.functions.integration import fcn_euler_forward
-from scipy.integrate import solve_ivp
+from mbps.functions.jit import njit
+
+# Scalar system of differential equations, for the compiled integration
+# (args: beta, gamma)
+@njit
+def rhs_jit(_t, _y0, _dy, args):
+    beta, gamma = args
+    s, i = _y0[0], _y0[1]
+    _dy[0] = -beta * s * i
+    _dy[1] = beta * s * i - gamma * i
+    _dy[2] = gamma * i
 
 class SIR(Module):
     """ Module for disease spread
@@ -25,10 +34,19 @@ class SIR(Module):
     Add here the model outputs returned by your object
     
     """
+    # State variables, in the order used by the method 'diff'
+    x_keys = ('susceptible', 'infected', 'recovered')
+    # Parameters, in the order of the parameter vector read by 'diff'
+    p_keys = ('beta', 'gamma')
+    # Default integration method (solve_ivp, adaptive Runge-Kutta)
+    method = 'RK45'
+    # Compiled right-hand side, for the argument `jit`
+    rhs_jit = staticmethod(rhs_jit)
+
     # Initialize object. Inherit methods from object Module
     # TODO: fill in the required code
-    def __init__(self,tsim,dt,x0,p):
-        Module.__init__(self,tsim,dt,x0,p)
+    def __init__(self,tsim,dt,x0,p,**kwargs):
+        Module.__init__(self,tsim,dt,x0,p,**kwargs)
     
     # Define system of differential equations of the model
     # TODO: fill in the required code.
@@ -44,24 +62,32 @@ class SIR(Module):
         # State variables
         s, i, r = _y0[0], _y0[1], _y0[2]
         # Parameters
-        beta, gamma = self.p['beta'], self.p['gamma']
+        beta, gamma = self.pv
         # Differential equations
         ds_dt = -beta * s * i
         di_dt = beta * s * i - gamma * i
         dr_dt = gamma * i
         return np.array([ds_dt, di_dt, dr_dt])
 
-    def output(self, tspan):
-        # Retrieve object properties
-        diff = self.diff
-        y0 = [self.x0['susceptible'], self.x0['infected'], self.x0['recovered']]
-
-        # Numerical integration using solve_ivp from scipy
-        t_eval = np.linspace(tspan[0], tspan[1], int((tspan[1]-tspan[0])/self.dt)+1)
-        sol = solve_ivp(diff, tspan, y0, method='RK45', t_eval=t_eval)
+    # Same system of differential equations, written into the buffer _dy
+    # (for the in-place methods 'euler_inplace' and 'rk4_inplace')
+    def diff_inplace(self, _t, _y0, _dy):
+        # State variables
+        s, i = _y0[0], _y0[1]
+        # Parameters
+        beta, gamma = self.pv
+        # Differential equations
+        _dy[0] = -beta * s * i
+        _dy[1] = beta * s * i - gamma * i
+        _dy[2] = gamma * i
 
-        # Retrieve results from numerical integration output
-        t = sol.t
-        s, i, r = sol.y[0], sol.y[1], sol.y[2]
-        return {'t': t, 'susceptible': s, 'infected': i, 'recovered': r}
+    def output(self, tspan):
+        # Numerical integration with the method of the instance
+        # (by default, solve_ivp from scipy, evaluated with the
+        # time-step of the stored results), or compiled with `jit`
+        # (fixed-step, with method 'euler' or 'rk4'), see Module.solve
+        # (outputs 't', 'susceptible', 'infected' and 'recovered', and the
+        # times and states of events, if any)
+        y = self.solve(tspan)
+        return y
 
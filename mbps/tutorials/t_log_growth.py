@@ -43,15 +43,18 @@ dt = 0.1             # [d] time-step size
 x0 = {"m" : 1.0}        # [gDM m-2] initial conditions
 p = {"r":1.2, "K": 100}   # [d-1], [gDM m-2] model parameters
 lg = LogisticGrowth(tsim,dt,x0,p)
+# Same model, integrated with Runge-Kutta
+lg_rk = LogisticGrowth(tsim,dt,x0,p,method='rk4')
 
 # Run model
 tspan = (tsim[0],tsim[-1])
 y = lg.run(tspan)
+y_rk = lg_rk.run(tspan)
 
 # Plot results
 plt.figure(1)
 plt.plot(y['t'], y['m'], label='Euler Forward')
-plt.plot(y["t_rk"], y["m_rk"], label='Runga Kutta')
+plt.plot(y_rk["t"], y_rk["m"], label='Runga Kutta')
 plt.legend()
 plt.xlabel(r'$time\ [d]$')
 plt.ylabel(r'$mass\ [gDM\ m^{-2}]$')
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""
+FTE34806 - Modelling of Biobased Production Systems
+MSc Biosystems Engineering, WUR
+
+Common inputs of the tests: the grass growth model with a year of
+synthetic daily weather
+"""
+import numpy as np
+import pytest
+
+@pytest.fixture
+def grass_inputs():
+    """ Time array, initial conditions, parameters, disturbances and
+    controlled inputs of a one-year run of Grass
+    """
+    tsim = np.linspace(0.0, 365.0, 366)
+    x0 = {'Ws':1E-4, 'Wg':1E-4}
+    p = {'a':45, 'alpha':2E-8, 'beta':0.025, 'k':0.5, 'm':0.1, 'M':0.02,
+         'mu_m':0.5, 'P0':0.432, 'phi':0.9, 'Tmax':42.0, 'Tmin':0.0,
+         'Topt':20.0, 'Y':0.75, 'z':1.33}
+    # Seasonal temperature [°C] and radiation [J m-2 d-1]
+    season = np.sin(2*np.pi*(tsim-110)/365)
+    d = {'T':np.array([tsim, 10 + 8*season]).T,
+         'I0':np.array([tsim, 9E6 + 7E6*season]).T,
+         'WAI':np.array([tsim, np.ones(tsim.size)]).T}
+    u = {'f_Gr':0, 'f_Hr':0}
+    return tsim, x0, p, d, u
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+FTE34806 - Modelling of Biobased Production Systems
+MSc Biosystems Engineering, WUR
+
+Tests of the cache of run results (mbps.classes.cache): the state of the
+model after a cache hit, used by the methods that do not call 'output'
+"""
+import numpy as np
+
+from mbps.models.grass_sol import Grass
+from mbps.classes.cache import ResultCache
+from mbps.functions.adjoint import fcn_sse
+
+P_NS = ('a', 'beta', 'mu_m')
+
+def reference_ns(grass_inputs):
+    tsim, x0, p, d, u = grass_inputs
+    grass = Grass(tsim, 1, x0, p)
+    return grass.ns(x0, {k:p[k] for k in P_NS}, d, u, forward=True)
+
+def test_disk_hit_then_forward_ns(grass_inputs, tmp_path):
+    # A run cached on disk, then a hit in a fresh instance and cache
+    # (as in a new process), followed by forward sensitivities
+    tsim, x0, p, d, u = grass_inputs
+    Grass(tsim, 1, x0, p, cache=ResultCache(path=str(tmp_path))).run(
+        (tsim[0], tsim[-1]), d, u)
+    cache = ResultCache(path=str(tmp_path))
+    grass = Grass(tsim, 1, x0, p, cache=cache)
+    ns = grass.ns(x0, {k:p[k] for k in P_NS}, d, u, forward=True)
+    assert cache.disk_hits == 1
+    np.testing.assert_allclose(ns.values, reference_ns(grass_inputs).values,
+                               rtol=1E-12)
+
+def test_hit_after_other_disturbances(grass_inputs):
+    # A hit with the disturbances `d` after a run with other disturbances
+    tsim, x0, p, d, u = grass_inputs
+    cache = ResultCache()
+    Grass(tsim, 1, x0, p, cache=cache).run((tsim[0], tsim[-1]), d, u)
+    d_dry = dict(d, WAI=np.array([tsim, np.full(tsim.size, 0.5)]).T)
+    grass = Grass(tsim, 1, x0, p, cache=cache)
+    grass.run((tsim[0], tsim[-1]), d_dry, u)
+    ns = grass.ns(x0, {k:p[k] for k in P_NS}, d, u, forward=True)
+    assert cache.hits == 1
+    np.testing.assert_allclose(ns.values, reference_ns(grass_inputs).values,
+                               rtol=1E-12)
+
+def test_hit_then_gradient(grass_inputs, tmp_path):
+    # The adjoint gradient after a disk hit, equal to that without cache
+    tsim, x0, p, d, u = grass_inputs
+    objective = fcn_sse('Wg', [100, 200, 300], [0.05, 0.1, 0.2])
+    Grass(tsim, 1, x0, p, cache=ResultCache(path=str(tmp_path))).run(
+        (tsim[0], tsim[-1]), d, u)
+    grass = Grass(tsim, 1, x0, p, cache=ResultCache(path=str(tmp_path)))
+    J, dJ_dp, _ = grass.gradient(x0, p, objective, d, u)
+    J_ref, dJ_dp_ref, _ = Grass(tsim, 1, x0, p).gradient(x0, p, objective,
+                                                          d, u)
+    assert J == J_ref
+    for k in p:
+        np.testing.assert_allclose(dJ_dp[k], dJ_dp_ref[k], rtol=1E-12)
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""
+FTE34806 - Modelling of Biobased Production Systems
+MSc Biosystems Engineering, WUR
+
+Tests of the calibration of parameters (mbps.classes.calibration)
+"""
+import numpy as np
+import pytest
+
+from mbps.models.log_growth import LogisticGrowth
+from mbps.classes.calibration import Calibration
+
+@pytest.mark.parametrize('jac', ['forward', 'fd'])
+def test_fit_recovers_parameters(jac):
+    # Calibration of r and K to synthetic data of logistic growth, from
+    # a run with known parameters, from other initial values
+    tsim = np.linspace(0, 30, 31)
+    x0, p = {'m':0.5}, {'r':0.4, 'K':12.0}
+    y = LogisticGrowth(tsim, 1.0, x0, p, method='rk4').run((0, 30))
+    t_data = tsim[2::3]
+    data = [{'y':'m', 't':t_data, 'data':y['m'][2::3]}]
+    cal = Calibration(LogisticGrowth(tsim, 1.0, x0, p, method='rk4'), x0,
+                      {'r':0.2, 'K':20.0}, data, ('r', 'K'),
+                      bounds={'r':(0.01, 2.0), 'K':(1.0, 100.0)}, jac=jac)
+    result = cal.fit()
+    np.testing.assert_allclose([result.p['r'], result.p['K']], [0.4, 12.0],
+                               rtol=1E-5)
+    assert result.cost < 1E-10
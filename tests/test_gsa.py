@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+FTE34806 - Modelling of Biobased Production Systems
+MSc Biosystems Engineering, WUR
+
+Tests of the global sensitivity analysis (mbps.classes.gsa)
+"""
+import numpy as np
+
+from mbps.classes.module import Module
+from mbps.classes.gsa import Sobol, Morris
+
+class Function(Module):
+    """ Module with the value of a function of the parameters as the
+    state 'f' at t=1 (dt=1 and Euler forward, from f=0 at t=0)
+    """
+    x_keys = ('f',)
+    p_keys = ('x1','x2','x3')
+
+    def __init__(self,fcn):
+        Module.__init__(self,np.array([0.,1.]),1.,{'f':0.},
+                        {'x1':0.,'x2':0.,'x3':0.})
+        self.fcn = fcn
+
+    def diff(self,_t,_y0):
+        return np.ones_like(_y0)*self.fcn(*self.pv)
+
+    def output(self,tspan):
+        return self.solve(tspan)
+
+def ishigami(x1, x2, x3):
+    return np.sin(x1) + 7*np.sin(x2)**2 + 0.1*x3**4*np.sin(x1)
+
+def test_sobol_ishigami():
+    # Sobol indices of the Ishigami function (a=7, b=0.1) on [-pi, pi]^3
+    module = Function(ishigami)
+    bounds = {k:(-np.pi, np.pi) for k in module.p_keys}
+    sa = Sobol(module, module.x0, module.p, bounds,
+               aggregate=lambda y: y[:,-1], n_boot=20, seed=0)
+    sa.run(4096, batch_size=4096)
+    df = sa.indices().iloc[0]
+    np.testing.assert_allclose([df['f',k,'S1'] for k in module.p_keys],
+                               [0.314, 0.442, 0.], atol=0.05)
+    np.testing.assert_allclose([df['f',k,'ST'] for k in module.p_keys],
+                               [0.558, 0.442, 0.244], atol=0.05)
+    assert sa.n_runs == 4096*5
+
+def test_morris_linear():
+    # Elementary effects of a linear function: the coefficient times the
+    # range of the parameter, without spread
+    module = Function(lambda x1, x2, x3: 2*x1 - 3*x2 + 0*x3)
+    bounds = {'x1':(0., 1.), 'x2':(-1., 1.), 'x3':(0., 5.)}
+    sa = Morris(module, module.x0, module.p, bounds,
+                aggregate=lambda y: y[:,-1], n_boot=20, seed=0)
+    sa.run(20)
+    df = sa.indices().iloc[0]
+    np.testing.assert_allclose([df['f',k,'mu'] for k in module.p_keys],
+                               [2., -6., 0.], atol=1E-12)
+    np.testing.assert_allclose([df['f',k,'mu_star'] for k in module.p_keys],
+                               [2., 6., 0.], atol=1E-12)
+    np.testing.assert_allclose([df['f',k,'sigma'] for k in module.p_keys],
+                               0., atol=1E-12)
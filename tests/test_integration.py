@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+FTE34806 - Modelling of Biobased Production Systems
+MSc Biosystems Engineering, WUR
+
+Tests of the integration functions (mbps.functions.integration)
+"""
+import numpy as np
+import pytest
+
+from mbps.functions.integration import fcn_integrate, fcn_dopri45, fcn_bdf2
+from mbps.models.lotka_volterra import LotkaVolterra
+
+def decay(t, y):
+    return np.array([1.0, -0.1*y[1]])
+
+def event(t, y):
+    return y[0] - 8.377
+event.terminal = True
+
+@pytest.mark.parametrize('method', ['rk4', 'RK45', 'LSODA'])
+def test_terminal_event_ends_results(method):
+    # The results end with the time and state of the terminal event
+    # (tolerances of the adaptive methods of solve_ivp)
+    options = {} if method == 'rk4' else {'rtol':1E-10, 'atol':1E-12}
+    y = fcn_integrate(decay, (0, 20), np.array([0., 1.]), method=method,
+                      h=1.0, events=event, **options)
+    np.testing.assert_allclose(y['t'][-2:], [8.0, 8.377])
+    np.testing.assert_allclose(y['y'][:,-1], [8.377, np.exp(-0.8377)],
+                               rtol=1E-6)
+    np.testing.assert_allclose(y['t_events'][0], [8.377])
+
+@pytest.mark.parametrize('method', ['euler', 'rk4'])
+def test_inplace_methods_equal_fixed_step(method):
+    # The in-place methods give the results of the fixed-step methods,
+    # with nsave, and record the same stored states
+    def diff_inplace(t, y, dy):
+        dy[...] = decay(t, y)
+    rec, rec_ip = [], []
+    y = fcn_integrate(decay, (0, 10), np.array([0., 1.]), method=method,
+                      h=0.25, nsave=4, record=rec.append)
+    y_ip = fcn_integrate(diff_inplace, (0, 10), np.array([0., 1.]),
+                         method=method+'_inplace', h=0.25, nsave=4,
+                         record=rec_ip.append)
+    np.testing.assert_array_equal(y_ip['t'], y['t'])
+    np.testing.assert_allclose(y_ip['y'], y['y'], rtol=1E-14)
+    assert rec_ip == rec == list(range(10))
+
+def test_inplace_method_of_model():
+    # A run of LotkaVolterra with 'rk4_inplace' (with its method
+    # 'diff_inplace'), for a single trajectory and an ensemble
+    tsim = np.linspace(0, 100, 101)
+    x0 = {'prey':50, 'pred':np.array([40., 50.])}
+    p = {'p1':1/30, 'p2':0.02/30, 'p3':0.01/30, 'p4':1/30}
+    for x0_k in (dict(x0, pred=50), x0):
+        y = LotkaVolterra(tsim, 0.5, x0_k, p, method='rk4').run((0, 100))
+        lv = LotkaVolterra(tsim, 0.5, x0_k, p, method='rk4_inplace')
+        # (only the method 'diff_inplace' is evaluated)
+        lv.diff = None
+        y_ip = lv.run((0, 100))
+        for k in ('prey', 'pred'):
+            np.testing.assert_allclose(y_ip[k], y[k], rtol=1E-12)
+            np.testing.assert_allclose(lv.y[k], y[k], rtol=1E-12)
+
+def logistic(t, y):
+    return 0.5*y*(1 - y/10)
+
+@pytest.mark.parametrize('rtol', [1E-3, 1E-6, 1E-9])
+def test_dopri45_logistic_growth(rtol):
+    # Error of fcn_dopri45 to the analytic solution of logistic growth,
+    # at the dense output times, within the tolerances
+    y = fcn_dopri45(logistic, (0, 30), np.array([0.1]), h=0.5, rtol=rtol,
+                    atol=rtol*1E-3)
+    m = 10/(1 + 99*np.exp(-0.5*y['t']))
+    np.testing.assert_allclose(y['y'][0], m, rtol=10*rtol)
+    assert y['t'][-1] == 30
+
+def test_dopri45_rejects_nan_steps():
+    # A NaN of the right-hand side (outside its domain, y < 0) rejects the
+    # step, and the integration goes on with smaller steps
+    def diff(t, y):
+        return np.where(y >= 0, -5*y, np.nan)
+    y = fcn_dopri45(diff, (0, 5), np.array([1.]), h=1.0)
+    np.testing.assert_allclose(y['y'][0], np.exp(-5*y['t']), rtol=1E-2,
+                               atol=1E-6)
+    # (with a NaN for all states, until the step size becomes too small)
+    def diff_nan(t, y):
+        return np.full(y.shape, np.nan) if t > 2 else -y
+    with pytest.raises(RuntimeError, match='too small'):
+        fcn_dopri45(diff_nan, (0, 5), np.array([1.]), h=1.0)
+
+def test_bdf2_second_order():
+    # The error of fcn_bdf2 to the analytic solution of logistic growth
+    # is divided by about 4 when the step size is halved
+    err = []
+    for h in (0.5, 0.25, 0.125):
+        y = fcn_bdf2(logistic, (0, 10), np.array([0.1]), h=h, rtol=1E-12,
+                     atol=1E-14)
+        m = 10/(1 + 99*np.exp(-0.5*y['t']))
+        err.append(np.max(np.abs(y['y'][0] - m)))
+    np.testing.assert_allclose(np.array(err[:-1])/err[1:], 4, rtol=0.05)
+
+def test_bdf2_stiff_stable():
+    # For the stiff dy/dt = -1000*(y - cos(t)), a step size of 0.1 (where
+    # rk4 is unstable) follows the slow solution, about
+    # cos(t) + sin(t)/1000 after the initial transient
+    def stiff(t, y):
+        return -1000*(y - np.cos(t))
+    y = fcn_bdf2(stiff, (0, 10), np.array([0.]), h=0.1)
+    assert np.all(np.isfinite(y['y']))
+    t = y['t'][10:]
+    np.testing.assert_allclose(y['y'][0,10:], np.cos(t) + np.sin(t)/1000,
+                               atol=1E-4)
+    with np.errstate(over='ignore', invalid='ignore'):
+        y_rk4 = fcn_integrate(stiff, (0, 10), np.array([0.]), method='rk4',
+                              h=0.1)
+    assert not np.all(np.abs(y_rk4['y']) < 10)
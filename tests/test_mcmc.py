@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+FTE34806 - Modelling of Biobased Production Systems
+MSc Biosystems Engineering, WUR
+
+Tests of the MCMC sampling of parameters (mbps.classes.mcmc)
+"""
+import numpy as np
+import pytest
+from scipy import stats
+
+from mbps.models.log_growth import LogisticGrowth
+from mbps.classes.mcmc import EnsembleSampler
+
+class Interrupted(Exception):
+    pass
+
+def sampler(n_calls=None):
+    """ Sampler of r and K of logistic growth, for noisy synthetic data
+    (interrupted after `n_calls` calls of the log-posterior, one for the
+    initial positions and two per step)
+    """
+    tsim = np.linspace(0, 30, 31)
+    x0, p = {'m':0.5}, {'r':0.4, 'K':12.0}
+    y = LogisticGrowth(tsim, 1.0, x0, p, method='rk4').run((0, 30))
+    noise = np.random.default_rng(1).normal(0, 0.2, 10)
+    data = [{'y':'m', 't':tsim[2::3], 'data':y['m'][2::3] + noise,
+             'sigma':0.2}]
+    priors = {'r':stats.uniform(0.1, 0.9), 'K':stats.uniform(5, 20)}
+    s = EnsembleSampler(LogisticGrowth(tsim, 1.0, x0, p, method='rk4'), x0,
+                        p, data, priors, n_walkers=8, seed=0)
+    s.initialize(p)
+    if n_calls is not None:
+        log_posterior, calls = s.log_posterior, [1]
+        def interrupted(P):
+            calls[0] += 1
+            if calls[0] > n_calls:
+                raise Interrupted()
+            return log_posterior(P)
+        s.log_posterior = interrupted
+    return s
+
+def test_checkpoint_restore(tmp_path):
+    # A run interrupted after a checkpoint, restored in a new sampler and
+    # continued, gives the chains of an uninterrupted run
+    reference = sampler()
+    reference.run(10)
+    file = str(tmp_path / 'chains.npz')
+    # (interrupted in the 7th step, after the checkpoint of the 4th step)
+    with pytest.raises(Interrupted):
+        sampler(n_calls=1 + 2*6).run(10, checkpoint=file, every=4)
+    restored = sampler()
+    restored.restore(file)
+    assert restored.chain.shape[0] == 4
+    np.testing.assert_array_equal(restored.chain, reference.chain[:4])
+    restored.run(6)
+    np.testing.assert_array_equal(restored.chain, reference.chain)
+    np.testing.assert_array_equal(restored.log_prob, reference.log_prob)
+    np.testing.assert_array_equal(restored.n_accepted, reference.n_accepted)
+    assert restored.n_evals == reference.n_evals
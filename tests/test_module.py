@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+FTE34806 - Modelling of Biobased Production Systems
+MSc Biosystems Engineering, WUR
+
+Tests of the runs and logs of Module (mbps.classes.module)
+"""
+import numpy as np
+import pytest
+
+from mbps.models.grass_sol import Grass
+from mbps.models.sir import SIR
+from mbps.classes.sinks import Decimator
+
+def test_derived_outputs_keep_parameters_of_run(grass_inputs):
+    # The derived outputs (LAI = a*Wg) of a run and of the logs do not
+    # change with the parameters of later runs
+    tsim, x0, p, d, u = grass_inputs
+    grass = Grass(tsim, 1, x0, p)
+    y = grass.run((0, 100), d, u)
+    lai = np.array(y['LAI'])
+    grass.p['a'] = 60
+    grass.run((100, 200), d, u)
+    np.testing.assert_array_equal(y['LAI'], lai)
+    # (the state at t=100 is the first one of the second run)
+    np.testing.assert_allclose(grass.y['LAI'][:100],
+                               45*grass.y['Wg'][:100], rtol=1E-15)
+    np.testing.assert_allclose(grass.y['LAI'][100:201],
+                               60*grass.y['Wg'][100:201], rtol=1E-15)
+
+def test_run_from_event_time_is_logged(grass_inputs):
+    # A run from the (off-grid) time of a terminal event is stored in the
+    # logs, interpolated at the module time array
+    tsim, x0, p, d, u = grass_inputs
+    grass = Grass(tsim, 1, x0, p, method='rk4')
+    def event(t, y):
+        return y[1] - 0.05
+    event.terminal = True
+    grass.run((tsim[0], tsim[-1]), d, u, events=event)
+    t_ev = grass.t_x0
+    assert t_ev % 1 > 1E-3
+    y = grass.run((t_ev, tsim[-1]), d, u)
+    i = int(np.ceil(t_ev))
+    assert not np.any(np.isnan(grass.y['Wg']))
+    np.testing.assert_allclose(grass.y['Wg'][i:],
+                               np.interp(grass.t[i:], y['t'], y['Wg']),
+                               rtol=1E-12)
+    np.testing.assert_allclose(grass.y['LAI'][i:], 45*grass.y['Wg'][i:],
+                               rtol=1E-12)
+
+def test_stream_with_method_of_instance(grass_inputs):
+    # The states streamed to a sink (with the method of the instance, on a
+    # fresh instance) equal the logs of a run
+    tsim, x0, p, d, u = grass_inputs
+    ref = Grass(tsim, 1, x0, p, method='rk4')
+    ref.run((tsim[0], tsim[-1]), d, u)
+    grass = Grass(tsim, 1, x0, p, method='rk4')
+    sink = Decimator(1)
+    grass.stream((tsim[0], tsim[-1]), [sink], d, u, chunk=50)
+    np.testing.assert_array_equal(sink.t, ref.t)
+    np.testing.assert_allclose(sink.y, [ref.y['Ws'], ref.y['Wg']],
+                               rtol=1E-12)
+    assert grass.x0 == ref.x0
+
+def test_stream_sir_with_fixed_step_scheme():
+    # SIR (method 'RK45' by default) streams with 'rk4', and with the
+    # time-step of the stored results of the instance
+    tsim = np.linspace(0, 100, 101)
+    x0 = {'susceptible':0.99, 'infected':0.01, 'recovered':0.0}
+    p = {'beta':0.5, 'gamma':0.02}
+    ref = SIR(tsim, 0.25, x0, p, dt_save=1.0, method='rk4')
+    ref.run((tsim[0], tsim[-1]))
+    sir = SIR(tsim, 0.25, x0, p, dt_save=1.0)
+    sink = Decimator(1)
+    sir.stream((tsim[0], tsim[-1]), [sink], chunk=30)
+    np.testing.assert_array_equal(sink.t, ref.t)
+    np.testing.assert_allclose(sink.y, [ref.y[k] for k in SIR.x_keys],
+                               rtol=1E-12)
+    # (no fixed-step scheme for an implicit method)
+    sir = SIR(tsim, 0.25, x0, p, method='bdf2')
+    with pytest.raises(ValueError, match="'bdf2'"):
+        sir.stream((tsim[0], tsim[-1]), [Decimator(1)])
+
+def test_logs_follow_shape_of_ensemble(grass_inputs):
+    # Single trajectory, ensemble and single trajectory again on one
+    # instance: the logs take the shape of each run
+    tsim, x0, p, d, u = grass_inputs
+    grass = Grass(tsim, 1, x0, p)
+    grass.run((tsim[0], tsim[-1]), d, u)
+    assert grass.y['Wg'].shape == (tsim.size,)
+    grass.x0 = dict(x0)
+    grass.p = dict(p, a=np.array([40., 50.]))
+    y = grass.run((tsim[0], tsim[-1]), d, u)
+    assert grass.y['Wg'].shape == grass.y['LAI'].shape == (2, tsim.size)
+    np.testing.assert_array_equal(grass.y['Wg'], y['Wg'])
+    grass.x0, grass.p = dict(x0), dict(p)
+    y = grass.run((tsim[0], tsim[-1]), d, u)
+    assert grass.y['Wg'].shape == grass.f['f_P'].shape == (tsim.size,)
+    np.testing.assert_array_equal(grass.y['LAI'], 45*y['Wg'])
+
+def test_derived_outputs_are_keys(grass_inputs):
+    # The derived outputs of a run are keys of its outputs, as those of
+    # the model
+    tsim, x0, p, d, u = grass_inputs
+    y = Grass(tsim, 1, x0, p).run((tsim[0], tsim[-1]), d, u)
+    assert 'LAI' in y and 'LAI' in y.keys()
+    np.testing.assert_array_equal(y.get('LAI'), 45*y['Wg'])
+    assert y.get('none') is None
+    assert list(y) == ['t', 'Ws', 'Wg', 'LAI'] and len(y) == 4
+    np.testing.assert_array_equal(dict(y.items())['LAI'], y['LAI'])
+    np.testing.assert_array_equal(dict(y)['LAI'], y['LAI'])
+
+def test_ns_modes_with_part_of_parameters(grass_inputs):
+    # With some of the parameters in p_ref, the serial, batch and forward
+    # sensitivities perturb those parameters from the parameters of the
+    # instance completed with p_ref, and leave the attribute p unchanged
+    tsim, x0, p, d, u = grass_inputs
+    p_ref = {'a':50, 'beta':0.03}
+    y = Grass(tsim, 1, x0, dict(p, **p_ref), method='rk4').run(
+        (tsim[0], tsim[-1]), d, u)
+    res = {}
+    for mode in ('serial', 'batch', 'forward'):
+        grass = Grass(tsim, 1, x0, p, method='rk4')
+        grass.run((tsim[0], tsim[-1]), d, u)
+        res[mode] = grass.ns(x0, p_ref, d, u, y_keys=['Wg', 'LAI'],
+                             batch=(mode == 'batch'),
+                             forward=(mode == 'forward'), frame=False)
+        assert grass.p == p
+        np.testing.assert_array_equal(grass.pv, grass.get_p())
+        np.testing.assert_allclose(res[mode].ref[:, 0], y['Wg'], rtol=1E-6)
+        np.testing.assert_allclose(grass.y['LAI'], 50*grass.y['Wg'],
+                                   rtol=1E-15)
+    np.testing.assert_allclose(res['batch'].block, res['serial'].block,
+                               rtol=1E-6, atol=1E-9)
+    # (the forward sensitivities, between those of -5% and +5%)
+    ns_fwd = res['forward'].block[-1, :, :, 0]
+    ns_mns, ns_pls = res['serial'].block[-1, :, :, :].transpose(2, 0, 1)
+    assert np.all((ns_fwd - ns_mns)*(ns_fwd - ns_pls) <= 1E-9)